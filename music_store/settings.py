@@ -39,12 +39,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the whole chain.
+    'store.middleware.RequestInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'store.profiling.RequestProfilingMiddleware',
+    'store.middleware.ReplicaPinningMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -82,9 +86,40 @@ DATABASES = {
         'PASSWORD': '12345678',
         'HOST': 'localhost',
         'PORT': '',
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# Read replicas, given as a comma separated list of hosts. Catalog and review reads go to a random replica, see
+# store.routers. A user who wrote something keeps reading from the primary for DATABASE_REPLICA_PIN_SECONDS, which
+# should be longer than the usual replication lag.
+
+for i, host in enumerate(host for host in os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',') if host):
+    DATABASES['replica_{}'.format(i + 1)] = dict(DATABASES['default'], HOST=host, TEST={'MIRROR': 'default'})
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['store.routers.ReplicaRouter']
+DATABASE_REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# Local memory cache is per process, production with several workers should use a shared backend (e.g. memcached),
+# otherwise catalog invalidation only reaches the worker which handled the write.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+CATALOG_CACHE = 'default'
+CATALOG_CACHE_TIMEOUT = 60 * 15
+# Pre-rendered list representations of products, their keys change with the product, so they can live longer.
+CATALOG_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Seconds pieces added to a cart stay reserved for the user, see store.models.Reservation.
+RESERVATION_TIMEOUT = 60 * 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -131,6 +166,10 @@ STATICFILES_DIRS = (
 MEDIA_ROOT = os.path.join(BASE_DIR, 'uploads')
 MEDIA_URL = '/media/'
 
+# Limits of images uploaded as base64, checked before the pixels are decoded.
+IMAGE_UPLOAD_MAX_SIZE = 5 * 1024 * 1024
+IMAGE_UPLOAD_MAX_PIXELS = 25 * 1000 * 1000
+
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -173,6 +212,13 @@ AUTHENTICATION_BACKENDS = (
 )
 
 
+# Catalog feed
+# Keys partners send in the X-Feed-Key header to download /api/products/feed/, staff users don't need one.
+
+CATALOG_FEED_KEYS = [key for key in os.environ.get('CATALOG_FEED_KEYS', '').split(',') if key]
+CATALOG_FEED_CHUNK_SIZE = 1000
+
+
 # CORS
 
 CORS_ORIGIN_ALLOW_ALL = True
@@ -183,3 +229,27 @@ CORS_ALLOW_CREDENTIALS = True
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 EMAIL_ADDRESS = 'no-reply@music-shop.com'
+
+
+# Request instrumentation
+# Server-Timing header and 'store.instrumentation' log line with query count and timings of every request,
+# slow requests are sampled into a warning with the most repeated SQL statements.
+
+REQUEST_INSTRUMENTATION = False
+REQUEST_INSTRUMENTATION_SLOW_MS = 500
+REQUEST_INSTRUMENTATION_SAMPLE_RATE = 0.1
+
+
+# Request profiling
+# Staff users profile a request by sending the X-Profile header (or the `profile` parameter) set to `sample`
+# (stack sampling, saved as collapsed stacks for flame graphs) or `cprofile` (pstats file). Profiles are listed
+# in the admin, at most one request per process is profiled at a time.
+
+REQUEST_PROFILING = False
+REQUEST_PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+REQUEST_PROFILING_DEFAULT_MODE = 'sample'
+REQUEST_PROFILING_MAX_PER_MINUTE = 10
+REQUEST_PROFILING_SAMPLE_INTERVAL = 0.005
+REQUEST_PROFILING_MAX_SAMPLES = 6000
+REQUEST_PROFILING_MAX_PROFILES = 200
+REQUEST_PROFILING_MAX_AGE = 60 * 60 * 24 * 7
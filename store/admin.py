@@ -1,9 +1,16 @@
+from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.html import format_html
 
 from store.models import UserProfile, Artist, Genre, Product, Review, Shipping, Medium, RecordLabel, Payment, Order,\
-                         OrderItem, BankInfo
+                         OrderItem, BankInfo, OutgoingEmail, RequestProfile, Reservation
+from store.profiling import get_profile_path
 
 
 class UserProfileInline(admin.StackedInline):
@@ -67,8 +74,16 @@ class OrderAdmin(admin.ModelAdmin):
     list_editable = ('state',)
     list_select_related = ('user', 'user__user', 'shipping', 'payment')
     date_hierarchy = 'created'
-    readonly_fields = ('total_price', 'created')
+    readonly_fields = ('items_price', 'shipping_price', 'total_price', 'created')
     search_fields = ('user__user__username',)
+    actions = ('cancel_orders',)
+
+    def cancel_orders(self, request, queryset):
+        selected = queryset.count()
+        cancelled = queryset.cancel()
+        self.message_user(request, 'Anulowano zamówień: {}, pominięto opłaconych: {}.'.format(
+            len(cancelled), selected - len(cancelled)))
+    cancel_orders.short_description = 'Anuluj wybrane nieopłacone zamówienia'
 
 
 class OrderItemAdmin(admin.ModelAdmin):
@@ -77,6 +92,74 @@ class OrderItemAdmin(admin.ModelAdmin):
     search_fields = ('id',)
 
 
+class ReservationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'product', 'quantity', 'expires')
+    list_select_related = ('user', 'user__user', 'product')
+    readonly_fields = ('user', 'product', 'quantity', 'created')
+    search_fields = ('user__user__username', 'product__title')
+    actions = ('release_reservations',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_actions(self, request):
+        # Deleting the rows would keep the reserved pieces off the stock for good.
+        actions = super(ReservationAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def delete_model(self, request, obj):
+        Reservation.objects.filter(id=obj.id).release()
+
+    def release_reservations(self, request, queryset):
+        self.message_user(request, 'Zwolniono rezerwacji: {}.'.format(len(queryset.release())))
+    release_reservations.short_description = 'Zwolnij wybrane rezerwacje'
+
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to', 'attempts', 'next_attempt', 'sent')
+    list_filter = ('sent',)
+    date_hierarchy = 'created'
+    readonly_fields = ('created',)
+    search_fields = ('to',)
+
+
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created', 'method', 'path', 'status_code', 'mode', 'duration', 'user', 'download_link')
+    list_filter = ('mode', 'method')
+    list_select_related = ('user',)
+    date_hierarchy = 'created'
+    readonly_fields = ('user', 'method', 'path', 'status_code', 'mode', 'duration', 'file_name', 'created',
+                       'download_link')
+    search_fields = ('path',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            url(r'^(?P<pk>\d+)/download/$', self.admin_site.admin_view(self.download),
+                name='store_requestprofile_download'),
+        ] + super(RequestProfileAdmin, self).get_urls()
+
+    def download_link(self, obj):
+        return format_html('<a href="{}">{}</a>', reverse('admin:store_requestprofile_download', args=[obj.pk]),
+                           obj.file_name)
+    download_link.short_description = 'Pobierz'
+
+    def download(self, request, pk):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        try:
+            response = FileResponse(open(get_profile_path(profile.file_name), 'rb'),
+                                    content_type='application/octet-stream')
+        except FileNotFoundError:
+            raise Http404
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(profile.file_name)
+        return response
+
+
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 admin.site.register(Product, ProductAdmin)
@@ -87,6 +170,9 @@ admin.site.register(Shipping, ShippingAdmin)
 admin.site.register(RecordLabel, RecordLabelAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(OrderItem, OrderItemAdmin)
+admin.site.register(Reservation, ReservationAdmin)
 admin.site.register(Payment, PaymentAdmin)
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
 
 admin.site.register([Medium, BankInfo])
@@ -0,0 +1,24 @@
+from threading import Thread
+from time import perf_counter
+
+from django.db import connection
+
+
+def run_in_threads(target, arguments):
+    """
+    Calls `target(*args)` for every tuple of `arguments` in its own thread with its own database connection,
+    returns how many seconds all of them took.
+    """
+    def run(*args):
+        try:
+            target(*args)
+        finally:
+            connection.close()
+
+    threads = [Thread(target=run, args=args) for args in arguments]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return perf_counter() - start
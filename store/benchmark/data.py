@@ -0,0 +1,241 @@
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+from itertools import islice
+from uuid import UUID
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connections, models, router, transaction
+from django.db.models import Max
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from store.importing import CatalogImporter
+from store.models import Product, UserProfile, Review, Order, OrderItem, Shipping, Payment, BankInfo
+
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+USERNAME_PREFIX = 'benchmark-'
+PASSWORD = 'benchmark'
+
+GENRES = ('Rock', 'Pop', 'Jazz', 'Blues', 'Metal', 'Punk', 'Hip-hop', 'Elektronika', 'Muzyka klasyczna', 'Folk',
+          'Reggae', 'Soul', 'Funk', 'Country', 'Disco polo', 'Poezja śpiewana', 'Soundtrack', 'Alternatywa')
+MEDIA = (('CD', 60), ('Winyl', 30), ('Kaseta', 5), ('Blu-ray', 5))
+WORDS = ('miłość', 'noc', 'miasto', 'droga', 'słońce', 'wolność', 'ogień', 'cisza', 'morze', 'sen', 'koncert',
+         'złoty', 'czarny', 'ostatni', 'nowy', 'dziki', 'zimny', 'wielki', 'światło', 'deszcz', 'wiatr', 'serce',
+         'burza', 'lato', 'zima', 'gwiazda', 'ulica', 'piosenka', 'ballada', 'dom', 'czas', 'ziemia', 'niebo')
+TAGS = ['lata {}'.format(decade) for decade in (60, 70, 80, 90)] + [
+    'remaster', 'edycja limitowana', 'koncertowy', 'składanka', 'debiut', 'polski', 'instrumentalny', 'akustyczny',
+    'kolorowy winyl', 'box', 'reedycja', 'nagroda', 'klasyka', 'ścieżka dźwiękowa', 'dla dzieci', 'live',
+] + ['tag {}'.format(i) for i in range(200)]
+# Few products get most of the reviews and orders, like in a real shop.
+POPULARITY = 1.2
+
+
+# Fields whose values need backend specific conversion, e.g. aware datetimes on SQLite. Other values are passed
+# to the database driver as they are.
+CONVERTED_FIELDS = (models.DateTimeField, models.UUIDField)
+
+
+def prepare_rows(connection, model, fields, rows):
+    fields = [model._meta.get_field(name) for name in fields]
+    converted = [(i, field) for i, field in enumerate(fields) if isinstance(field, CONVERTED_FIELDS)]
+    columns = [connection.ops.quote_name(field.column) for field in fields]
+    if not converted:
+        return columns, rows
+    prepared = []
+    for row in rows:
+        row = list(row)
+        for i, field in converted:
+            row[i] = field.get_db_prep_save(row[i], connection)
+        prepared.append(row)
+    return columns, prepared
+
+
+def bulk_insert(model, fields, rows):
+    """
+    Inserts tuples of values with one executemany. Skips building model instances and converting every value,
+    which is most of the time bulk_create takes when generating millions of rows, so the values must already be
+    of the column types.
+    """
+    connection = connections[router.db_for_write(model)]
+    columns, rows = prepare_rows(connection, model, fields, rows)
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(connection.ops.quote_name(model._meta.db_table),
+                                                   ', '.join(columns), ', '.join(['%s'] * len(columns)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def reset_sequences(*models):
+    """Moves id sequences past rows inserted with explicit ids, needed on backends with sequences only."""
+    connection = connections[router.db_for_write(models[0])]
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class DataGenerator(object):
+    """
+    Seeds the database with a synthetic shop of `products` products, about one user per 20 products, three reviews
+    and 0.2 orders per product. The same seed gives the same data. Rows are written in chunks through the catalog
+    importer and executemany inserts, so memory stays flat up to millions of products.
+    """
+
+    def __init__(self, products, seed=0, chunk_size=5000, log=None):
+        self.products = products
+        self.rng = random.Random(seed)
+        self.chunk_size = chunk_size
+        self.log = log or (lambda message: None)
+
+    def generate(self):
+        self.create_reference_data()
+        self.create_users()
+        self.create_products()
+        self.create_reviews()
+        self.create_orders()
+
+    def create_reference_data(self):
+        for slug, name, price in (('kurier', 'Kurier', '15.00'), ('paczkomat', 'Paczkomat', '9.99'),
+                                  ('odbior-osobisty', 'Odbiór osobisty', '0.00')):
+            Shipping.objects.get_or_create(slug=slug, defaults={'name': name, 'price': Decimal(price)})
+        for slug, name in (('paypal', 'PayPal'), ('przelew-bankowy', 'Przelew bankowy')):
+            Payment.objects.get_or_create(slug=slug, defaults={'name': name})
+        if not BankInfo.objects.exists():
+            BankInfo.objects.create(account='12 3456 7890', name='Music Shop', address='Ulica 1, Warszawa')
+
+    def create_users(self):
+        count = max(self.products // 20, 10)
+        password = make_password(PASSWORD)
+        with transaction.atomic():
+            for numbers in chunked(range(count), self.chunk_size):
+                usernames = ['{}{}'.format(USERNAME_PREFIX, number) for number in numbers]
+                User.objects.bulk_create([User(username=username, password=password, email=username + '@example.com')
+                                          for username in usernames])
+                ids = list(User.objects.filter(username__in=usernames).values_list('id', flat=True))
+                # bulk_create sends no post_save, so profiles and tokens are created here.
+                UserProfile.objects.bulk_create([
+                    UserProfile(user_id=user_id, city=self.rng.choice(('Warszawa', 'Kraków', 'Gdańsk', 'Poznań')))
+                    for user_id in ids
+                ])
+                Token.objects.bulk_create([Token(user_id=user_id, key='{:040x}'.format(self.rng.getrandbits(160)))
+                                           for user_id in ids])
+        self.profile_ids = list(UserProfile.objects.filter(user__username__startswith=USERNAME_PREFIX)
+                                .values_list('id', flat=True))
+        self.log('Użytkownicy: {}'.format(count))
+
+    def make_products(self):
+        artists = max(self.products // 10, 10)
+        labels = max(self.products // 100, 5)
+        media, weights = zip(*MEDIA)
+        for i in range(self.products):
+            title = ' '.join(self.rng.sample(WORDS, self.rng.randint(1, 4))).capitalize()
+            yield {
+                'slug': 'benchmark-album-{}'.format(i),
+                'title': title,
+                'artist': 'Artysta {}'.format(int(self.rng.paretovariate(POPULARITY)) % artists),
+                'genre': self.rng.choice(GENRES),
+                'label': 'Wytwórnia {}'.format(self.rng.randrange(labels)) if self.rng.random() < 0.9 else None,
+                'medium': self.rng.choices(media, weights)[0],
+                'medium_count': self.rng.choice((1, 1, 1, 2)),
+                'release_date': date(1960, 1, 1) + timedelta(days=self.rng.randrange(365 * 58)),
+                'price': '{}.99'.format(self.rng.randint(9, 199)),
+                'stock': self.rng.choice((0,) + (1000,) * 19),
+                'length': self.rng.randint(20, 120),
+                'tags': self.rng.sample(TAGS, self.rng.choice((0, 1, 2, 2, 3, 4))),
+                'description': 'Album {} z {} utworami.'.format(title, self.rng.randint(6, 16)),
+            }
+
+    def create_products(self):
+        importer = CatalogImporter(chunk_size=self.chunk_size)
+        importer.run(self.make_products(), lambda importer: self.log('Produkty: {}'.format(importer.rows)))
+        products = Product.objects.filter(slug__startswith='benchmark-album-')
+        self.product_range = products.order_by('id').values_list('id', flat=True)
+        self.first_product_id = self.product_range.first()
+        self.last_product_id = self.product_range.last()
+
+    def pick_product(self):
+        """Picks a product id with a long tail distribution, low ids are the popular ones."""
+        offset = int(self.rng.paretovariate(POPULARITY)) - 1
+        return self.first_product_id + offset % (self.last_product_id - self.first_product_id + 1)
+
+    def create_reviews(self):
+        count = self.products * 3
+        next_id = (Review.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        start = timezone.now() - timedelta(days=3 * 365)
+        roots = []
+        fields = ('id', 'author', 'product', 'parent', 'text', 'rate', 'is_active', 'path', 'depth', 'created',
+                  'updated')
+        for chunk in chunked(range(count), self.chunk_size):
+            rows = []
+            for _ in chunk:
+                created = start + timedelta(seconds=self.rng.randrange(3 * 365 * 86400))
+                author = self.rng.choice(self.profile_ids)
+                if roots and self.rng.random() < 0.2:
+                    # A reply, in the thread of one of the recent reviews.
+                    parent_id, parent_path, product_id = self.rng.choice(roots)
+                    path, depth = Review.make_path(parent_path, next_id)
+                    rows.append((next_id, author, product_id, parent_id, 'Zgadzam się.', None, True, path, depth,
+                                 created, created))
+                else:
+                    product_id = self.pick_product()
+                    path, depth = Review.make_path('', next_id)
+                    rate = self.rng.choices((1, 2, 3, 4, 5), (5, 5, 15, 35, 40))[0]
+                    rows.append((next_id, author, product_id, None, 'Ocena {}, polecam.'.format(rate), rate,
+                                 self.rng.random() < 0.97, path, depth, created, created))
+                    roots.append((next_id, path, product_id))
+                    roots = roots[-100:]
+                next_id += 1
+            with transaction.atomic():
+                bulk_insert(Review, fields, rows)
+            self.log('Komentarze: {}'.format(chunk[-1] + 1))
+        reset_sequences(Review)
+        call_command('rebuild_product_ratings', stdout=StringIO())
+
+    def make_code(self):
+        # Drawn from the seeded generator like everything else, so the same seed makes the same orders.
+        return UUID(int=self.rng.getrandbits(128), version=4).hex
+
+    def create_orders(self):
+        count = max(self.products // 5, 10)
+        shippings = list(Shipping.objects.values_list('id', 'price'))
+        payments = list(Payment.objects.values_list('id', flat=True))
+        next_id = (Order.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        start = timezone.now() - timedelta(days=2 * 365)
+        order_fields = ('id', 'user', 'code', 'shipping', 'payment', 'address', 'zip_code', 'city', 'state',
+                        'items_price', 'shipping_price', 'total_price', 'created')
+        for chunk in chunked(range(count), self.chunk_size):
+            items = [(order_id, [(self.pick_product(), self.rng.randint(1, 3))
+                                 for _ in range(self.rng.randint(1, 4))])
+                     for order_id in range(next_id, next_id + len(chunk))]
+            prices = dict(Product.objects.filter(id__in={product_id for _, lines in items for product_id, _ in lines})
+                          .values_list('id', 'price'))
+            orders = []
+            for order_id, lines in items:
+                shipping_id, shipping_price = self.rng.choice(shippings)
+                items_price = sum(prices[product_id] * quantity for product_id, quantity in lines)
+                orders.append((order_id, self.rng.choice(self.profile_ids), self.make_code(), shipping_id,
+                               self.rng.choice(payments), 'Ulica {}'.format(order_id % 100), '00-001', 'Warszawa',
+                               self.rng.choice((Order.ORDERED, Order.PAID, Order.SEND)), items_price, shipping_price,
+                               items_price + shipping_price,
+                               start + timedelta(seconds=self.rng.randrange(2 * 365 * 86400))))
+            with transaction.atomic():
+                bulk_insert(Order, order_fields, orders)
+                bulk_insert(OrderItem, ('order', 'product', 'quantity'),
+                            [(order_id, product_id, quantity) for order_id, lines in items
+                             for product_id, quantity in lines])
+            next_id += len(chunk)
+            self.log('Zamówienia: {}'.format(chunk[-1] + 1))
+        reset_sequences(Order)
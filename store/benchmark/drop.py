@@ -0,0 +1,66 @@
+from time import perf_counter, sleep
+
+from django.db import DatabaseError, transaction
+from rest_framework.exceptions import ValidationError
+
+from store.benchmark.concurrency import run_in_threads
+from store.models import InsufficientStock, Reservation
+from store.serializers import OrderCreateSerizalizer
+
+
+class ReservationDrop(object):
+    """
+    A limited drop of one product: every group of buyers runs in its own thread, each buyer reserves a piece and
+    checks out. Results hold the seconds every attempt took, by outcome, and the number of database errors.
+    """
+
+    def __init__(self, product, buyers, shipping, payment, retries=20):
+        self.product = product
+        self.buyers = buyers
+        self.order = {'shipping': shipping, 'payment': payment, 'address': 'Ulica 1', 'zip_code': '00-001',
+                      'city': 'Warszawa', 'items': [{'product': product.slug, 'quantity': 1}]}
+        self.retries = retries
+
+    def run(self):
+        results = {'bought': [], 'checkout': [], 'sold_out': [], 'failed_checkout': [], 'errors': []}
+
+        def worker(buyers):
+            for buyer in buyers:
+                try:
+                    self.buy(buyer, results)
+                except DatabaseError:
+                    results['errors'].append(1)
+
+        run_in_threads(worker, [(buyers,) for buyers in self.buyers])
+        return results
+
+    def retry(self, func):
+        # Buyers retry like the shop's client does, SQLite fails concurrent writers instead of making them wait.
+        for attempt in range(self.retries):
+            try:
+                return func()
+            except DatabaseError:
+                sleep(0.005 * (attempt + 1))
+        raise DatabaseError('Retries exhausted')
+
+    def checkout(self, buyer):
+        serializer = OrderCreateSerizalizer(data=self.order)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            serializer.save(user=buyer)
+
+    def buy(self, buyer, results):
+        start = perf_counter()
+        try:
+            self.retry(lambda: Reservation.objects.reserve(buyer, self.product.id, 1))
+        except InsufficientStock:
+            results['sold_out'].append(perf_counter() - start)
+            return
+        reserved = perf_counter()
+        try:
+            self.retry(lambda: self.checkout(buyer))
+        except ValidationError:
+            results['failed_checkout'].append(perf_counter() - start)
+        else:
+            results['bought'].append(perf_counter() - start)
+            results['checkout'].append(perf_counter() - reserved)
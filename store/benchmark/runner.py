@@ -0,0 +1,198 @@
+import json
+import platform
+import random
+import subprocess
+from collections import OrderedDict, namedtuple
+from time import perf_counter
+from unittest import mock
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from rest_framework.authtoken.models import Token
+from rest_framework.views import APIView
+
+from store.benchmark.data import USERNAME_PREFIX
+from store.models import Product, Genre, Order, Shipping, Payment
+from store.paginations import ProductResultsSetPagination
+
+
+NO_DATA = 'Brak danych benchmarku, uruchom najpierw seed_benchmark_data.'
+
+Scenario = namedtuple('Scenario', ('name', 'method', 'make_request'))
+
+
+class Samples(object):
+    """Slugs, users and orders the scenarios pick from, loaded before anything is measured."""
+
+    def __init__(self, rng, size=200):
+        last_id = Product.objects.order_by('-id').values_list('id', flat=True).first()
+        if last_id is None:
+            raise ValueError(NO_DATA)
+        ids = [rng.randint(1, last_id) for _ in range(size)]
+        self.products = list(Product.objects.filter(id__in=ids, stock__gt=0).values_list('slug', 'title'))
+        self.pages = max(-(-Product.objects.count() // ProductResultsSetPagination.page_size), 1)
+        self.genres = list(Genre.objects.values_list('slug', flat=True))
+        self.tags = list(Product.tags.through.objects.values_list('tag__name', flat=True).distinct()[:size])
+        tokens = Token.objects.filter(user__username__startswith=USERNAME_PREFIX).values_list('user__profile', 'key')
+        self.tokens = dict(tokens[:size])
+        self.orders = list(Order.objects.filter(user__in=list(self.tokens)).values_list('id', 'user')[:size])
+        self.shipping = Shipping.objects.values_list('slug', flat=True).first()
+        self.payment = Payment.objects.filter(slug='paypal').values_list('slug', flat=True).first()
+        self.staff = User.objects.filter(is_staff=True).first()
+        if not self.products or not self.tokens or not self.orders:
+            raise ValueError(NO_DATA)
+
+
+def get_scenarios(samples):
+    """Every endpoint of store/urls.py, product lists with the typical filter combinations."""
+
+    def product(rng):
+        return rng.choice(samples.products)
+
+    def token(rng):
+        return rng.choice(list(samples.tokens.values()))
+
+    def get(path, params=None, auth=None):
+        return path, params or {}, auth
+
+    def order_detail(rng):
+        order_id, profile_id = rng.choice(samples.orders)
+        return get('/api/orders/{}/'.format(order_id), auth=samples.tokens[profile_id])
+
+    return [
+        Scenario('product-list', 'get', lambda rng: get('/api/products/')),
+        Scenario('product-list-page', 'get', lambda rng: get('/api/products/', {
+            'page': rng.randint(1, min(samples.pages, 20))})),
+        Scenario('product-list-cursor', 'get', lambda rng: get('/api/products/', {'cursor': ''})),
+        Scenario('product-list-genre', 'get', lambda rng: get('/api/products/', {'genre': rng.choice(samples.genres)})),
+        Scenario('product-list-price', 'get', lambda rng: get('/api/products/', {
+            'min_price': rng.randint(10, 50), 'max_price': rng.randint(60, 150), 'ordering': 'price'})),
+        Scenario('product-list-tags', 'get', lambda rng: get('/api/products/', {'tags': rng.choice(samples.tags)})),
+        Scenario('product-list-rating', 'get', lambda rng: get('/api/products/', {
+            'min_rating': rng.randint(1, 4), 'ordering': '-rating'})),
+        Scenario('product-list-search', 'get', lambda rng: get('/api/products/', {
+            'q': rng.choice(product(rng)[1].split())})),
+        Scenario('product-list-combined', 'get', lambda rng: get('/api/products/', {
+            'genre': rng.choice(samples.genres), 'max_price': 100, 'ordering': '-price'})),
+        Scenario('product-facets', 'get', lambda rng: get('/api/products/facets/', {
+            'genre': rng.choice(samples.genres)})),
+        Scenario('product-detail', 'get', lambda rng: get('/api/products/{}/'.format(product(rng)[0]))),
+        Scenario('product-feed', 'get', lambda rng: get('/api/products/feed/', {'since': '2999-01-01T00:00:00'},
+                                                         'staff')),
+        Scenario('reviews', 'get', lambda rng: get('/api/reviews/', {'product': product(rng)[0]})),
+        Scenario('reviews-threaded', 'get', lambda rng: get('/api/reviews/', {
+            'product': product(rng)[0], 'threaded': 1})),
+        Scenario('review-create', 'post', lambda rng: get('/api/reviews/', {
+            'product': product(rng)[0], 'text': 'Benchmark', 'rate': rng.randint(1, 5)}, token(rng))),
+        Scenario('order-create', 'post', lambda rng: get('/api/orders/new/', {
+            'shipping': samples.shipping, 'payment': samples.payment, 'address': 'Ulica 1', 'zip_code': '00-001',
+            'city': 'Warszawa', 'items': [{'product': slug, 'quantity': 1}
+                                          for slug, _ in rng.sample(samples.products, rng.randint(1, 3))]
+        }, token(rng))),
+        Scenario('orders-list', 'get', lambda rng: get('/api/orders/', auth=token(rng))),
+        Scenario('orders-list-filtered', 'get', lambda rng: get('/api/orders/', {
+            'state': rng.choice([state for state, _ in Order.STATES]), 'created_from': '2017-01-01'}, token(rng))),
+        Scenario('order-detail', 'get', lambda rng: order_detail(rng)),
+        Scenario('reservation-create', 'post', lambda rng: get('/api/reservations/', {
+            'product': product(rng)[0], 'quantity': 1}, token(rng))),
+        Scenario('reservations', 'get', lambda rng: get('/api/reservations/', auth=token(rng))),
+        Scenario('profile', 'get', lambda rng: get('/api/profile/', auth=token(rng))),
+    ]
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted `values`."""
+    return values[max(int(round(percent / 100 * len(values))) - 1, 0)]
+
+
+class BenchmarkRunner(object):
+    """
+    Sends requests to the API in-process, through the whole middleware and URL stack, and measures latency and
+    queries of each. Runs in a transaction which is rolled back, so orders and reviews created by the run don't
+    change the data the next run measures. Throttling is switched off, the runner would hit the limits at once.
+    """
+
+    def __init__(self, requests=100, seed=0, cold=False, scenarios=None):
+        self.requests = requests
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.cold = cold
+        self.only = set(scenarios or ())
+
+    def run(self):
+        try:
+            setup_test_environment()
+            test_environment = True
+        except RuntimeError:
+            # Already set up, when running from the test suite.
+            test_environment = False
+        try:
+            with mock.patch.object(APIView, 'get_throttles', lambda view: []), transaction.atomic():
+                results = self.run_scenarios()
+                transaction.set_rollback(True)
+        finally:
+            if test_environment:
+                teardown_test_environment()
+        return OrderedDict([('meta', self.get_meta()), ('scenarios', results)])
+
+    def run_scenarios(self):
+        samples = Samples(self.rng)
+        if samples.staff is None:
+            samples.staff = User.objects.create_user('benchmark-staff', is_staff=True)
+        client = Client()
+        results = OrderedDict()
+        for scenario in get_scenarios(samples):
+            if self.only and scenario.name not in self.only:
+                continue
+            results[scenario.name] = self.run_scenario(client, scenario, samples)
+        return results
+
+    def run_scenario(self, client, scenario, samples):
+        latencies, queries, errors = [], [], 0
+        for _ in range(self.requests):
+            path, data, auth = scenario.make_request(self.rng)
+            headers = {}
+            if auth == 'staff':
+                client.force_login(samples.staff)
+            else:
+                client.logout()
+                if auth:
+                    headers['HTTP_AUTHORIZATION'] = 'Token ' + auth
+            if self.cold:
+                caches['default'].clear()
+            with CaptureQueriesContext(connection) as context:
+                start = perf_counter()
+                if scenario.method == 'post':
+                    response = client.post(path, json.dumps(data), content_type='application/json', **headers)
+                else:
+                    response = client.get(path, data, **headers)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                latencies.append((perf_counter() - start) * 1000)
+            queries.append(len(context.captured_queries))
+            errors += response.status_code >= 400
+        total = sum(latencies)
+        latencies.sort()
+        return OrderedDict([
+            ('requests', self.requests), ('errors', errors),
+            ('p50_ms', round(percentile(latencies, 50), 2)), ('p95_ms', round(percentile(latencies, 95), 2)),
+            ('p99_ms', round(percentile(latencies, 99), 2)), ('mean_ms', round(total / self.requests, 2)),
+            ('throughput_rps', round(self.requests / total * 1000, 1)),
+            ('queries_mean', round(sum(queries) / self.requests, 1)), ('queries_max', max(queries)),
+        ])
+
+    def get_meta(self):
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                             stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return OrderedDict([
+            ('commit', commit), ('products', Product.objects.count()), ('requests', self.requests),
+            ('seed', self.seed), ('cold_cache', self.cold), ('database', connection.vendor),
+            ('python', platform.python_version()), ('django', django.get_version()),
+        ])
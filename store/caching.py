@@ -0,0 +1,153 @@
+from hashlib import md5
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import urlencode
+
+from store.routers import is_catalog_recently_written, mark_catalog_written, reading_from_replica
+
+
+LIST_VERSION = 'list'
+CATALOG_VERSION = 'catalog'
+REVIEWS_VERSION = 'reviews'
+REVIEW_AUTHORS_VERSION = 'review-authors'
+
+
+def get_catalog_cache():
+    return caches[settings.CATALOG_CACHE]
+
+
+def version_key(name, pk=None):
+    if pk is None:
+        return 'catalog:version:{}'.format(name)
+    return 'catalog:version:{}:{}'.format(name, pk)
+
+
+def get_versions(keys):
+    """
+    Returns current values of the version `keys`. A missing version starts from the current timestamp instead of 0,
+    so a version evicted from the cache never comes back with a value an older entry was stored with.
+    """
+    cache = get_catalog_cache()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, int(time() * 1000000), None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def bump_versions(keys):
+    cache = get_catalog_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time() * 1000000), None)
+
+
+def invalidate(*keys):
+    """
+    Bumps the list version and the given `keys`. The bump is repeated after commit, so a request that read
+    the old rows while the transaction was open can't keep them cached under the new version.
+    """
+    keys = [version_key(LIST_VERSION)] + list(keys)
+    bump_versions(keys)
+    transaction.on_commit(lambda: committed(keys))
+
+
+def committed(keys):
+    bump_versions(keys)
+    if settings.DATABASE_REPLICAS:
+        mark_catalog_written()
+
+
+def get_cache_timeout():
+    """
+    A replica may not have the rows committed within the last DATABASE_REPLICA_PIN_SECONDS yet, data read from it
+    then is cached only that long, so stale rows don't stay cached under the new version.
+    """
+    if reading_from_replica() and is_catalog_recently_written():
+        return settings.DATABASE_REPLICA_PIN_SECONDS
+    return settings.CATALOG_CACHE_TIMEOUT
+
+
+def invalidate_products(product_ids):
+    invalidate(*[version_key('product', product_id) for product_id in product_ids])
+
+
+def invalidate_catalog():
+    """Invalidates every cached catalog response, for bulk changes which don't send model signals."""
+    invalidate(version_key(CATALOG_VERSION))
+
+
+def invalidate_reviews(product_id):
+    # Review lists aren't cached, only their validators follow these versions, so the list version stays.
+    keys = [version_key(REVIEWS_VERSION), version_key(REVIEWS_VERSION, product_id)]
+    bump_versions(keys)
+    transaction.on_commit(lambda: committed(keys))
+
+
+def invalidate_review_authors():
+    keys = [version_key(REVIEW_AUTHORS_VERSION)]
+    bump_versions(keys)
+    transaction.on_commit(lambda: committed(keys))
+
+
+def get_review_dependencies(product_ids=None):
+    """Version keys of review lists of `product_ids`, or of all reviews when None."""
+    if product_ids is None:
+        keys = [version_key(REVIEWS_VERSION)]
+    else:
+        keys = [version_key(REVIEWS_VERSION, product_id) for product_id in sorted(product_ids)]
+    return keys + [version_key(REVIEW_AUTHORS_VERSION)]
+
+
+def get_list_cache_key(request, allowed_params, prefix='catalog:list'):
+    params = sorted((key, sorted(request.query_params.getlist(key)))
+                    for key in request.query_params if key in allowed_params)
+    query = urlencode([(key, value) for key, values in params for value in values])
+    list_version = get_versions([version_key(LIST_VERSION)])[version_key(LIST_VERSION)]
+    digest = md5('{}?{}'.format(request.get_host(), query).encode('utf-8')).hexdigest()
+    return '{}:{}:{}'.format(prefix, list_version, digest)
+
+
+def get_cached_list(key):
+    return get_catalog_cache().get(key)
+
+
+def set_cached_list(key, data):
+    get_catalog_cache().set(key, data, get_cache_timeout())
+
+
+def get_product_dependencies(product):
+    keys = [version_key(CATALOG_VERSION), version_key('product', product.id), version_key('genre', product.genre_id),
+            version_key('medium', product.medium_type_id)]
+    if product.artist_id:
+        keys.append(version_key('artist', product.artist_id))
+    if product.label_id:
+        keys.append(version_key('label', product.label_id))
+    keys.extend(version_key('tag', tag.id) for tag in product.tags.all())
+    return keys
+
+
+def get_product_cache_key(request, slug):
+    return 'catalog:product:{}'.format(md5('{}/{}'.format(request.get_host(), slug).encode('utf-8')).hexdigest())
+
+
+def get_cached_product(key):
+    """Returns cached (versions, data) of a product, if none of the rows it was built from have changed since."""
+    cache = get_catalog_cache()
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    versions, data = entry
+    if cache.get_many(list(versions)) != versions:
+        return None
+    return entry
+
+
+def set_cached_product(key, versions, data):
+    get_catalog_cache().set(key, (versions, data), get_cache_timeout())
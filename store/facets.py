@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+from django.db.models import Case, Count, IntegerField, Sum, When
+
+from store.models import Product
+
+
+PRICE_BUCKETS = (0, 20, 50, 100, 200)
+MAX_TAGS = 50
+
+
+def get_facet_queryset(filterset_class, data, queryset, exclude=()):
+    """Products matching the filters, except the `exclude` ones, so a facet doesn't narrow down its own values."""
+    data = data.copy()
+    for param in exclude:
+        data.pop(param, None)
+    filtered = filterset_class(data, queryset=queryset).qs
+    return Product.objects.filter(id__in=filtered.order_by().values('id')).order_by()
+
+
+def count_values(queryset, fields, limit=None):
+    """Counts products per value, `fields` are (output name, lookup) pairs and the first one is the grouping key."""
+    names, lookups = zip(*fields)
+    counts = queryset.exclude(**{lookups[0] + '__isnull': True}).values_list(*lookups).annotate(count=Count('id'))\
+        .order_by('-count', lookups[0])[:limit]
+    return [OrderedDict(zip(names + ('count',), values)) for values in counts]
+
+
+def count_prices(queryset):
+    ranges = list(zip(PRICE_BUCKETS, PRICE_BUCKETS[1:] + (None,)))
+    counts = queryset.aggregate(**{
+        'bucket_{}'.format(i): Sum(Case(When(price__gte=low, then=1) if high is None else
+                                        When(price__gte=low, price__lt=high, then=1),
+                                        default=0, output_field=IntegerField()))
+        for i, (low, high) in enumerate(ranges)
+    })
+    return [OrderedDict([('min', low), ('max', high), ('count', counts['bucket_{}'.format(i)] or 0)])
+            for i, (low, high) in enumerate(ranges)]
+
+
+def get_facets(filterset_class, data, queryset):
+    """Counts of every facet value for the current filters, one grouped query per facet."""
+    return OrderedDict([
+        ('genre', count_values(get_facet_queryset(filterset_class, data, queryset, ('genre',)),
+                               (('slug', 'genre__slug'), ('name', 'genre__name')))),
+        ('medium_type', count_values(get_facet_queryset(filterset_class, data, queryset, ('medium_type',)),
+                                     (('name', 'medium_type__name'),))),
+        ('label', count_values(get_facet_queryset(filterset_class, data, queryset, ('label',)),
+                               (('slug', 'label__slug'), ('name', 'label__name')))),
+        ('tags', count_values(get_facet_queryset(filterset_class, data, queryset, ('tags',)),
+                              (('name', 'tags__name'),), limit=MAX_TAGS)),
+        ('price', count_prices(get_facet_queryset(filterset_class, data, queryset, ('min_price', 'max_price')))),
+    ])
@@ -0,0 +1,80 @@
+import csv
+import json
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from taggit.models import TaggedItem
+
+from store.models import Product
+
+
+FEED_FIELDS = OrderedDict([
+    ('slug', 'slug'), ('title', 'title'), ('artist', 'artist__name'), ('artist_slug', 'artist__slug'),
+    ('genre', 'genre__name'), ('genre_slug', 'genre__slug'), ('label', 'label__name'), ('label_slug', 'label__slug'),
+    ('medium_type', 'medium_type__name'), ('medium_count', 'medium_count'), ('release_date', 'release_date'),
+    ('price', 'price'), ('stock', 'stock'), ('length', 'length'), ('image', 'image'), ('description', 'description'),
+    ('updated', 'updated'),
+])
+CSV_FIELDS = list(FEED_FIELDS) + ['tags']
+
+
+def iter_products(since=None, chunk_size=1000, get_image_url=None):
+    """
+    Yields chunks of feed rows of all products, or of products changed since `since`, ordered by (updated, id).
+    Every chunk is one keyset query plus one query for its tags, so memory doesn't depend on the catalog size.
+    """
+    queryset = Product.objects.order_by('updated', 'id').values('id', *FEED_FIELDS.values())
+    if since is not None:
+        queryset = queryset.filter(updated__gte=since)
+    content_type = ContentType.objects.get_for_model(Product)
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(Q(updated__gt=last['updated']) | Q(updated=last['updated'], id__gt=last['id']))
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        last = chunk[-1]
+        tags = {}
+        for product_id, name in TaggedItem.objects.filter(content_type=content_type,
+                                                          object_id__in=[row['id'] for row in chunk])\
+                .order_by('tag__name').values_list('object_id', 'tag__name'):
+            tags.setdefault(product_id, []).append(name)
+        rows = []
+        for row in chunk:
+            feed_row = OrderedDict((name, row[lookup]) for name, lookup in FEED_FIELDS.items())
+            if feed_row['image'] and get_image_url is not None:
+                feed_row['image'] = get_image_url(feed_row['image'])
+            feed_row['tags'] = tags.get(row['id'], [])
+            rows.append(feed_row)
+        yield rows
+
+
+def render_ndjson(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n' for row in rows)
+
+
+class LineBuffer(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+def render_csv(chunks):
+    buffer = LineBuffer()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+    yield buffer.lines.pop()
+    for rows in chunks:
+        for row in rows:
+            row['tags'] = ','.join(row['tags'])
+            writer.writerow(row)
+        yield ''.join(buffer.lines)
+        buffer.lines = []
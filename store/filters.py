@@ -1,7 +1,11 @@
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
 from django_filters.rest_framework import FilterSet
-from django_filters import CharFilter, NumberFilter, OrderingFilter, Filter
+from django_filters import CharFilter, ChoiceFilter, DateFilter, NumberFilter, OrderingFilter, Filter
 
-from store.models import Product, Review
+from store.models import Order, Product, Review
+from store.search import search_products
 
 
 class TagsFilter(Filter):
@@ -13,19 +17,46 @@ class TagsFilter(Filter):
         return super(TagsFilter, self).filter(qs, [value])
 
 
+class SearchFilter(Filter):
+
+    def filter(self, qs, value):
+        if not value:
+            return qs
+        return search_products(qs, value)
+
+
+class DayFilter(DateFilter):
+    """
+    Filters a datetime field by a day in the current time zone, `gte` from its start and `lte` to its end.
+    Compares with datetimes instead of truncating the column, so an index on the field can be used.
+    """
+
+    def filter(self, qs, value):
+        if not value:
+            return qs
+        lookup = self.lookup_expr
+        if lookup == 'lte':
+            value, lookup = value + timedelta(days=1), 'lt'
+        start = timezone.make_aware(datetime.combine(value, time.min))
+        return qs.filter(**{'{}__{}'.format(self.name, lookup): start})
+
+
 class ProductFilterSet(FilterSet):
+    q = SearchFilter()
     genre = CharFilter(name='genre__slug')
     artist = CharFilter(name='artist__slug')
     medium_type = CharFilter(name='medium_type__name')
     min_price = NumberFilter(name='price', lookup_expr='gte')
     max_price = NumberFilter(name='price', lookup_expr='lte')
     label = CharFilter(name='label__slug')
-    ordering = OrderingFilter(fields=(('price', 'price'), ('-price', '-price')))
+    min_rating = NumberFilter(name='rating__average', lookup_expr='gte')
+    ordering = OrderingFilter(fields=(('price', 'price'), ('-price', '-price'), ('rating__average', 'rating')))
     tags = TagsFilter(name='tags__name')
 
     class Meta:
         model = Product
-        fields = ('genre', 'artist', 'medium_type', 'min_price', 'max_price', 'label', 'ordering', 'tags')
+        fields = ('q', 'genre', 'artist', 'medium_type', 'min_price', 'max_price', 'label', 'min_rating', 'ordering',
+                  'tags')
 
 
 class ReviewFilterSet(FilterSet):
@@ -34,3 +65,13 @@ class ReviewFilterSet(FilterSet):
     class Meta:
         model = Review
         fields = ('product', )
+
+
+class OrderFilterSet(FilterSet):
+    state = ChoiceFilter(choices=Order.STATES)
+    created_from = DayFilter(name='created', lookup_expr='gte')
+    created_to = DayFilter(name='created', lookup_expr='lte')
+
+    class Meta:
+        model = Order
+        fields = ('state', 'created_from', 'created_to')
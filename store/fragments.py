@@ -0,0 +1,80 @@
+import json
+from collections import OrderedDict
+from collections.abc import Mapping
+from hashlib import md5
+
+from django.conf import settings
+from django.utils.functional import cached_property
+from rest_framework.renderers import JSONRenderer
+
+from store.caching import get_catalog_cache
+
+
+FRAGMENT_FIELDS = ('id', 'updated')
+
+
+class PrerenderedJSON(Mapping):
+    """JSON rendered beforehand. It's decoded only when something reads it as data, e.g. the browsable API."""
+
+    def __init__(self, content):
+        self.content = content
+
+    @cached_property
+    def decoded(self):
+        return json.loads(self.content.decode('utf-8'), object_pairs_hook=OrderedDict)
+
+    def __getitem__(self, key):
+        return self.decoded[key]
+
+    def __iter__(self):
+        return iter(self.decoded)
+
+    def __len__(self):
+        return len(self.decoded)
+
+
+class PrerenderedJSONRenderer(JSONRenderer):
+    """JSONRenderer which sends PrerenderedJSON as it is."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, PrerenderedJSON):
+            return data.content
+        return super(PrerenderedJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+
+
+def get_fragment_key(base, product):
+    # `updated` changes with the product, its artist, genre, label, medium and tags, so an outdated fragment is
+    # never read again and there is nothing to invalidate.
+    return 'catalog:fragment:{}:{}:{:x}'.format(base, product.id, int(product.updated.timestamp() * 1000000))
+
+
+def get_fragment_keys(request, products):
+    # Image URLs are absolute, so fragments are kept apart for every scheme and host.
+    base = md5(request.build_absolute_uri('/').encode('utf-8')).hexdigest()[:12]
+    return OrderedDict((product.id, get_fragment_key(base, product)) for product in products)
+
+
+def get_product_fragments(request, products, load, serialize):
+    """
+    Returns the list representations of `products`, which need only `id` and `updated` loaded, as JSON bytes.
+    Missing fragments are made of the instances `load(ids)` returns, serialized by `serialize(instances)`.
+    """
+    keys = get_fragment_keys(request, products)
+    cache = get_catalog_cache()
+    fragments = cache.get_many(list(keys.values()))
+    missing = [product_id for product_id, key in keys.items() if key not in fragments]
+    if missing:
+        instances = list(load(missing))
+        renderer = JSONRenderer()
+        new = {keys[instance.id]: renderer.render(data) for instance, data in zip(instances, serialize(instances))}
+        cache.set_many(new, settings.CATALOG_FRAGMENT_CACHE_TIMEOUT)
+        fragments.update(new)
+    # A product deleted since the page was selected has no fragment.
+    return [fragments[key] for key in keys.values() if key in fragments]
+
+
+def render_page(envelope, fragments):
+    """Renders the pagination `envelope`, whose last item is empty `results`, with `fragments` as the results."""
+    content = JSONRenderer().render(envelope)
+    assert list(envelope)[-1] == 'results' and content.endswith(b'[]}')
+    return b''.join([content[:-3], b'[', b','.join(fragments), b']}'])
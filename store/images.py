@@ -0,0 +1,106 @@
+import os
+from base64 import b64decode
+from binascii import Error as Base64Error
+from collections import OrderedDict
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from PIL import Image
+
+
+# name: (max width, max height), renditions are generated from the largest to the smallest one.
+RENDITIONS = OrderedDict([
+    ('retina', (1200, 1200)),
+    ('detail', (600, 600)),
+    ('thumbnail', (200, 200)),
+])
+RENDITIONS_DIR = 'renditions'
+RENDITION_FORMAT = 'JPEG'
+RENDITION_QUALITY = 82
+UPLOAD_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+# Multiple of 4, so every chunk of base64 text decodes on its own.
+DECODE_CHUNK_SIZE = 64 * 1024
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def decode_base64_image(data):
+    """
+    Decodes a data URI or plain base64 image chunk by chunk into a temporary file, which stays in memory only while
+    it's small. Raises InvalidImage when the data isn't base64, isn't an image in one of UPLOAD_FORMATS or exceeds
+    IMAGE_UPLOAD_MAX_SIZE or IMAGE_UPLOAD_MAX_PIXELS. The dimensions are checked from the header only, before any
+    pixel is decoded.
+    """
+    if not isinstance(data, str):
+        raise InvalidImage('Niepoprawny format zdjęcia.')
+    start = data.find(',') + 1 if data.startswith('data:') else 0
+    if (len(data) - start) // 4 * 3 > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise InvalidImage('Zdjęcie jest za duże.')
+    stream = SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        for offset in range(start, len(data), DECODE_CHUNK_SIZE):
+            stream.write(b64decode(data[offset:offset + DECODE_CHUNK_SIZE], validate=True))
+        stream.seek(0)
+        image = Image.open(stream)
+    except (Base64Error, ValueError, IOError):
+        stream.close()
+        raise InvalidImage('Niepoprawny format zdjęcia.')
+    if image.format not in UPLOAD_FORMATS:
+        stream.close()
+        raise InvalidImage('Niepoprawny format zdjęcia.')
+    width, height = image.size
+    if width * height > settings.IMAGE_UPLOAD_MAX_PIXELS:
+        stream.close()
+        raise InvalidImage('Zdjęcie jest za duże.')
+    stream.seek(0)
+    return File(stream, name='{}.{}'.format(uuid4(), UPLOAD_FORMATS[image.format]))
+
+
+def get_rendition_name(image_name, rendition):
+    base = os.path.splitext(os.path.basename(image_name))[0]
+    return '{}/{}/{}.jpg'.format(RENDITIONS_DIR, rendition, base)
+
+
+def get_rendition_urls(image_name, storage=default_storage):
+    return OrderedDict((rendition, storage.url(get_rendition_name(image_name, rendition)))
+                       for rendition in reversed(RENDITIONS))
+
+
+def open_source(image_name, storage):
+    with storage.open(image_name) as source:
+        image = Image.open(source)
+        # For JPEGs lets the decoder scale down by up to 8x while reading, much cheaper than a full decode + resize.
+        image.draft('RGB', RENDITIONS[next(iter(RENDITIONS))])
+        image.load()
+    if image.mode != 'RGB':
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        else:
+            image = image.convert('RGB')
+    return image
+
+
+def generate_renditions(image_name, storage=default_storage):
+    """
+    Stores every rendition of the image under get_rendition_name. Each rendition is scaled down from the previous,
+    larger one instead of the original, so a big upload is resampled in full only once. Existing renditions are
+    replaced. Doesn't touch the database, so it can run in worker processes.
+    """
+    image = open_source(image_name, storage)
+    for rendition, size in RENDITIONS.items():
+        image.thumbnail(size, Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, RENDITION_FORMAT, quality=RENDITION_QUALITY, optimize=True, progressive=True)
+        name = get_rendition_name(image_name, rendition)
+        storage.delete(name)
+        storage.save(name, File(output))
+    return image_name
@@ -0,0 +1,317 @@
+import csv
+import json
+from collections import Counter, OrderedDict, defaultdict
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from itertools import islice
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.text import slugify
+from taggit.models import Tag, TaggedItem
+
+from store.models import Artist, Genre, RecordLabel, Medium, Product, ProductRating, SearchTerm
+from store.search import get_search_terms, get_texts, unaccent
+
+
+RELATED_FIELDS = ((Artist, 'artist'), (Genre, 'genre'), (RecordLabel, 'label'))
+PRODUCT_FIELDS = ('title', 'genre_id', 'artist_id', 'label_id', 'medium_type_id', 'medium_count', 'release_date',
+                  'price', 'length', 'stock', 'description')
+# Slugs made of artist, title and medium are shorter than the field, so a numeric suffix always fits.
+SLUG_BASE_LENGTH = 190
+# Rows of one UPDATE of changed products, each distinct new value of a field adds a WHEN.
+UPDATE_BATCH_SIZE = 100
+
+
+class RowError(Exception):
+    pass
+
+
+def read_csv(stream):
+    """Yields rows of a CSV file with a header, `tags` are separated with commas."""
+    return csv.DictReader(stream)
+
+
+def read_jsonl(stream):
+    """Yields objects of a file with one JSON object per line, `tags` is a list. Broken lines are yielded as None."""
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+@lru_cache(maxsize=10000)
+def make_slug(*parts, max_length=200):
+    # slugify drops letters without an ascii decomposition, unaccent maps ł and the rest of Polish letters first.
+    return slugify(unaccent(' '.join(part for part in parts if part)))[:max_length].strip('-')
+
+
+def parse_row(row):
+    """Validates a source row and returns the product fields, related names and tags of it."""
+    if not isinstance(row, dict):
+        raise RowError('Niepoprawny format wiersza.')
+    values = {key: value.strip() if isinstance(value, str) else value for key, value in row.items() if key}
+    for field in ('title', 'genre', 'medium', 'release_date', 'price'):
+        if values.get(field) in (None, ''):
+            raise RowError('Brak pola {}.'.format(field))
+    try:
+        price = Decimal(str(values['price']))
+        release_date = parse_date(str(values['release_date']))
+        stock = int(values.get('stock') or 0)
+        medium_count = int(values.get('medium_count') or 1)
+        length = int(values['length']) if values.get('length') not in (None, '') else None
+    except (InvalidOperation, ValueError):
+        raise RowError('Niepoprawna wartość liczbowa lub data.')
+    if release_date is None or stock < 0 or medium_count < 1 or not Decimal('0') <= price < Decimal('1000'):
+        raise RowError('Niepoprawna wartość liczbowa lub data.')
+    tags = values.get('tags') or []
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    tags = sorted({str(tag).strip()[:100] for tag in tags if str(tag).strip()})
+    related = {}
+    for field in ('artist', 'genre', 'label'):
+        name = values.get(field) or None
+        related[field] = (make_slug(name, max_length=192), name[:128]) if name else None
+        if name and not related[field][0]:
+            raise RowError('Nie można utworzyć sluga pola {}.'.format(field))
+    slug = make_slug(values.get('slug')) or None
+    base = slug or make_slug(values.get('artist'), values['title'], values['medium'], max_length=SLUG_BASE_LENGTH)
+    if not base:
+        raise RowError('Nie można utworzyć sluga.')
+    return {
+        # A product is the one with the slug given in the file, or the one with the same made up slug (suffixes
+        # aside) and release date.
+        'key': (slug,) if slug else (base, release_date),
+        'slug': slug, 'slug_base': base, 'title': values['title'][:200], 'artist': related['artist'],
+        'genre': related['genre'], 'label': related['label'], 'medium': values['medium'][:128], 'tags': tags,
+        'fields': {'price': price, 'release_date': release_date, 'stock': stock, 'medium_count': medium_count,
+                   'length': length, 'description': values.get('description') or None},
+    }
+
+
+class CatalogImporter(object):
+    """
+    Imports products in chunks, each in its own transaction. Artists, genres, labels, media and tags are resolved
+    with one query per chunk and kept in dictionaries, so memory grows with the number of distinct names, never with
+    the number of rows. A product is identified by the slug given in the file, or else by the slug made of artist,
+    title and medium together with the release date, so importing the same file again updates the products instead
+    of duplicating them. A different product which makes the same slug gets a numeric suffix.
+    """
+
+    def __init__(self, chunk_size=500, dry_run=False, max_errors=20):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.max_errors = max_errors
+        self.related = {Artist: {}, Genre: {}, RecordLabel: {}}
+        self.media = {}
+        self.tags = {}
+        self.content_type = ContentType.objects.get_for_model(Product)
+        self.rows = self.created = self.updated = 0
+        # The first `max_errors` errors, only counted after that.
+        self.errors = []
+        self.error_count = 0
+
+    def run(self, reader, progress=None):
+        while True:
+            chunk = list(islice(reader, self.chunk_size))
+            if not chunk:
+                break
+            products = OrderedDict()
+            for row in chunk:
+                self.rows += 1
+                try:
+                    product = parse_row(row)
+                except RowError as e:
+                    self.error_count += 1
+                    if len(self.errors) < self.max_errors:
+                        self.errors.append((self.rows, str(e)))
+                    continue
+                # A later row of the same product replaces the earlier one.
+                products.pop(product['key'], None)
+                products[product['key']] = product
+            if products:
+                self.import_chunk(list(products.values()))
+            if progress is not None:
+                progress(self)
+
+    def import_chunk(self, products):
+        # A dry run rolls every chunk back, so ids cached by it would point to rows which don't exist.
+        if self.dry_run:
+            cached = {model: dict(ids) for model, ids in self.related.items()}, dict(self.media), dict(self.tags)
+        with transaction.atomic():
+            self.resolve_related(products)
+            self.resolve_tags(products)
+            existing = self.find_existing(products)
+            new = [product for product in products if product['key'] not in existing]
+            changed = self.find_changed([(existing[product['key']], product) for product in products
+                                         if product['key'] in existing])
+            Product.objects.bulk_create([Product(slug=product['new_slug'], **self.get_fields(product))
+                                         for product in new], batch_size=self.chunk_size)
+            new_ids = dict(Product.objects.filter(slug__in=[product['new_slug'] for product in new])
+                           .values_list('slug', 'id'))
+            self.update_products(changed, timezone.now())
+            ProductRating.objects.bulk_create([ProductRating(product_id=product_id) for product_id in new_ids.values()],
+                                              batch_size=self.chunk_size)
+
+            # Tags and search terms of unchanged products stay as they are.
+            written = [(new_ids[product['new_slug']], product) for product in new]
+            written += [(product_id, product) for product_id, product, _ in changed]
+            changed_ids = [product_id for product_id, _, _ in changed]
+            TaggedItem.objects.filter(content_type=self.content_type, object_id__in=changed_ids).delete()
+            TaggedItem.objects.bulk_create([
+                TaggedItem(content_type=self.content_type, object_id=product_id, tag_id=self.tags[name])
+                for product_id, product in written for name in product['tags']
+            ], batch_size=self.chunk_size)
+            SearchTerm.objects.filter(product_id__in=changed_ids).delete()
+            SearchTerm.objects.bulk_create([
+                SearchTerm(product_id=product_id, term=term, weight=weight) for product_id, product in written
+                for term, weight in get_search_terms(get_texts(
+                    product['title'], product['genre'][1], product['fields']['description'],
+                    product['artist'] and product['artist'][1], product['label'] and product['label'][1],
+                    product['tags'])).items()
+            ], batch_size=self.chunk_size)
+            self.created += len(new)
+            self.updated += len(changed)
+            if self.dry_run:
+                transaction.set_rollback(True)
+        if self.dry_run:
+            self.related, self.media, self.tags = cached
+
+    def find_existing(self, products):
+        """
+        Returns ids of the products already in the catalog ({key: id}) and sets `new_slug` of the others to a slug
+        no product has. Suffixed slugs are only looked up for new products whose made up slug is already taken.
+        """
+        given = {product['slug'] for product in products if product['slug']}
+        made = [product for product in products if not product['slug']]
+        candidates = defaultdict(list)
+        for product_id, slug, release_date in Product.objects.filter(
+                slug__in=list(given) + [product['slug_base'] for product in made]
+        ).order_by('id').values_list('id', 'slug', 'release_date'):
+            candidates[slug].append((product_id, release_date))
+        taken = set(candidates) | given
+        existing = {}
+        self.match_existing(products, candidates, existing)
+        # Bases taken by another product, or made by several new products of the chunk, need suffixes.
+        counts = Counter(product['slug_base'] for product in made)
+        collided = {product['slug_base'] for product in made if product['key'] not in existing and (
+            product['slug_base'] in taken or counts[product['slug_base']] > 1)}
+        if collided:
+            condition = Q()
+            for base in collided:
+                # '.' comes right after '-', so the range holds every slug starting with `base-`.
+                condition |= Q(slug__gt=base + '-', slug__lt=base + '.')
+            for product_id, slug, release_date in Product.objects.filter(condition).order_by('id')\
+                    .values_list('id', 'slug', 'release_date'):
+                base, _, suffix = slug.rpartition('-')
+                if base in collided and suffix.isdigit():
+                    candidates[base].append((product_id, release_date))
+                    taken.add(slug)
+            self.match_existing([product for product in made if product['slug_base'] in collided], candidates,
+                                existing)
+
+        for product in products:
+            if product['key'] in existing:
+                continue
+            slug, suffix = product['slug_base'], 2
+            if not product['slug']:
+                while slug in taken:
+                    slug, suffix = '{}-{}'.format(product['slug_base'], suffix), suffix + 1
+            taken.add(slug)
+            product['new_slug'] = slug
+        return existing
+
+    def match_existing(self, products, candidates, existing):
+        for product in products:
+            if product['key'] in existing:
+                continue
+            if product['slug']:
+                matches = [product_id for product_id, _ in candidates.get(product['slug'], ())]
+            else:
+                base, release_date = product['key']
+                matches = [product_id for product_id, date in candidates.get(base, ()) if date == release_date]
+            if matches:
+                existing[product['key']] = matches[0]
+
+    def find_changed(self, matched):
+        """
+        Returns the matched products ([(id, product)]) whose fields or tags differ from the catalog, as
+        [(id, product, {field: new value})].
+        """
+        ids = [product_id for product_id, _ in matched]
+        current = {row[0]: row[1:] for row in Product.objects.filter(id__in=ids).values_list('id', *PRODUCT_FIELDS)}
+        tags = defaultdict(set)
+        for object_id, tag_id in TaggedItem.objects.filter(content_type=self.content_type, object_id__in=ids)\
+                .values_list('object_id', 'tag_id'):
+            tags[object_id].add(tag_id)
+        changed = []
+        for product_id, product in matched:
+            fields = self.get_fields(product)
+            values = {name: fields[name] for name, value in zip(PRODUCT_FIELDS, current[product_id])
+                      if fields[name] != value}
+            if values or tags[product_id] != {self.tags[name] for name in product['tags']}:
+                changed.append((product_id, product, values))
+        return changed
+
+    def update_products(self, changed, updated):
+        """Writes the changed fields of products ([(id, product, {field: value})]), one UPDATE per UPDATE_BATCH_SIZE."""
+        for start in range(0, len(changed), UPDATE_BATCH_SIZE):
+            batch = changed[start:start + UPDATE_BATCH_SIZE]
+            values = {}
+            for name in PRODUCT_FIELDS:
+                ids = defaultdict(list)
+                for product_id, _, fields in batch:
+                    if name in fields:
+                        ids[fields[name]].append(product_id)
+                if ids:
+                    field = Product._meta.get_field(name)
+                    values[name] = Case(*[When(id__in=product_ids, then=Value(value, output_field=field))
+                                          for value, product_ids in ids.items()], default=F(name), output_field=field)
+            Product.objects.filter(id__in=[product_id for product_id, _, _ in batch]).update(updated=updated, **values)
+
+    def get_fields(self, product):
+        fields = dict(product['fields'], title=product['title'], medium_type_id=self.media[product['medium']])
+        for model, key in RELATED_FIELDS:
+            fields[key + '_id'] = self.related[model][product[key][0]] if product[key] else None
+        return fields
+
+    def resolve_related(self, products):
+        for model, key in RELATED_FIELDS:
+            names = dict(product[key] for product in products if product[key])
+            self.resolve(model, 'slug', self.related[model], names, lambda slug, name: model(slug=slug, name=name))
+        names = {product['medium']: product['medium'] for product in products}
+        self.resolve(Medium, 'name', self.media, names, lambda name, _: Medium(name=name))
+
+    def resolve_tags(self, products):
+        names = {name: name for product in products for name in product['tags']}
+        missing = [name for name in names if name not in self.tags]
+        taken = set(Tag.objects.filter(slug__in=[make_slug(name, max_length=90) for name in missing])
+                    .exclude(name__in=missing).values_list('slug', flat=True))
+
+        def make_tag(name, _):
+            slug = base = make_slug(name, max_length=90) or 'tag'
+            i = 1
+            while slug in taken:
+                slug = '{}-{}'.format(base, i)
+                i += 1
+            taken.add(slug)
+            return Tag(name=name, slug=slug)
+
+        self.resolve(Tag, 'name', self.tags, names, make_tag)
+
+    def resolve(self, model, key, ids, names, make):
+        """Fills `ids` ({key: id}) for `names` ({key: name}), creating missing rows with one bulk insert."""
+        missing = [value for value in names if value not in ids]
+        if not missing:
+            return
+        ids.update(model.objects.filter(**{key + '__in': missing}).values_list(key, 'id'))
+        new = [make(value, names[value]) for value in missing if value not in ids]
+        if new:
+            model.objects.bulk_create(new)
+            ids.update(model.objects.filter(**{key + '__in': [getattr(obj, key) for obj in new]})
+                       .values_list(key, 'id'))
@@ -0,0 +1,42 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import F, Sum
+
+from store.models import Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = 'Zapisuje ceny zamówień złożonych przed wprowadzeniem zapisanych cen.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help='Przelicza ceny wszystkich zamówień, nie tylko tych bez zapisanej ceny.')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.select_related('shipping').order_by('id')
+        if not options['all']:
+            orders = orders.filter(total_price__isnull=True)
+        batch_size = options['batch_size']
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(orders.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            items_prices = dict(
+                OrderItem.objects.filter(order__in=batch).values('order').order_by()
+                .annotate(items_price=Sum(F('quantity') * F('product__price'), output_field=models.DecimalField()))
+                .values_list('order', 'items_price')
+            )
+            with transaction.atomic():
+                for order in batch:
+                    order.set_prices(Decimal(items_prices.get(order.id) or 0))
+                    Order.objects.filter(id=order.id).update(items_price=order.items_price,
+                                                             shipping_price=order.shipping_price,
+                                                             total_price=order.total_price)
+            updated += len(batch)
+            last_id = batch[-1].id
+        self.stdout.write('Zaktualizowano zamówień: {}'.format(updated))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, transaction
+
+from store.benchmark.concurrency import run_in_threads
+from store.models import InsufficientStock, Product
+
+
+class Command(BaseCommand):
+    help = ('Porównuje przepustowość równoległych zakupów tych samych produktów przez decrement_stock i przez '
+            'zapis produktów metodą save(). Stan magazynowy produktów jest przywracany po pomiarze.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--checkouts', type=int, default=10, help='Liczba zakupów na wątek.')
+        parser.add_argument('--products', type=int, default=3, help='Liczba produktów w każdym zakupie.')
+        parser.add_argument('--stock', type=int, default=50)
+
+    def handle(self, *args, **options):
+        ids = list(Product.objects.order_by('id').values_list('id', flat=True)[:options['products']])
+        if not ids or len(ids) < options['products']:
+            raise CommandError('Za mało produktów, uruchom najpierw seed_benchmark_data.')
+        stock = dict(Product.objects.filter(id__in=ids).values_list('id', 'stock'))
+        checkouts = (
+            ('decrement_stock', lambda: Product.objects.decrement_stock({product_id: 1 for product_id in ids})),
+            ('save()', lambda: self.legacy_checkout(ids)),
+        )
+        try:
+            for name, checkout in checkouts:
+                Product.objects.filter(id__in=ids).update(stock=options['stock'])
+                self.measure(name, checkout, ids, options)
+        finally:
+            for product_id, value in stock.items():
+                Product.objects.filter(id=product_id).update(stock=value)
+
+    def measure(self, name, checkout, ids, options):
+        failed = []
+
+        def worker():
+            for _ in range(options['checkouts']):
+                try:
+                    with transaction.atomic():
+                        checkout()
+                except (InsufficientStock, DatabaseError):
+                    failed.append(1)
+
+        elapsed = run_in_threads(worker, [()] * options['threads'])
+        attempts = options['threads'] * options['checkouts']
+        sold = attempts - len(failed)
+        # Every sold piece has to be missing from the stock, anything else is a lost update or an oversold piece.
+        expected = options['stock'] - sold
+        wrong = sorted(stock for stock in Product.objects.filter(id__in=ids).values_list('stock', flat=True)
+                       if stock != expected)
+        self.stdout.write('{:16} {:8.0f} zakupów/s, sprzedano {}/{}, niezgodne stany: {}'.format(
+            name, attempts / elapsed, sold, attempts, wrong or 'brak'))
+
+    def legacy_checkout(self, ids):
+        for product in Product.objects.filter(id__in=ids):
+            product.stock -= 1
+            product.save()
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from time import process_time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from store.caching import get_catalog_cache
+from store.fragments import get_fragment_keys, get_product_fragments, render_page
+from store.serializers import ProductsListSerializer
+from store.views import ProductListView
+
+
+class Command(BaseCommand):
+    help = 'Porównuje czas procesora budowania strony listy produktów przez serializer i z fragmentów JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=500)
+        parser.add_argument('--page-size', type=int, default=16)
+
+    def handle(self, *args, **options):
+        pages, page_size = options['pages'], options['page_size']
+        # Products are loaded once, only serialization and rendering are measured.
+        products = list(ProductListView.queryset.order_by('-created')[:page_size])
+        if len(products) < page_size:
+            raise CommandError('Za mało produktów, uruchom najpierw seed_benchmark_data.')
+        request = APIRequestFactory().get('/api/products/')
+        # Image URLs are built for the host of the request factory.
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            self.compare(request, products, pages, page_size)
+
+    def compare(self, request, products, pages, page_size):
+        envelope = OrderedDict([('count', 1000), ('next', 'http://testserver/api/products/?page=2'),
+                                ('previous', None), ('results', [])])
+
+        def serialize(instances):
+            return ProductsListSerializer(instances, many=True, context={'request': request}).data
+
+        def render_fragments():
+            return render_page(envelope, get_product_fragments(request, products, lambda ids: products, serialize))
+
+        def render_serializer():
+            return JSONRenderer().render(OrderedDict(envelope, results=serialize(products)))
+
+        def render_cold_fragments():
+            cache.delete_many(keys)
+            return render_fragments()
+
+        cache = get_catalog_cache()
+        keys = list(get_fragment_keys(request, products).values())
+        if render_fragments() != render_serializer():
+            raise CommandError('Strona z fragmentów różni się od strony z serializera.')
+        for name, render in (('serializer', render_serializer), ('fragmenty (w cache)', render_fragments),
+                             ('fragmenty (bez cache)', render_cold_fragments)):
+            start = process_time()
+            for _ in range(pages):
+                render()
+            elapsed = process_time() - start
+            self.stdout.write('{:24} {:8.0f} us CPU/stronę {} produktów'.format(name, elapsed / pages * 1000000,
+                                                                                 page_size))
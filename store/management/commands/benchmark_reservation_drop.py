@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from store.benchmark.data import USERNAME_PREFIX
+from store.benchmark.drop import ReservationDrop
+from store.benchmark.runner import percentile
+from store.models import Order, Payment, Product, Reservation, Shipping, UserProfile
+
+
+class Command(BaseCommand):
+    help = ('Symuluje limitowaną premierę: kupujący jednocześnie rezerwują i kupują sztuki jednego produktu. '
+            'Zamówienia i rezerwacje z pomiaru są usuwane, a stan magazynowy produktu przywracany.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--buyers', type=int, default=5, help='Liczba kupujących na wątek.')
+        parser.add_argument('--stock', type=int, default=20)
+
+    def handle(self, *args, **options):
+        count = options['threads'] * options['buyers']
+        buyers = list(UserProfile.objects.filter(user__username__startswith=USERNAME_PREFIX).order_by('id')[:count])
+        product = Product.objects.order_by('id').first()
+        shipping = Shipping.objects.values_list('slug', flat=True).first()
+        payment = Payment.objects.values_list('slug', flat=True).first()
+        if len(buyers) < count or None in (product, shipping, payment):
+            raise CommandError('Za mało danych, uruchom najpierw seed_benchmark_data.')
+        groups = [buyers[start:start + options['buyers']] for start in range(0, count, options['buyers'])]
+        last_order = Order.objects.aggregate(last=Max('id'))['last'] or 0
+        Product.objects.filter(id=product.id).update(stock=options['stock'])
+        try:
+            results = ReservationDrop(product, groups, shipping, payment).run()
+        finally:
+            Order.objects.filter(id__gt=last_order, user__in=buyers).delete()
+            Reservation.objects.filter(product=product, user__in=buyers).delete()
+            Product.objects.filter(id=product.id).update(stock=product.stock)
+
+        latencies = sorted(latency * 1000 for latency in results['bought'] + results['sold_out'])
+        checkout = sorted(latency * 1000 for latency in results['checkout'])
+        self.stdout.write('Kupiono {}/{} ({:.0%}), wyprzedane: {}, nieudane zakupy: {}, błędy: {}'.format(
+            len(results['bought']), count, len(results['bought']) / count, len(results['sold_out']),
+            len(results['failed_checkout']), len(results['errors'])))
+        for name, values in (('rezerwacja i zakup', latencies), ('zakup', checkout)):
+            if values:
+                self.stdout.write('{}: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+                    name, percentile(values, 50), percentile(values, 95), percentile(values, 99)))
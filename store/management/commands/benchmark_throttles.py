@@ -0,0 +1,42 @@
+import pickle
+from time import perf_counter
+from types import SimpleNamespace
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from rest_framework.throttling import UserRateThrottle
+
+from store.throttles import SlidingWindowUserRateThrottle
+
+
+class Command(BaseCommand):
+    help = 'Porównuje czas sprawdzenia i rozmiar stanu w cache throttle DRF i throttle z przesuwanym oknem.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        checks = options['checks']
+        request = SimpleNamespace(method='GET', user=SimpleNamespace(pk=1, is_authenticated=True), META={})
+        for throttle_class in (UserRateThrottle, SlidingWindowUserRateThrottle):
+            # The rate is above the number of checks, so every request is let through and recorded.
+            throttle_class = type(throttle_class.__name__, (throttle_class,), {'rate': '{}/h'.format(checks * 2),
+                                                                                'scope': 'benchmark'})
+            throttle = throttle_class()
+            cache.delete_many(self.get_keys(throttle, request))
+            start = perf_counter()
+            for _ in range(checks):
+                throttle.allow_request(request, None)
+            elapsed = perf_counter() - start
+            state = cache.get_many(self.get_keys(throttle, request))
+            self.stdout.write('{:32} {:8.1f} us/sprawdzenie, {:8} B w cache'.format(
+                throttle_class.__name__, elapsed / checks * 1000000,
+                sum(len(pickle.dumps(value)) for value in state.values())))
+            cache.delete_many(list(state))
+
+    def get_keys(self, throttle, request):
+        key = throttle.get_cache_key(request, None)
+        if not isinstance(throttle, SlidingWindowUserRateThrottle):
+            return [key]
+        window = throttle.timer() // throttle.duration
+        return ['{}:{:.0f}'.format(key, window + offset) for offset in (-1, 0, 1)]
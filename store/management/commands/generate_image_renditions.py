@@ -0,0 +1,49 @@
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from store.caching import invalidate_catalog
+from store.images import generate_renditions
+from store.models import Product
+
+
+def reset_connections():
+    # Forked workers inherit the parent's database connections. They are dropped without being closed, closing
+    # them would end the parent's session, possibly in the middle of its transaction.
+    for connection in connections.all():
+        connection.connection = None
+
+
+def render(image_name):
+    try:
+        return generate_renditions(image_name), None
+    except (IOError, OSError) as e:
+        return image_name, repr(e)
+
+
+class Command(BaseCommand):
+    help = 'Generuje miniatury okładek produktów, które ich jeszcze nie mają.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None, help='Domyślnie liczba procesorów.')
+        parser.add_argument('--all', action='store_true', help='Generuje od nowa również istniejące miniatury.')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['all']:
+            products = products.exclude(renditions_source=F('image'))
+        image_names = sorted(set(products.values_list('image', flat=True)))
+        done = failed = 0
+        with Pool(options['processes'], initializer=reset_connections) as pool:
+            for image_name, error in pool.imap_unordered(render, image_names):
+                if error:
+                    failed += 1
+                    self.stderr.write('{}: {}'.format(image_name, error))
+                    continue
+                Product.objects.filter(image=image_name).update(renditions_source=image_name, updated=timezone.now())
+                done += 1
+        invalidate_catalog()
+        self.stdout.write('Wygenerowano miniatury: {}, błędy: {}'.format(done, failed))
@@ -0,0 +1,48 @@
+import os
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.caching import invalidate_catalog
+from store.importing import CatalogImporter, read_csv, read_jsonl
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+MAX_REPORTED_ERRORS = 20
+
+
+class Command(BaseCommand):
+    help = 'Importuje produkty z pliku CSV lub JSONL, tworząc brakujących artystów, gatunki, wytwórnie i nośniki.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=sorted(READERS), help='Domyślnie według rozszerzenia pliku.')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Sprawdza plik bez zapisywania zmian.')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if file_format == 'ndjson':
+            file_format = 'jsonl'
+        if file_format not in READERS:
+            raise CommandError('Nieznany format pliku, użyj --format.')
+        importer = CatalogImporter(options['chunk_size'], options['dry_run'], MAX_REPORTED_ERRORS)
+        start = time()
+
+        def progress(importer):
+            self.stdout.write('Wiersze: {}, {:.0f} wierszy/s'.format(
+                importer.rows, importer.rows / max(time() - start, 0.001)), ending='\r')
+            self.stdout.flush()
+
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+                importer.run(READERS[file_format](stream), progress)
+        finally:
+            if not options['dry_run'] and importer.created + importer.updated:
+                invalidate_catalog()
+        self.stdout.write('')
+        for line, error in importer.errors:
+            self.stderr.write('Wiersz {}: {}'.format(line, error))
+        self.stdout.write('{}Utworzono: {}, zaktualizowano: {}, błędy: {}, {:.1f} s'.format(
+            'Bez zapisu. ' if options['dry_run'] else '', importer.created, importer.updated, importer.error_count,
+            time() - start))
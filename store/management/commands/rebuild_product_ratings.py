@@ -0,0 +1,40 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from store.caching import invalidate_catalog
+from store.models import Product, ProductRating, Review
+
+
+class Command(BaseCommand):
+    help = 'Przelicza od nowa oceny wszystkich produktów na podstawie komentarzy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        distributions = defaultdict(dict)
+        counts = Review.objects.filter(is_active=True, parent__isnull=True, rate__isnull=False)\
+            .values_list('product', 'rate').annotate(count=Count('id')).order_by()
+        for product_id, rate, count in counts:
+            distributions[product_id][rate] = count
+
+        batch_size = options['batch_size']
+        product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+        with transaction.atomic():
+            ProductRating.objects.all().delete()
+            for start in range(0, len(product_ids), batch_size):
+                ratings = []
+                for product_id in product_ids[start:start + batch_size]:
+                    rating = ProductRating(product_id=product_id)
+                    for rate, count in distributions[product_id].items():
+                        setattr(rating, 'rate_{}'.format(rate), count)
+                        rating.count += count
+                        rating.total += rate * count
+                    rating.set_average()
+                    ratings.append(rating)
+                ProductRating.objects.bulk_create(ratings)
+        invalidate_catalog()
+        self.stdout.write('Przeliczono oceny produktów: {}'.format(len(product_ids)))
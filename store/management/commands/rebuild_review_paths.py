@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.models import Review
+
+
+class Command(BaseCommand):
+    help = 'Wylicza ścieżki wątków komentarzy dodanych przed ich wprowadzeniem.'
+
+    def handle(self, *args, **options):
+        paths = {}
+        updated = 0
+        with transaction.atomic():
+            # Parents are always older than their replies, so walking by id visits them first.
+            for review in Review.objects.only('id', 'parent_id').order_by('id').iterator():
+                path, depth = Review.make_path(paths[review.parent_id] if review.parent_id else '', review.id)
+                paths[review.id] = path
+                updated += Review.objects.filter(id=review.id).exclude(path=path).update(path=path, depth=depth)
+        self.stdout.write('Zaktualizowano komentarzy: {}'.format(updated))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.search import INDEX_BATCH_SIZE, reindex_in_batches
+
+
+class Command(BaseCommand):
+    help = 'Buduje od nowa indeks wyszukiwania produktów.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=INDEX_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        indexed = reindex_in_batches(Product.objects.all(), options['batch_size'])
+        self.stdout.write('Zaindeksowano produktów: {}'.format(indexed))
@@ -0,0 +1,36 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from store.models import Reservation
+
+
+def release_expired_reservations(batch_size):
+    """Puts one batch of expired reservations back in stock, returns how many were released."""
+    ids = list(Reservation.objects.expired().order_by('id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return 0
+    # Expiry is checked again under the lock, a reservation extended in the meantime stays.
+    return len(Reservation.objects.expired().filter(id__in=ids).release())
+
+
+class Command(BaseCommand):
+    help = 'Zwalnia wygasłe rezerwacje i przywraca zarezerwowane sztuki do stanu magazynowego.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true',
+                            help='Działa bez końca, sprawdzając rezerwacje co --interval.')
+        parser.add_argument('--interval', type=float, default=10)
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired_reservations(options['batch_size'])
+            if released:
+                self.stdout.write('Zwolniono rezerwacji: {}'.format(released))
+            if not options['loop']:
+                # Without --loop everything expired is released, one batch and one transaction at a time.
+                if not released:
+                    break
+            elif released < options['batch_size']:
+                sleep(options['interval'])
@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.benchmark.runner import BenchmarkRunner
+
+
+class Command(BaseCommand):
+    help = 'Mierzy opóźnienia, przepustowość i liczbę zapytań endpointów API, wynik w formacie JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100, help='Liczba żądań na scenariusz.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--cold', action='store_true', help='Czyści cache przed każdym żądaniem.')
+        parser.add_argument('--scenario', action='append', help='Uruchamia tylko podane scenariusze.')
+        parser.add_argument('--output', help='Zapisuje wynik do pliku zamiast na standardowe wyjście.')
+
+    def handle(self, *args, **options):
+        runner = BenchmarkRunner(options['requests'], options['seed'], options['cold'], options['scenario'])
+        try:
+            results = runner.run()
+        except ValueError as e:
+            raise CommandError(str(e))
+        report = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,28 @@
+from time import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from store.benchmark.data import DataGenerator, SIZES, USERNAME_PREFIX
+
+
+class Command(BaseCommand):
+    help = 'Wypełnia bazę syntetycznymi produktami, użytkownikami, komentarzami i zamówieniami do benchmarków.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', default='1k', help='Liczba produktów albo jeden z rozmiarów: {}.'.format(
+            ', '.join(sorted(SIZES))))
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        size = options['products'].lower()
+        if size not in SIZES and not size.isdigit():
+            raise CommandError('Niepoprawna liczba produktów.')
+        if User.objects.filter(username__startswith=USERNAME_PREFIX).exists():
+            raise CommandError('Baza zawiera już dane benchmarku, użyj pustej bazy.')
+        start = time()
+        generator = DataGenerator(SIZES.get(size) or int(size), options['seed'], options['chunk_size'],
+                                  lambda message: self.stdout.write(message))
+        generator.generate()
+        self.stdout.write('Gotowe w {:.1f} s'.format(time() - start))
@@ -0,0 +1,28 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from store.outbox import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = 'Wysyła wiadomości czekające w kolejce.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--max-attempts', type=int, default=10)
+        parser.add_argument('--loop', action='store_true',
+                            help='Działa bez końca, sprawdzając kolejkę co --interval.')
+        parser.add_argument('--interval', type=float, default=5)
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_queued_emails(options['batch_size'], options['max_attempts'])
+            if sent or failed:
+                self.stdout.write('Wysłano: {}, błędy: {}'.format(sent, failed))
+            if not options['loop']:
+                break
+            # A full batch means more emails are probably due, so only wait when the queue has been drained or
+            # nothing could be sent, e.g. when the SMTP server is down.
+            if sent + failed < options['batch_size'] or not sent:
+                sleep(options['interval'])
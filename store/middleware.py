@@ -0,0 +1,184 @@
+import json
+import logging
+import random
+import re
+from collections import Counter
+from itertools import islice
+from threading import local
+from time import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.serializers import BaseSerializer
+
+from store.routers import has_written, pin_user, start_request
+
+
+logger = logging.getLogger('store.instrumentation')
+
+# Instrumentation state of the request handled by the current thread, for the serializer timing.
+current = local()
+
+LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LIST_REGEX = re.compile(r'IN \((?:\?, )*\?\)')
+
+
+def normalize_sql(sql):
+    """Replaces literals with placeholders, so the same statement run for different rows is counted together."""
+    return IN_LIST_REGEX.sub('IN (...)', LITERAL_REGEX.sub('?', sql))
+
+
+def get_query_time(since):
+    """Seconds spent in queries logged after `since` ({alias: length of the query log})."""
+    return sum(float(query['time']) for connection in connections.all()
+               for query in islice(connection.queries_log, since.get(connection.alias, 0), None))
+
+
+def time_serializer_data(data):
+    """
+    Wraps the BaseSerializer.data property, adding the time serializers take, without their queries, to the
+    instrumented request. Nested serializers count as part of the outermost one.
+    """
+    def get_data(serializer):
+        state = getattr(current, 'state', None)
+        if state is None or state['serializing']:
+            return data.fget(serializer)
+        state['serializing'] = True
+        start = time()
+        queries = {connection.alias: len(connection.queries_log) for connection in connections.all()}
+        try:
+            return data.fget(serializer)
+        finally:
+            state['serializer'] += time() - start - get_query_time(queries)
+            state['serializing'] = False
+
+    get_data.instrumented = True
+    return property(get_data, doc=data.__doc__)
+
+
+class RequestInstrumentationMiddleware(object):
+    """
+    Records SQL query count, database time, serializer time, view time and render time of every request and
+    reports them through the Server-Timing header and a log line. It is the first middleware, so the view time
+    includes the rest of the chain. A streamed response is reported in the log line only, once its body has been
+    consumed, so the queries run meanwhile are counted too. Slow requests are sampled into a warning with the most
+    repeated SQL statements. Enabled by REQUEST_INSTRUMENTATION, otherwise the middleware removes itself from the chain.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_ms = settings.REQUEST_INSTRUMENTATION_SLOW_MS
+        self.sample_rate = settings.REQUEST_INSTRUMENTATION_SAMPLE_RATE
+        if not getattr(BaseSerializer.data.fget, 'instrumented', False):
+            BaseSerializer.data = time_serializer_data(BaseSerializer.data)
+
+    def __call__(self, request):
+        debug_cursors = {}
+        queries_start = {}
+        for connection in connections.all():
+            debug_cursors[connection.alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            queries_start[connection.alias] = len(connection.queries_log)
+        request._instrumentation = current.state = {'start': time(), 'view_name': None, 'view_end': None,
+                                                     'render_end': None, 'serializer': 0, 'serializing': False}
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self.collect_queries(debug_cursors, queries_start)
+            raise
+        finally:
+            current.state = None
+        if response.streaming:
+            # The body of a streamed response, with its queries, is produced only while it's consumed.
+            response.streaming_content = self.stream(request, response, response.streaming_content, debug_cursors,
+                                                     queries_start)
+        else:
+            self.report(request, response, self.collect_queries(debug_cursors, queries_start))
+        return response
+
+    def stream(self, request, response, content, debug_cursors, queries_start):
+        current.state = request._instrumentation
+        try:
+            yield from content
+        finally:
+            current.state = None
+            self.report(request, response, self.collect_queries(debug_cursors, queries_start))
+
+    def collect_queries(self, debug_cursors, queries_start):
+        """Restores debug cursors and returns the queries logged since `queries_start` by alias."""
+        queries = {}
+        for connection in connections.all():
+            if connection.alias in debug_cursors:
+                connection.force_debug_cursor = debug_cursors[connection.alias]
+                queries[connection.alias] = list(connection.queries_log)[queries_start[connection.alias]:]
+        return queries
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'view_class', view_func)
+        request._instrumentation['view_name'] = '{}.{}'.format(view.__module__, view.__name__)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after this hook, the callback marks the end of rendering.
+        state = request._instrumentation
+        state['view_end'] = time()
+        response.add_post_render_callback(lambda response: state.update(render_end=time()))
+        return response
+
+    def report(self, request, response, queries_by_alias):
+        end = time()
+        queries = [query for alias_queries in queries_by_alias.values() for query in alias_queries]
+        state = request._instrumentation
+        db_ms = sum(float(query['time']) for query in queries) * 1000
+        total_ms = (end - state['start']) * 1000
+        view_end = state['view_end'] or end
+        render_ms = ((state['render_end'] or end) - view_end) * 1000
+        serializer_ms = state['serializer'] * 1000
+        view_ms = max((view_end - state['start']) * 1000 - db_ms - serializer_ms, 0)
+
+        # Headers of a streamed response are already sent when it's reported.
+        if not response.streaming:
+            response['Server-Timing'] = ', '.join([
+                'db;dur={:.1f};desc="{} queries"'.format(db_ms, len(queries)),
+                'serializer;dur={:.1f}'.format(serializer_ms),
+                'view;dur={:.1f}'.format(view_ms),
+                'render;dur={:.1f}'.format(render_ms),
+                'total;dur={:.1f}'.format(total_ms),
+            ])
+        record = {
+            'method': request.method, 'path': request.path, 'view': state['view_name'],
+            'status': response.status_code, 'queries': len(queries), 'db_ms': round(db_ms, 1),
+            'queries_by_alias': {alias: len(alias_queries) for alias, alias_queries in queries_by_alias.items()
+                                 if alias_queries},
+            'serializer_ms': round(serializer_ms, 1), 'view_ms': round(view_ms, 1), 'render_ms': round(render_ms, 1),
+            'total_ms': round(total_ms, 1),
+        }
+        logger.info(json.dumps(record))
+        if total_ms >= self.slow_ms and random.random() < self.sample_rate:
+            statements = Counter(normalize_sql(query['sql']) for query in queries)
+            record['repeated_sql'] = [{'sql': sql, 'count': count}
+                                      for sql, count in statements.most_common(5) if count > 1]
+            logger.warning(json.dumps(record))
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Keeps reads of a user who has just written to the primary on the primary for DATABASE_REPLICA_PIN_SECONDS,
+    see store.routers. Removes itself from the chain when there are no DATABASE_REPLICAS.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'DATABASE_REPLICAS', None):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start_request()
+        response = self.get_response(request)
+        # REST framework sets the user it authenticated on the Django request as well.
+        user = getattr(request, 'user', None)
+        if has_written() and user is not None and user.is_authenticated:
+            pin_user(user)
+        return response
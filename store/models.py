@@ -1,12 +1,16 @@
+from collections import OrderedDict
+from datetime import timedelta
 from decimal import Decimal
 from uuid import uuid4
 
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
-from django.db.models import F
-from django.db.models import Sum
+from django.utils import timezone
+from django.db.models import Case, F, Q, Sum, When
 
 from taggit.managers import TaggableManager
+from store.caching import invalidate_products
 from store.validators import validate_zip_code
 
 
@@ -81,6 +85,50 @@ class Medium(models.Model):
         return self.name
 
 
+class InsufficientStock(Exception):
+
+    def __init__(self, product_ids):
+        super(InsufficientStock, self).__init__(product_ids)
+        self.product_ids = product_ids
+
+
+class ProductQuerySet(models.QuerySet):
+
+    def decrement_stock(self, quantities):
+        """
+        Takes `quantities` ({product id: quantity}) off the stock with one conditional UPDATE. Rows are locked in id
+        order first, so concurrent checkouts can't deadlock. Raises InsufficientStock, leaving the stock untouched,
+        when any of the products doesn't have enough pieces.
+        """
+        with transaction.atomic():
+            stock = dict(self.select_for_update().filter(id__in=quantities).order_by('id').values_list('id', 'stock'))
+            missing = [product_id for product_id in sorted(quantities)
+                       if stock.get(product_id, 0) < quantities[product_id]]
+            if missing:
+                raise InsufficientStock(missing)
+            condition = Q()
+            for product_id, quantity in quantities.items():
+                condition |= Q(id=product_id, stock__gte=quantity)
+            updated = self.filter(condition).update(updated=timezone.now(), stock=Case(
+                *[When(id=product_id, then=F('stock') - quantity) for product_id, quantity in quantities.items()],
+                default=F('stock'), output_field=models.PositiveIntegerField()
+            ))
+            if updated != len(quantities):
+                # Only possible on backends without row locks, leaving the savepoint takes the partial update back.
+                raise InsufficientStock(sorted(quantities))
+        invalidate_products(quantities)
+
+    def increment_stock(self, quantities):
+        """Puts `quantities` ({product id: quantity}) back in stock with one UPDATE, rows locked like above."""
+        with transaction.atomic():
+            list(self.select_for_update().filter(id__in=quantities).order_by('id').values_list('id', flat=True))
+            self.filter(id__in=quantities).update(updated=timezone.now(), stock=Case(
+                *[When(id=product_id, then=F('stock') + quantity) for product_id, quantity in quantities.items()],
+                default=F('stock'), output_field=models.PositiveIntegerField()
+            ))
+        invalidate_products(quantities)
+
+
 class Product(models.Model):
     genre = models.ForeignKey(Genre, verbose_name='Gatunek', related_name='products')
     artist = models.ForeignKey(Artist, verbose_name='Artysta', related_name='products', blank=True, null=True)
@@ -90,6 +138,8 @@ class Product(models.Model):
     medium_count = models.PositiveSmallIntegerField(verbose_name='Liczba nośników', default=1)
     release_date = models.DateField(verbose_name='Data wydania')
     image = models.ImageField(verbose_name='Okładka', upload_to='images', max_length=255, blank=True, null=True)
+    # Name of the image the current renditions were generated from, see store.images.
+    renditions_source = models.CharField(verbose_name='Źródło miniatur', max_length=255, blank=True, editable=False)
     description = models.TextField(verbose_name='Opis', max_length=1024, blank=True, null=True)
     price = models.DecimalField(verbose_name='Cena', max_digits=5, decimal_places=2)
     length = models.PositiveSmallIntegerField('Czas trwania', blank=True, null=True)
@@ -97,10 +147,14 @@ class Product(models.Model):
     tags = TaggableManager(verbose_name='Tagi', blank=True)
     stock = models.PositiveIntegerField(verbose_name='Dostępność')
     created = models.DateTimeField(auto_now_add=True, verbose_name='Data dodania')
+    # Queryset updates have to set it themselves, the catalog feed's incremental mode relies on it.
+    updated = models.DateTimeField(auto_now=True, verbose_name='Data modyfikacji')
+
+    objects = ProductQuerySet.as_manager()
 
     class Meta:
         ordering = ('-created',)
-        index_together = (('id', 'slug'),)
+        index_together = (('id', 'slug'), ('created', 'id'), ('price', 'id'), ('updated', 'id'))
         verbose_name = 'Produkt'
         verbose_name_plural = 'Produkty'
 
@@ -108,7 +162,75 @@ class Product(models.Model):
         return self.title
 
     def get_serializable_tags(self):
-        return self.tags.values_list('name', flat=True)
+        # Iterating over tags.all() lets prefetch_related('tags') serve a whole page from a single query.
+        return [tag.name for tag in self.tags.all()]
+
+
+class SearchTerm(models.Model):
+    """Inverted index entry: a normalized word of product's title, artist, label, genre, tags or description."""
+    term = models.CharField(verbose_name='Słowo', max_length=64)
+    product = models.ForeignKey(Product, verbose_name='Produkt', related_name='search_terms', on_delete=models.CASCADE)
+    weight = models.PositiveIntegerField(verbose_name='Waga')
+
+    class Meta:
+        unique_together = (('term', 'product'),)
+        verbose_name = 'Słowo wyszukiwania'
+        verbose_name_plural = 'Słowa wyszukiwania'
+
+    def __str__(self):
+        return self.term
+
+
+class ProductRating(models.Model):
+    """Rating summary of a product, kept up to date by Review.save() and review deletion."""
+    product = models.OneToOneField(Product, verbose_name='Produkt', primary_key=True, related_name='rating',
+                                   on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(verbose_name='Liczba ocen', default=0)
+    total = models.PositiveIntegerField(verbose_name='Suma ocen', default=0)
+    rate_1 = models.PositiveIntegerField(verbose_name='Oceny 1', default=0)
+    rate_2 = models.PositiveIntegerField(verbose_name='Oceny 2', default=0)
+    rate_3 = models.PositiveIntegerField(verbose_name='Oceny 3', default=0)
+    rate_4 = models.PositiveIntegerField(verbose_name='Oceny 4', default=0)
+    rate_5 = models.PositiveIntegerField(verbose_name='Oceny 5', default=0)
+    average = models.DecimalField(verbose_name='Średnia ocena', max_digits=3, decimal_places=2, default=0,
+                                  db_index=True)
+
+    RATES = (1, 2, 3, 4, 5)
+
+    class Meta:
+        verbose_name = 'Ocena produktu'
+        verbose_name_plural = 'Oceny produktów'
+
+    def __str__(self):
+        return 'Ocena {}'.format(self.product_id)
+
+    @classmethod
+    def add_rate(cls, product_id, rate):
+        with transaction.atomic():
+            rating = cls.objects.select_for_update().get_or_create(product_id=product_id)[0]
+            rating.change(rate, 1)
+
+    @classmethod
+    def remove_rate(cls, product_id, rate):
+        with transaction.atomic():
+            rating = cls.objects.select_for_update().filter(product_id=product_id).first()
+            if rating is not None:
+                rating.change(rate, -1)
+
+    def change(self, rate, delta):
+        field = 'rate_{}'.format(rate)
+        setattr(self, field, getattr(self, field) + delta)
+        self.count += delta
+        self.total += rate * delta
+        self.set_average()
+        self.save()
+        invalidate_products([self.product_id])
+
+    def set_average(self):
+        self.average = (Decimal(self.total) / self.count).quantize(Decimal('0.01')) if self.count else Decimal(0)
+
+    def get_distribution(self):
+        return OrderedDict((rate, getattr(self, 'rate_{}'.format(rate))) for rate in self.RATES)
 
 
 class Review(models.Model):
@@ -119,16 +241,67 @@ class Review(models.Model):
     rate = models.PositiveSmallIntegerField(verbose_name='Ocena', null=True, blank=True,
                                             choices=[(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)])
     is_active = models.BooleanField(verbose_name='Czy aktywny', default=True)
+    path = models.CharField(verbose_name='Ścieżka', max_length=255, db_index=True, blank=True, editable=False)
+    depth = models.PositiveSmallIntegerField(verbose_name='Poziom', default=0, editable=False)
     created = models.DateTimeField(auto_now_add=True, verbose_name='Data dodania')
+    updated = models.DateTimeField(auto_now=True, verbose_name='Data modyfikacji')
+
+    # Path is made of zero padded ids of the review and its ancestors, so ordering by it gives whole threads
+    # in display order. Threads are loaded one level at a time through `parent`, see ReviewView.list_threads.
+    PATH_STEP = 11
+    MAX_DEPTH = 255 // PATH_STEP - 1
 
     class Meta:
         verbose_name = 'Komentarz'
         verbose_name_plural = 'Komentarze'
         ordering = ('-created', )
+        # First replies of a review and their count, see ReviewView.list_threads.
+        index_together = (('parent', 'is_active', 'id'),)
 
     def __str__(self):
         return 'Opinia {} o {}'.format(self.author, self.product)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Review, cls).from_db(db, field_names, values)
+        if {'is_active', 'rate', 'parent_id'}.issubset(field_names):
+            instance._saved_rate = instance.counted_rate
+        return instance
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.pk and not hasattr(self, '_saved_rate'):
+                saved = Review.objects.filter(id=self.pk).only('is_active', 'rate', 'parent_id').first()
+                self._saved_rate = saved.counted_rate if saved else None
+            super(Review, self).save(*args, **kwargs)
+            if not self.path:
+                self.set_path()
+                Review.objects.filter(id=self.id).update(path=self.path, depth=self.depth)
+            saved_rate, self._saved_rate = getattr(self, '_saved_rate', None), self.counted_rate
+            if saved_rate != self.counted_rate:
+                if saved_rate:
+                    ProductRating.remove_rate(self.product_id, saved_rate)
+                if self.counted_rate:
+                    ProductRating.add_rate(self.product_id, self.counted_rate)
+
+    @property
+    def counted_rate(self):
+        """Rate which counts into the product rating, only active top level reviews are counted."""
+        if self.is_active and self.rate and not self.parent_id:
+            return self.rate
+        return None
+
+    def set_path(self):
+        self.path, self.depth = self.make_path(self.parent.path if self.parent_id else '', self.id)
+
+    @classmethod
+    def make_path(cls, parent_path, review_id):
+        return '{}{:010d}/'.format(parent_path, review_id), len(parent_path) // cls.PATH_STEP
+
+    @property
+    def parent_path(self):
+        return self.path[:-self.PATH_STEP]
+
 
 class Shipping(models.Model):
     """e.g InPost"""
@@ -159,6 +332,29 @@ class Payment(models.Model):
         return self.name
 
 
+class OrderQuerySet(models.QuerySet):
+
+    def cancel(self):
+        """
+        Deletes the unpaid orders of the queryset and puts their items back in stock, in one transaction and with
+        the same number of statements for any number of orders. Orders are locked before their state is checked,
+        so an order being paid at the same time is either paid or cancelled, never both. Returns ids of the
+        cancelled orders.
+        """
+        with transaction.atomic():
+            ids = list(self.select_for_update().filter(state=Order.ORDERED).order_by('id')
+                       .values_list('id', flat=True))
+            if not ids:
+                return []
+            quantities = dict(OrderItem.objects.filter(order__in=ids).order_by().values('product')
+                              .annotate(quantity=Sum('quantity')).values_list('product', 'quantity'))
+            if quantities:
+                Product.objects.increment_stock(quantities)
+            # Without signals connected to orders and items, both are removed with one DELETE per table.
+            Order.objects.filter(id__in=ids).delete()
+        return ids
+
+
 class Order(models.Model):
     ORDERED = 1
     PAID = 2
@@ -177,21 +373,32 @@ class Order(models.Model):
     city = models.CharField(verbose_name='Miejscowość', max_length=128)
     phone = models.CharField(verbose_name='Numer telefonu', max_length=16, blank=True, null=True)
     state = models.PositiveSmallIntegerField(verbose_name='Status', choices=STATES, default=ORDERED)
+    items_price = models.DecimalField(verbose_name='Cena produktów', max_digits=10, decimal_places=2,
+                                      blank=True, null=True)
+    shipping_price = models.DecimalField(verbose_name='Cena dostawy', max_digits=5, decimal_places=2,
+                                         blank=True, null=True)
+    total_price = models.DecimalField(verbose_name='Cena całkowita', max_digits=10, decimal_places=2,
+                                      blank=True, null=True)
     created = models.DateTimeField(auto_now_add=True, verbose_name='Data utworzenia')
 
-    def total_price(self):
-        return self.shipping.price + Decimal(self.items.aggregate(total_price=Sum(F('quantity')*F('product__price'),
-                                                                  output_field=models.DecimalField()))['total_price'])
-    total_price.short_description = 'Cena całkowita'
+    objects = OrderQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Zamówienie'
         verbose_name_plural = 'Zamówienia'
         ordering = ['-created']
+        # Pages of a user's orders are ranges of this index, see OrderResultsSetPagination.
+        index_together = (('user', 'created', 'id'),)
 
     def __str__(self):
         return 'Zamówienie nr. {}'.format(self.id)
 
+    def set_prices(self, items_price):
+        """Freezes the order prices, so they don't change together with product or shipping prices."""
+        self.items_price = items_price
+        self.shipping_price = self.shipping.price
+        self.total_price = self.items_price + self.shipping_price
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, verbose_name='Zamówienie', related_name='items')
@@ -206,6 +413,101 @@ class OrderItem(models.Model):
         return 'Zamówiony produkt nr. {}'.format(self.id)
 
 
+class ReservationQuerySet(models.QuerySet):
+
+    def live(self):
+        return self.filter(expires__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires__lte=timezone.now())
+
+    def reserve(self, user, product_id, quantity):
+        """
+        Takes `quantity` pieces of the product off the stock and holds them for `user` for RESERVATION_TIMEOUT
+        seconds, adding them to the user's reservation of the product and extending it if there is one already.
+        Raises InsufficientStock like decrement_stock.
+        """
+        expires = timezone.now() + timedelta(seconds=settings.RESERVATION_TIMEOUT)
+        reservations = Reservation.objects.filter(user=user, product_id=product_id)
+        with transaction.atomic():
+            # The reservation is locked before the product, in the same order as release() and claim() lock them.
+            list(reservations.select_for_update().values_list('id', flat=True))
+            Product.objects.decrement_stock({product_id: quantity})
+            if not reservations.update(quantity=F('quantity') + quantity, expires=expires):
+                try:
+                    with transaction.atomic():
+                        Reservation.objects.create(user=user, product_id=product_id, quantity=quantity,
+                                                   expires=expires)
+                except IntegrityError:
+                    # There was nothing to lock, a concurrent first reservation of the product by the user
+                    # committed in the meantime. The pieces are added to it instead.
+                    reservations.update(quantity=F('quantity') + quantity, expires=expires)
+            return reservations.select_related('product').get()
+
+    def release(self):
+        """Puts the pieces held by the reservations of the queryset back in stock and deletes them, returns ids."""
+        with transaction.atomic():
+            ids = list(self.select_for_update().order_by('id').values_list('id', flat=True))
+            if not ids:
+                return []
+            # Quantities are read after the lock, a checkout which held it may have claimed a part of them.
+            quantities = dict(Reservation.objects.filter(id__in=ids).order_by().values('product')
+                              .annotate(quantity=Sum('quantity')).values_list('product', 'quantity'))
+            Product.objects.increment_stock(quantities)
+            Reservation.objects.filter(id__in=ids).delete()
+        return ids
+
+    def claim(self, user, quantities):
+        """
+        Takes `quantities` ({product id: quantity}) of an order of `user` from the user's live reservations. The
+        pieces are already off the stock, so products aren't touched. Returns the quantities which weren't
+        reserved and have to be taken off the stock, in the same transaction.
+        """
+        with transaction.atomic(savepoint=False):
+            reservations = (self.live().select_for_update().filter(user=user, product__in=quantities).order_by('id')
+                            .values_list('id', 'product', 'quantity'))
+            remaining = dict(quantities)
+            used, left = [], {}
+            for reservation_id, product_id, reserved in reservations:
+                claimed = min(reserved, remaining[product_id])
+                remaining[product_id] -= claimed
+                if claimed == reserved:
+                    used.append(reservation_id)
+                else:
+                    left[reservation_id] = reserved - claimed
+            if used:
+                Reservation.objects.filter(id__in=used).delete()
+            if left:
+                Reservation.objects.filter(id__in=left).update(quantity=Case(
+                    *[When(id=reservation_id, then=quantity) for reservation_id, quantity in left.items()],
+                    output_field=models.PositiveIntegerField()
+                ))
+        return {product_id: quantity for product_id, quantity in remaining.items() if quantity}
+
+
+class Reservation(models.Model):
+    """
+    Pieces of a product held for a user until `expires`. They are taken off Product.stock when reserved, so a
+    checkout of reserved pieces can't run out of stock. Expired reservations go back to the stock with
+    release_expired_reservations.
+    """
+    user = models.ForeignKey(UserProfile, verbose_name='Użytkownik', related_name='reservations')
+    product = models.ForeignKey(Product, verbose_name='Produkt', related_name='reservations')
+    quantity = models.PositiveIntegerField(verbose_name='Liczba')
+    expires = models.DateTimeField(verbose_name='Ważna do', db_index=True)
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Data utworzenia')
+
+    objects = ReservationQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (('user', 'product'),)
+        verbose_name = 'Rezerwacja'
+        verbose_name_plural = 'Rezerwacje'
+
+    def __str__(self):
+        return 'Rezerwacja nr. {}'.format(self.id)
+
+
 class BankInfo(models.Model):
     account = models.CharField(verbose_name='Numer rachunku', max_length=100)
     name = models.CharField(verbose_name='Nazwa odbiorcy', max_length=128)
@@ -217,3 +519,51 @@ class BankInfo(models.Model):
 
     def __str__(self):
         return 'Dane przelewowe'
+
+
+class OutgoingEmail(models.Model):
+    """Email waiting in the outbox, written in the transaction which caused it and sent by send_queued_emails."""
+    subject = models.CharField(verbose_name='Temat', max_length=255)
+    body = models.TextField(verbose_name='Treść')
+    from_email = models.CharField(verbose_name='Nadawca', max_length=254)
+    to = models.EmailField(verbose_name='Odbiorca', max_length=254)
+    attempts = models.PositiveSmallIntegerField(verbose_name='Liczba prób', default=0)
+    next_attempt = models.DateTimeField(verbose_name='Następna próba', default=timezone.now)
+    last_error = models.TextField(verbose_name='Ostatni błąd', blank=True)
+    sent = models.DateTimeField(verbose_name='Data wysłania', blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Data utworzenia')
+
+    class Meta:
+        index_together = (('sent', 'next_attempt'),)
+        verbose_name = 'Wiadomość do wysłania'
+        verbose_name_plural = 'Wiadomości do wysłania'
+
+    def __str__(self):
+        return '{} do {}'.format(self.subject, self.to)
+
+
+class RequestProfile(models.Model):
+    """Profile of one request, recorded on demand of a staff user and kept in REQUEST_PROFILING_DIR."""
+    CPROFILE = 'cprofile'
+    SAMPLE = 'sample'
+    MODE_CHOICES = (
+        (CPROFILE, 'cProfile'),
+        (SAMPLE, 'Próbkowanie stosu'),
+    )
+
+    user = models.ForeignKey(User, verbose_name='Użytkownik', on_delete=models.SET_NULL, blank=True, null=True)
+    method = models.CharField(verbose_name='Metoda', max_length=8)
+    path = models.CharField(verbose_name='Ścieżka', max_length=255)
+    status_code = models.PositiveSmallIntegerField(verbose_name='Kod odpowiedzi')
+    mode = models.CharField(verbose_name='Rodzaj', max_length=8, choices=MODE_CHOICES)
+    duration = models.FloatField(verbose_name='Czas trwania (ms)')
+    file_name = models.CharField(verbose_name='Plik', max_length=100, unique=True)
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Data utworzenia')
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = 'Profil żądania'
+        verbose_name_plural = 'Profile żądań'
+
+    def __str__(self):
+        return '{} {}'.format(self.method, self.path)
@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from store.models import OutgoingEmail
+
+
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+# How long a claimed batch stays hidden from other workers, longer than sending a batch should ever take.
+LEASE_TIME = 300
+
+
+def get_retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY))
+
+
+def claim_emails(batch_size, max_attempts):
+    """
+    Locks a batch of due emails and moves their next attempt forward, so concurrent workers skip the rows until
+    the lease runs out. An email left by a worker which died while sending is picked up again after the lease.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(OutgoingEmail.objects.select_for_update(skip_locked=True)
+                      .filter(sent__isnull=True, next_attempt__lte=now, attempts__lt=max_attempts)
+                      .order_by('next_attempt', 'id')[:batch_size])
+        OutgoingEmail.objects.filter(id__in=[email.id for email in emails])\
+            .update(next_attempt=now + timedelta(seconds=LEASE_TIME))
+    return emails
+
+
+def make_message(email, connection):
+    # The Message-ID is derived from the row, so a retry after a lost confirmation is recognised as a duplicate.
+    return EmailMessage(email.subject, email.body, email.from_email, [email.to], connection=connection,
+                        headers={'Message-ID': '<outbox-{}@music-shop.com>'.format(email.id)})
+
+
+def record_failure(email, error):
+    attempts = email.attempts + 1
+    OutgoingEmail.objects.filter(id=email.id).update(
+        attempts=attempts, next_attempt=timezone.now() + get_retry_delay(attempts), last_error=repr(error))
+
+
+def send_queued_emails(batch_size=100, max_attempts=10):
+    """Sends one batch of due emails over a single SMTP connection, returns numbers of sent and failed emails."""
+    emails = claim_emails(batch_size, max_attempts)
+    if not emails:
+        return 0, 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        # The server is unreachable, the whole batch is retried later instead of waiting for the lease.
+        for email in emails:
+            record_failure(email, e)
+        return 0, len(emails)
+    sent = failed = 0
+    try:
+        for email in emails:
+            try:
+                make_message(email, connection).send()
+            except Exception as e:
+                record_failure(email, e)
+                failed += 1
+            else:
+                OutgoingEmail.objects.filter(id=email.id, sent__isnull=True).update(sent=timezone.now())
+                sent += 1
+    finally:
+        connection.close()
+    return sent, failed
@@ -1,7 +1,132 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict, namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import exceptions
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+Cursor = namedtuple('Cursor', ('position', 'id', 'reverse'))
 
 
 class StandardResultsSetPagination(PageNumberPagination):
     page_size = 16
     page_size_query_param = 'page_size'
     max_page_size = 32
+
+
+class KeysetResultsSetPagination(StandardResultsSetPagination):
+    """
+    Page number pagination with an opt-in keyset mode, enabled by sending the `cursor` query parameter
+    (empty for the first page), or keyset only with `cursor_only`. Keyset pages are selected with a range condition
+    on the ordering field and `id`, so there is no COUNT(*) and no OFFSET and every page costs one index range scan.
+    """
+    cursor_query_param = 'cursor'
+    cursor_ordering_fields = ()
+    cursor_only = False
+    invalid_cursor_message = 'Niepoprawny kursor.'
+    invalid_ordering_message = 'Kursor nie obsługuje tego sortowania, użyj numerów stron.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = self.cursor_only or self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super(KeysetResultsSetPagination, self).paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        self.field, descending = self.get_ordering(queryset)
+        cursor = self.decode_cursor(request, queryset.model)
+        reverse = cursor.reverse if cursor else False
+
+        prefix = '-' if descending != reverse else ''
+        queryset = queryset.order_by(prefix + self.field, prefix + 'id')
+        if cursor:
+            lookup = 'lt' if prefix else 'gt'
+            queryset = queryset.filter(**{'{}__{}e'.format(self.field, lookup): cursor.position}).filter(
+                Q(**{'{}__{}'.format(self.field, lookup): cursor.position}) |
+                Q(**{self.field: cursor.position, 'id__{}'.format(lookup): cursor.id})
+            )
+
+        results = list(queryset[:page_size + 1])
+        has_following = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_following
+        else:
+            self.has_next, self.has_previous = has_following, cursor is not None
+        self.results = results
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super(KeysetResultsSetPagination, self).get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super(KeysetResultsSetPagination, self).get_next_link()
+        if not self.has_next or not self.results:
+            return None
+        return self.encode_cursor(self.results[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.cursor_mode:
+            return super(KeysetResultsSetPagination, self).get_previous_link()
+        if not self.has_previous or not self.results:
+            return None
+        return self.encode_cursor(self.results[0], reverse=True)
+
+    def get_ordering(self, queryset):
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        field = ordering[0] if ordering else '-id'
+        name = field.lstrip('-')
+        if name not in self.cursor_ordering_fields + ('id',):
+            # Reordering by `id` would return a different order than the one asked for, without telling anyone.
+            raise exceptions.ValidationError({self.cursor_query_param: self.invalid_ordering_message})
+        return name, field.startswith('-')
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            data = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('ascii'))
+            position = model._meta.get_field(self.field).to_python(data['p'])
+            return Cursor(position=position, id=int(data['i']), reverse=bool(data['r']))
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, instance, reverse):
+        position = getattr(instance, self.field)
+        data = {'p': position.isoformat() if hasattr(position, 'isoformat') else str(position),
+                'i': instance.id, 'r': reverse}
+        encoded = urlsafe_b64encode(json.dumps(data).encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+
+class ProductResultsSetPagination(KeysetResultsSetPagination):
+    cursor_ordering_fields = ('created', 'price')
+    search_cursor_message = 'Wyniki wyszukiwania według trafności nie obsługują kursora, użyj numerów stron.'
+
+    def get_ordering(self, queryset):
+        # Relevance is summed over the matched terms for every query, there is no index to walk its pages by.
+        if queryset.query.order_by and queryset.query.order_by[0] == '-search_rank':
+            raise exceptions.ValidationError({self.cursor_query_param: self.search_cursor_message})
+        return super(ProductResultsSetPagination, self).get_ordering(queryset)
+
+
+class OrderResultsSetPagination(KeysetResultsSetPagination):
+    """Keyset only, so a page costs the same for an account with thousands of orders as for a new one."""
+    cursor_ordering_fields = ('created',)
+    cursor_only = True
@@ -1,2 +1,15 @@
+from hmac import compare_digest
+
+from django.conf import settings
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 from rest_framework.compat import is_authenticated
+
+
+class IsStaffOrFeedKey(BasePermission):
+    """Staff users or partners sending one of CATALOG_FEED_KEYS in the X-Feed-Key header."""
+
+    def has_permission(self, request, view):
+        if request.user and is_authenticated(request.user) and request.user.is_staff:
+            return True
+        key = request.META.get('HTTP_X_FEED_KEY', '')
+        return bool(key) and any(compare_digest(key, feed_key) for feed_key in settings.CATALOG_FEED_KEYS)
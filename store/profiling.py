@@ -0,0 +1,189 @@
+import cProfile
+import marshal
+import os
+import sys
+from collections import Counter
+from datetime import timedelta
+from threading import Event, Lock, Thread, get_ident
+from time import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+from store.models import RequestProfile
+
+
+FLAG_HEADER = 'HTTP_X_PROFILE'
+FLAG_PARAM = 'profile'
+EXTENSIONS = {RequestProfile.CPROFILE: 'prof', RequestProfile.SAMPLE: 'folded'}
+
+# One profiled request at a time per process, the others run without the profiler.
+profiling_lock = Lock()
+
+
+def get_requested_mode(request):
+    """Returns the profiler requested with the X-Profile header or the `profile` parameter, None if not asked for."""
+    flag = request.META.get(FLAG_HEADER) or request.GET.get(FLAG_PARAM)
+    if flag is None:
+        return None
+    flag = flag.strip().lower()
+    if flag in EXTENSIONS:
+        return flag
+    return settings.REQUEST_PROFILING_DEFAULT_MODE
+
+
+def get_staff_user(request):
+    # API clients authenticate with a token, which DRF checks only in the view, so it's checked here as well.
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        try:
+            user = (TokenAuthentication().authenticate(request) or (None, None))[0]
+        except AuthenticationFailed:
+            user = None
+    return user if user is not None and user.is_active and user.is_staff else None
+
+
+def acquire_slot():
+    """Takes the process lock and a place in the limit of profiles per minute shared through the cache."""
+    if not profiling_lock.acquire(blocking=False):
+        return False
+    key = 'request-profiling:{}'.format(int(time() // 60))
+    cache.add(key, 0, 120)
+    try:
+        allowed = cache.incr(key) <= settings.REQUEST_PROFILING_MAX_PER_MINUTE
+    except ValueError:
+        allowed = False
+    if not allowed:
+        profiling_lock.release()
+    return allowed
+
+
+def get_profile_path(file_name):
+    return os.path.join(settings.REQUEST_PROFILING_DIR, file_name)
+
+
+def get_frame_name(frame):
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+
+class StackSampler(Thread):
+    """
+    Samples the stack of another thread every `interval` seconds and counts the stacks in the collapsed format
+    (frames from the root separated with semicolons) read by flamegraph.pl, speedscope and other flame graph tools.
+    Frames above `stop_code` belong to the server and the profiler, they are left out.
+    """
+
+    def __init__(self, thread_id, stop_code, interval, max_samples):
+        super(StackSampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stop_code = stop_code
+        self.interval = interval
+        self.max_samples = max_samples
+        self.stacks = Counter()
+        self.stopped = Event()
+
+    def run(self):
+        samples = 0
+        while samples < self.max_samples and not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            # The profiled thread may already be in stop(), the stack would show the profiler.
+            if frame is None or self.stopped.is_set():
+                break
+            stack = []
+            while frame is not None and frame.f_code is not self.stop_code:
+                stack.append(get_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common()).encode()
+
+
+def prune_profiles():
+    """Removes profiles older than REQUEST_PROFILING_MAX_AGE and the oldest above REQUEST_PROFILING_MAX_PROFILES."""
+    RequestProfile.objects.filter(
+        created__lt=timezone.now() - timedelta(seconds=settings.REQUEST_PROFILING_MAX_AGE)
+    ).delete()
+    ids = list(RequestProfile.objects.values_list('id', flat=True)[settings.REQUEST_PROFILING_MAX_PROFILES:])
+    if ids:
+        RequestProfile.objects.filter(id__in=ids).delete()
+
+
+def save_profile(request, response, user, mode, duration, data):
+    file_name = '{:%Y%m%d-%H%M%S}-{}.{}'.format(timezone.now(), uuid4().hex[:12], EXTENSIONS[mode])
+    os.makedirs(settings.REQUEST_PROFILING_DIR, exist_ok=True)
+    with open(get_profile_path(file_name), 'wb') as f:
+        f.write(data)
+    profile = RequestProfile.objects.create(user=user, method=request.method, path=request.get_full_path()[:255],
+                                            status_code=response.status_code, mode=mode, duration=duration,
+                                            file_name=file_name)
+    prune_profiles()
+    return profile
+
+
+class RequestProfilingMiddleware(object):
+    """
+    Profiles requests of staff users which ask for it with the X-Profile header or the `profile` parameter, `sample`
+    samples the stack into a flame graph, `cprofile` records every call with cProfile. Profiles are listed in the
+    admin. Other requests only pay for the header lookup. Enabled by REQUEST_PROFILING.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_PROFILING', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = get_requested_mode(request)
+        if mode is None:
+            return self.get_response(request)
+        user = get_staff_user(request)
+        if user is None:
+            return self.get_response(request)
+        if not acquire_slot():
+            response = self.get_response(request)
+            response['X-Profile-Skipped'] = 'limit'
+            return response
+        try:
+            start = time()
+            if mode == RequestProfile.CPROFILE:
+                response, data = self.run_cprofile(request)
+            else:
+                response, data = self.run_sampler(request)
+            duration = (time() - start) * 1000
+        finally:
+            profiling_lock.release()
+        profile = save_profile(request, response, user, mode, duration, data)
+        response['X-Profile-Id'] = str(profile.id)
+        return response
+
+    def run_cprofile(self, request):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        profiler.create_stats()
+        # The format of pstats.Stats.dump_stats, read by pstats, snakeviz and flameprof.
+        return response, marshal.dumps(profiler.stats)
+
+    def run_sampler(self, request):
+        sampler = StackSampler(get_ident(), self.run_sampler.__code__, settings.REQUEST_PROFILING_SAMPLE_INTERVAL,
+                               settings.REQUEST_PROFILING_MAX_SAMPLES)
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+        return response, sampler.collapsed()
@@ -0,0 +1,87 @@
+import random
+from threading import local
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.permissions import SAFE_METHODS
+
+
+PRIMARY = 'default'
+CATALOG_WRITTEN_KEY = 'db-primary:catalog'
+
+# Replica chosen for the current request and whether it wrote, per thread like the database connections.
+state = local()
+
+
+def get_user_pin_key(user):
+    return 'db-primary:user:{}'.format(user.pk)
+
+
+def pin_user(user):
+    """Sends reads of `user` to the primary until replicas have had the time to receive what the user wrote."""
+    cache.set(get_user_pin_key(user), True, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+def mark_catalog_written():
+    cache.set(CATALOG_WRITTEN_KEY, True, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+def is_catalog_recently_written():
+    return bool(cache.get(CATALOG_WRITTEN_KEY))
+
+
+def reading_from_replica():
+    return getattr(state, 'replica', None) is not None
+
+
+def choose_replica(user):
+    if not settings.DATABASE_REPLICAS:
+        return None
+    if user.is_authenticated and cache.get(get_user_pin_key(user)):
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+def start_request():
+    state.replica = None
+    state.wrote = False
+
+
+def has_written():
+    return getattr(state, 'wrote', False)
+
+
+class ReplicaRouter(object):
+    """
+    Reads of views using ReplicaReadMixin go to one of DATABASE_REPLICAS, everything else reads from and writes to
+    the primary. Objects keep the alias they were read from, so related objects are read from the same database.
+    """
+
+    def db_for_read(self, model, **hints):
+        return getattr(state, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
+
+
+class ReplicaReadMixin(object):
+    """
+    Reads of safe requests go to a replica, unless the user wrote something within DATABASE_REPLICA_PIN_SECONDS,
+    so nobody misses their own review or order because of the replication lag.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super(ReplicaReadMixin, self).initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            state.replica = choose_replica(request.user)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ReplicaReadMixin, self).dispatch(request, *args, **kwargs)
+        finally:
+            state.replica = None
@@ -0,0 +1,118 @@
+import re
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from store.models import Product, SearchTerm
+
+
+TITLE_WEIGHT = 8
+ARTIST_WEIGHT = 6
+TAG_WEIGHT = 4
+LABEL_WEIGHT = 3
+GENRE_WEIGHT = 2
+DESCRIPTION_WEIGHT = 1
+# Products reindexed at once when a genre, artist, label or tag of many products changes.
+INDEX_BATCH_SIZE = 500
+
+# Most common Polish inflection endings, longest first, so "płyty", "płytą" and "płytami" all become "plyt".
+SUFFIXES = ('ach', 'ami', 'ego', 'emu', 'imi', 'owi', 'ymi', 'ów', 'om', 'em', 'ie', 'ej', 'ą', 'ę', 'a', 'e', 'i',
+            'o', 'u', 'y')
+MIN_STEM_LENGTH = 3
+WORD_REGEX = re.compile(r'\w+', re.UNICODE)
+
+
+def stem(word):
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM_LENGTH:
+            return word[:-len(suffix)]
+    return word
+
+
+def unaccent(word):
+    # ł has no decomposition in unicode, so NFKD alone leaves it in place.
+    word = unicodedata.normalize('NFKD', word.replace('ł', 'l').replace('Ł', 'L'))
+    return ''.join(char for char in word if not unicodedata.combining(char))
+
+
+@lru_cache(maxsize=100000)
+def normalize_word(word):
+    return unaccent(stem(word))[:SearchTerm._meta.get_field('term').max_length]
+
+
+def normalize(text):
+    """Splits text into search terms: lowercased, stemmed words without diacritics."""
+    terms = []
+    for word in WORD_REGEX.findall((text or '').lower()):
+        term = normalize_word(word)
+        if len(term) > 1:
+            terms.append(term)
+    return terms
+
+
+def get_texts(title, genre, description, artist=None, label=None, tags=()):
+    texts = [(title, TITLE_WEIGHT), (genre, GENRE_WEIGHT), (description, DESCRIPTION_WEIGHT)]
+    if artist:
+        texts.append((artist, ARTIST_WEIGHT))
+    if label:
+        texts.append((label, LABEL_WEIGHT))
+    texts.extend((tag, TAG_WEIGHT) for tag in tags)
+    return texts
+
+
+def get_product_texts(product):
+    return get_texts(product.title, product.genre.name, product.description,
+                     product.artist.name if product.artist_id else None,
+                     product.label.name if product.label_id else None, [tag.name for tag in product.tags.all()])
+
+
+def get_search_terms(texts):
+    """Returns {term: weight} of (text, weight) pairs, weights of a term found in several fields add up."""
+    weights = Counter()
+    for text, weight in texts:
+        for term in normalize(text):
+            weights[term] += weight
+    return weights
+
+
+def index_products(products):
+    """Replaces index entries of the given products, expects genre, artist, label and tags to be loaded."""
+    search_terms = [SearchTerm(product=product, term=term, weight=weight) for product in products
+                    for term, weight in get_search_terms(get_product_texts(product)).items()]
+    with transaction.atomic():
+        SearchTerm.objects.filter(product__in=products).delete()
+        SearchTerm.objects.bulk_create(search_terms)
+
+
+def reindex_products(queryset):
+    index_products(list(queryset.select_related('genre', 'artist', 'label').prefetch_related('tags')))
+
+
+def reindex_in_batches(queryset, batch_size=INDEX_BATCH_SIZE):
+    """Reindexes products of the queryset `batch_size` at a time in the order of ids, returns how many there were."""
+    indexed = 0
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return indexed
+        reindex_products(Product.objects.filter(id__in=ids))
+        indexed += len(ids)
+        last_id = ids[-1]
+
+
+def search_products(queryset, query):
+    """
+    Narrows the queryset to products matching every word of the query and orders them by relevance, i.e. the sum
+    of field weights of the matched words. The lookup goes through the (term, product) index only.
+    """
+    terms = set(normalize(query))
+    if not terms:
+        return queryset.none()
+    return queryset.filter(search_terms__term__in=terms).annotate(
+        search_matches=Count('search_terms', distinct=True),
+        search_rank=Sum('search_terms__weight'),
+    ).filter(search_matches=len(terms)).order_by('-search_rank', *Product._meta.ordering)
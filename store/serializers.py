@@ -1,24 +1,46 @@
-from base64 import b64decode
-from uuid import uuid4
+from collections import OrderedDict, defaultdict
 
 from django.contrib.auth.models import User
-from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from rest_framework import serializers
 
 from store.models import UserProfile, Product, Artist, Genre, RecordLabel, Review, Shipping, Payment, Order, OrderItem,\
-                         BankInfo
+                         BankInfo, InsufficientStock, ProductRating, Reservation
+from store.images import InvalidImage, decode_base64_image, get_rendition_urls
+
+
+# OrderItem.quantity is a PositiveSmallIntegerField, merged items of a product can't go past it either.
+MAX_ITEM_QUANTITY = 32767
 
 
 class ImageBase64Field(serializers.ImageField):
     def to_internal_value(self, data):
         try:
-            decoded_image = b64decode(data.split(',')[1])
-        except TypeError:
-            raise serializers.ValidationError('Niepoprawny format zdjęcia.')
-        data = ContentFile(decoded_image, name=str(uuid4()) + '.png')
+            data = decode_base64_image(data)
+        except InvalidImage as e:
+            raise serializers.ValidationError(str(e))
         return super(ImageBase64Field, self).to_internal_value(data)
 
 
+class ImageRenditionsField(serializers.Field):
+    """URLs of the image renditions, null until they are generated, clients fall back to `image` then."""
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super(ImageRenditionsField, self).__init__(**kwargs)
+
+    def to_representation(self, product):
+        if not product.image or product.renditions_source != product.image.name:
+            return None
+        urls = get_rendition_urls(product.image.name)
+        request = self.context.get('request', None)
+        if request is not None:
+            urls = OrderedDict((name, request.build_absolute_uri(url)) for name, url in urls.items())
+        return urls
+
+
 class UserSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -85,15 +107,26 @@ class ShippingShortSerializer(serializers.ModelSerializer):
         read_only_fields = fields
 
 
+class ProductRatingSerializer(serializers.ModelSerializer):
+    distribution = serializers.ReadOnlyField(source='get_distribution')
+
+    class Meta:
+        model = ProductRating
+        fields = ('count', 'average', 'distribution')
+        read_only_fields = fields
+
+
 class ProductsListSerializer(serializers.ModelSerializer):
     genre = GenreSerializer()
     artist = ArtistSerializer()
     medium_type = serializers.StringRelatedField()
     tags = serializers.ReadOnlyField(source='get_serializable_tags')
+    images = ImageRenditionsField()
 
     class Meta:
         model = Product
-        fields = ('genre', 'artist', 'title', 'slug', 'medium_type', 'release_date', 'image', 'price', 'stock', 'tags')
+        fields = ('genre', 'artist', 'title', 'slug', 'medium_type', 'release_date', 'image', 'images', 'price', 'stock',
+                  'tags')
         read_only_fields = fields
 
 
@@ -103,13 +136,22 @@ class ProductDetailSerializer(serializers.ModelSerializer):
     medium_type = serializers.StringRelatedField()
     label = RecordLabelShortSerializer()
     tags = serializers.ReadOnlyField(source='get_serializable_tags')
+    rating = serializers.SerializerMethodField()
+    images = ImageRenditionsField()
 
     class Meta:
         model = Product
-        fields = ('genre', 'artist', 'title', 'slug', 'medium_type', 'medium_count', 'release_date', 'image',
-                  'description', 'price', 'length', 'label', 'tags', 'stock')
+        fields = ('genre', 'artist', 'title', 'slug', 'medium_type', 'medium_count', 'release_date', 'image', 'images',
+                  'description', 'price', 'length', 'label', 'tags', 'stock', 'rating')
         read_only_fields = fields
 
+    def get_rating(self, obj):
+        try:
+            rating = obj.rating
+        except ProductRating.DoesNotExist:
+            rating = ProductRating(product=obj)
+        return ProductRatingSerializer(rating).data
+
 
 class ReviewSerializer(serializers.ModelSerializer):
     author = UserProfileSerializer(read_only=True)
@@ -126,11 +168,33 @@ class ReviewSerializer(serializers.ModelSerializer):
             if validated_data.get('rate', None):
                 raise serializers.ValidationError({'rate': 'Nie można oceniać produktu przy odpowiedźi na komentarz.'})
             product = validated_data.get('product')
-            if not Review.objects.filter(id=parent.id, product=product).exists():
+            if parent.product_id != product.id:
                 raise serializers.ValidationError({'parent': 'Nie ma takiego komentarza dla tego produktu.'})
+            if parent.depth >= Review.MAX_DEPTH:
+                raise serializers.ValidationError({'parent': 'Nie można odpowiadać na tak zagnieżdżony komentarz.'})
         return super(ReviewSerializer, self).create(validated_data)
 
 
+class ReviewThreadSerializer(ReviewSerializer):
+    """
+    Review with its replies nested, read from `replies` ({parent path: [reviews]}) and `replies_count`
+    ({review id: count}) in the context.
+    """
+    replies_count = serializers.SerializerMethodField()
+    replies = serializers.SerializerMethodField()
+
+    class Meta(ReviewSerializer.Meta):
+        fields = ReviewSerializer.Meta.fields + ('replies_count', 'replies')
+
+    def get_replies_count(self, obj):
+        return self.context['replies_count'].get(obj.id, 0)
+
+    def get_replies(self, obj):
+        if obj.depth >= self.context['max_depth']:
+            return []
+        return ReviewThreadSerializer(self.context['replies'].get(obj.path, []), many=True, context=self.context).data
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     product = ProductDetailSerializer()
 
@@ -160,12 +224,60 @@ class OrderListSerializer(serializers.ModelSerializer):
         fields = ('id', 'shipping', 'payment', 'total_price', 'state', 'created')
 
 
+class PrefetchedSlugRelatedField(serializers.SlugRelatedField):
+    """SlugRelatedField which looks slugs up in objects resolved up front by `prefetch`, with one IN query."""
+
+    prefetched = None
+
+    def prefetch(self, slugs):
+        self.prefetched = defaultdict(list)
+        for obj in self.get_queryset().filter(**{self.slug_field + '__in': slugs}):
+            self.prefetched[getattr(obj, self.slug_field)].append(obj)
+
+    def to_internal_value(self, data):
+        if self.prefetched is None or not isinstance(data, str):
+            return super(PrefetchedSlugRelatedField, self).to_internal_value(data)
+        objects = self.prefetched.get(data)
+        if not objects:
+            self.fail('does_not_exist', slug_name=self.slug_field, value=data)
+        if len(objects) > 1:
+            self.fail('invalid')
+        return objects[0]
+
+
+class OrderItemCreateListSerializer(serializers.ListSerializer):
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            slugs = {item.get('product') for item in data if isinstance(item, dict)}
+            self.child.fields['product'].prefetch([slug for slug in slugs if isinstance(slug, str)])
+        merged = OrderedDict()
+        errors = []
+        for item in super(OrderItemCreateListSerializer, self).to_internal_value(data):
+            error = {}
+            if item['product'].id in merged:
+                quantity = merged[item['product'].id]['quantity'] + item['quantity']
+                if quantity > MAX_ITEM_QUANTITY:
+                    error = {'quantity': ['Łączna liczba sztuk produktu nie może przekraczać {}.'.format(
+                        MAX_ITEM_QUANTITY)]}
+                else:
+                    merged[item['product'].id]['quantity'] = quantity
+            else:
+                merged[item['product'].id] = item
+            errors.append(error)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return list(merged.values())
+
+
 class OrderItemCreateSerializer(serializers.ModelSerializer):
-    product = serializers.SlugRelatedField(queryset=Product.objects.all(), slug_field='slug')
+    product = PrefetchedSlugRelatedField(queryset=Product.objects.all(), slug_field='slug')
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_ITEM_QUANTITY)
 
     class Meta:
         model = OrderItem
         fields = ('product', 'quantity')
+        list_serializer_class = OrderItemCreateListSerializer
 
 
 class OrderCreateSerizalizer(serializers.ModelSerializer):
@@ -176,21 +288,52 @@ class OrderCreateSerizalizer(serializers.ModelSerializer):
     class Meta:
         model = Order
         exclude = ('user', 'state', 'created')
+        read_only_fields = ('items_price', 'shipping_price', 'total_price')
 
     def create(self, validated_data):
         items = validated_data.pop('items')
         if not items:
             raise serializers.ValidationError({'items': 'Nie można złożyć pustego zamówienia.'})
-        order = super(OrderCreateSerizalizer, self).create(validated_data)
-        order_items = []
-        for item in items:
-            order_items.append(OrderItem(order=order, product=item['product'], quantity=item['quantity']))
-            item['product'].stock -= item['quantity']
-            item['product'].save()
-        OrderItem.objects.bulk_create(order_items)
+        quantities = {item['product'].id: item['quantity'] for item in items}
+        try:
+            # Without a savepoint, a failed checkout rolls back the claimed reservations with the whole transaction.
+            with transaction.atomic(savepoint=False):
+                # Reserved pieces are already off the stock, only the rest is taken off the products.
+                if validated_data.get('user') is not None:
+                    quantities = Reservation.objects.claim(validated_data['user'], quantities)
+                if quantities:
+                    Product.objects.decrement_stock(quantities)
+        except InsufficientStock as e:
+            titles = [item['product'].title for item in items if item['product'].id in e.product_ids]
+            raise serializers.ValidationError({'items': 'Brak wystarczającej liczby sztuk produktów: {}.'.format(
+                ', '.join(titles))})
+        order = Order(**validated_data)
+        order.set_prices(sum(item['product'].price * item['quantity'] for item in items))
+        order.save()
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=item['product'], quantity=item['quantity'])
+                                       for item in items])
+        prefetch_related_objects([order], Prefetch('items', queryset=OrderItem.objects.select_related('product')))
         return order
 
 
+class ReservationSerializer(serializers.ModelSerializer):
+    product = serializers.SlugRelatedField(queryset=Product.objects.all(), slug_field='slug')
+    quantity = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = Reservation
+        fields = ('id', 'product', 'quantity', 'expires')
+        read_only_fields = ('expires',)
+
+    def create(self, validated_data):
+        product = validated_data['product']
+        try:
+            return Reservation.objects.reserve(validated_data['user'], product.id, validated_data['quantity'])
+        except InsufficientStock:
+            raise serializers.ValidationError({'quantity': 'Brak wystarczającej liczby sztuk produktu: {}.'.format(
+                product.title)})
+
+
 class BankInfoSerializer(serializers.ModelSerializer):
 
     class Meta:
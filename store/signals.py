@@ -1,8 +1,25 @@
+import logging
+import os
+
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
+from django.utils import timezone
+from taggit.models import Tag
+
+from store.caching import invalidate, invalidate_products, invalidate_review_authors, invalidate_reviews, version_key
+from store.images import generate_renditions
+from store.profiling import get_profile_path
+from store.search import INDEX_BATCH_SIZE, index_products, reindex_in_batches, reindex_products
+from store.models import UserProfile, Product, Genre, Artist, RecordLabel, Medium, Review, ProductRating,\
+                         RequestProfile
+
 
-from store.models import UserProfile
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_NAMES = {Genre: 'genre', Artist: 'artist', RecordLabel: 'label', Medium: 'medium', Tag: 'tag'}
+# User fields shown as the author of a review, see UserSerializer.
+REVIEW_AUTHOR_FIELDS = {'username', 'first_name', 'last_name', 'email'}
 
 
 @receiver(post_save, sender=User)
@@ -12,11 +29,161 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
+def save_user_profile(sender, instance, created, update_fields=None, **kwargs):
+    # A partial save, e.g. of last_login on every login, has nothing to save in the profile.
+    if not created and update_fields is None:
+        instance.profile.save()
+
+
+@receiver(post_save, sender=User)
+def invalidate_partially_saved_author(sender, instance, created, update_fields=None, **kwargs):
+    if not created and update_fields is not None and REVIEW_AUTHOR_FIELDS.intersection(update_fields):
+        invalidate_review_authors()
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_review_author(sender, instance, created, raw=False, **kwargs):
+    # Full saves of the user save the profile as well.
+    if not created and not raw:
+        invalidate_review_authors()
 
 
 @receiver(post_delete, sender=UserProfile)
 def post_delete_user(sender, instance, *args, **kwargs):
     instance.user.delete()
 
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    invalidate_products([instance.id])
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def invalidate_product_tags_cache(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, Product):
+        invalidate_products([instance.id])
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Artist)
+@receiver(post_delete, sender=Artist)
+@receiver(post_save, sender=RecordLabel)
+@receiver(post_delete, sender=RecordLabel)
+@receiver(post_save, sender=Medium)
+@receiver(post_delete, sender=Medium)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_catalog_cache(sender, instance, **kwargs):
+    invalidate(version_key(CATALOG_VERSION_NAMES[sender], instance.pk))
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_products([instance])
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def index_product_tags(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, Product):
+        reindex_products(Product.objects.filter(id=instance.id))
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Artist)
+@receiver(post_save, sender=RecordLabel)
+def index_related_products(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        reindex_in_batches(instance.products.all())
+
+
+@receiver(post_save, sender=Tag)
+def index_tagged_products(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        reindex_in_batches(Product.objects.filter(tags=instance))
+
+
+@receiver(pre_delete, sender=Tag)
+def remember_tagged_products(sender, instance, **kwargs):
+    # The tagged items are gone by post_delete, ids are all that is kept of the products.
+    instance._tagged_product_ids = list(Product.objects.filter(tags=instance).order_by('id')
+                                        .values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def index_products_of_deleted_tag(sender, instance, **kwargs):
+    ids = getattr(instance, '_tagged_product_ids', [])
+    for start in range(0, len(ids), INDEX_BATCH_SIZE):
+        reindex_products(Product.objects.filter(id__in=ids[start:start + INDEX_BATCH_SIZE]))
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def touch_product_tags(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, Product):
+        Product.objects.filter(id=instance.id).update(updated=timezone.now())
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Artist)
+@receiver(post_save, sender=RecordLabel)
+@receiver(post_save, sender=Medium)
+def touch_related_products(sender, instance, created, raw=False, **kwargs):
+    # Names of related rows are part of the catalog feed, so their products count as changed too.
+    if not created and not raw:
+        instance.products.update(updated=timezone.now())
+
+
+@receiver(post_save, sender=Tag)
+def touch_tagged_products(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        Product.objects.filter(tags=instance).update(updated=timezone.now())
+
+
+@receiver(pre_delete, sender=Tag)
+def touch_products_of_deleted_tag(sender, instance, **kwargs):
+    # Deleting a tag removes its tagged items without m2m_changed.
+    Product.objects.filter(tags=instance).update(updated=timezone.now())
+
+
+@receiver(post_save, sender=Product)
+def create_product_rating(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ProductRating.objects.get_or_create(product=instance)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_lists(sender, instance, **kwargs):
+    invalidate_reviews(instance.product_id)
+
+
+@receiver(post_delete, sender=Review)
+def remove_review_rate(sender, instance, **kwargs):
+    rate = getattr(instance, '_saved_rate', instance.counted_rate)
+    if rate:
+        ProductRating.remove_rate(instance.product_id, rate)
+
+
+@receiver(post_save, sender=Product)
+def generate_product_renditions(sender, instance, raw=False, **kwargs):
+    if raw or not instance.image or instance.image.name == instance.renditions_source:
+        return
+    try:
+        generate_renditions(instance.image.name)
+    except (IOError, OSError):
+        # The product stays on the original image until generate_image_renditions manages to process it.
+        logger.exception('Generating renditions of %s failed', instance.image.name)
+        return
+    instance.renditions_source, instance.updated = instance.image.name, timezone.now()
+    Product.objects.filter(id=instance.id).update(renditions_source=instance.renditions_source,
+                                                  updated=instance.updated)
+
+
+@receiver(post_delete, sender=RequestProfile)
+def delete_profile_file(sender, instance, **kwargs):
+    try:
+        os.remove(get_profile_path(instance.file_name))
+    except FileNotFoundError:
+        pass
@@ -1,5 +1,1718 @@
+import csv
+import json
+import os
+import pstats
+import shutil
+import tempfile
+from base64 import b64encode
+from datetime import date, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from time import sleep
+from unittest import mock
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.db import connection, connections, transaction, DatabaseError
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework import serializers, status
+from rest_framework.test import APITestCase, APIRequestFactory
 from rest_framework.authtoken.models import Token
+
+from store.benchmark.concurrency import run_in_threads
+from store.benchmark.data import DataGenerator, USERNAME_PREFIX
+from store.benchmark.drop import ReservationDrop
+from store.caching import get_product_cache_key
+from store.search import normalize, reindex_in_batches
+from store.middleware import normalize_sql, RequestInstrumentationMiddleware
+from store.serializers import OrderCreateSerizalizer, ProductsListSerializer
+from store.models import Artist, Genre, RecordLabel, Medium, Product, Shipping, Payment, Order, OrderItem,\
+    InsufficientStock, Review, SearchTerm, ProductRating, BankInfo, OutgoingEmail,\
+    RequestProfile, UserProfile, Reservation, ReservationQuerySet
+from store.outbox import send_queued_emails
+from store.routers import get_user_pin_key
+from store.profiling import get_profile_path
+from store.importing import CatalogImporter, make_slug, read_csv
+from store.feeds import CSV_FIELDS
+from store.throttles import ProductDetailThrottle, ProductListThrottle
+from store.images import InvalidImage, decode_base64_image, get_rendition_name
+from PIL import Image
+from taggit.models import Tag, TaggedItem
+
+
+class StoreDataMixin(object):
+
+    def setUp(self):
+        super(StoreDataMixin, self).setUp()
+        cache.clear()
+        self.genre = Genre.objects.create(name='Rock', slug='rock')
+        self.artist = Artist.objects.create(name='Artysta', slug='artysta')
+        self.label = RecordLabel.objects.create(name='Wytwórnia', slug='wytwornia')
+        self.medium = Medium.objects.create(name='CD')
+        self.shipping = Shipping.objects.create(name='Kurier', slug='kurier', price=Decimal('15.00'))
+        self.payment = Payment.objects.create(name='PayPal', slug='paypal')
+        self.user = User.objects.create_user('klient', 'klient@example.com', 'haslo1234')
+        self.token = Token.objects.create(user=self.user)
+
+    def authenticate(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def create_order(self, products, quantity=1):
+        order = Order.objects.create(user=self.user.profile, shipping=self.shipping, payment=self.payment,
+                                     address='Ulica 1', zip_code='00-001', city='Warszawa')
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=quantity)
+                                       for product in products])
+        return order
+
+    def create_products(self, count, tags=('rock', 'winyl'), **kwargs):
+        products = []
+        for i in range(count):
+            fields = dict(genre=self.genre, artist=self.artist, label=self.label, medium_type=self.medium,
+                          title='Album {}'.format(i), slug='album-{}'.format(i), release_date=date(2017, 1, 1),
+                          price=Decimal('10.00') + i, stock=100)
+            fields.update(kwargs)
+            product = Product.objects.create(**fields)
+            product.tags.add(*tags)
+            products.append(product)
+        return products
+
+
+class StoreTestCase(StoreDataMixin, APITestCase):
+    pass
+
+
+class ProductTagsQueryCountTest(StoreTestCase):
+
+    def test_list_tags_use_single_query(self):
+        self.create_products(32)
+        # count + page + products + tags, the last two only load products whose fragments aren't cached
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/products/', {'page_size': 32})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 32)
+        self.assertEqual(sorted(response.data['results'][0]['tags']), ['rock', 'winyl'])
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        self.create_products(32)
+        with self.assertNumQueries(4):
+            self.client.get('/api/products/', {'page_size': 4})
+        with self.assertNumQueries(4):
+            self.client.get('/api/products/', {'page_size': 32})
+
+    def test_detail_tags(self):
+        product = self.create_products(1)[0]
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/products/{}/'.format(product.slug))
+        self.assertEqual(sorted(response.data['tags']), ['rock', 'winyl'])
+
+    def test_order_detail_tags_use_single_query(self):
+        order = self.create_order(self.create_products(10))
+        self.authenticate()
+        response = self.client.get('/api/orders/{}/'.format(order.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.data['items'][0]['product']['tags']), ['rock', 'winyl'])
+        # token + profile + order + items + tags
+        with self.assertNumQueries(5):
+            self.client.get('/api/orders/{}/'.format(order.id))
+
+
+class ProductCursorPaginationTest(StoreTestCase):
+
+    def walk(self, params, queries=3):
+        slugs, url, pages = [], '/api/products/', 0
+        while url:
+            with self.assertNumQueries(queries):
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            slugs.extend(product['slug'] for product in response.data['results'])
+            url, params, pages = response.data['next'], None, pages + 1
+        return slugs, pages
+
+    def test_default_ordering(self):
+        products = self.create_products(20)
+        Product.objects.filter(id__in=[p.id for p in products[:10]]).update(created=products[0].created)
+        slugs, pages = self.walk({'cursor': '', 'page_size': 3})
+        expected = Product.objects.order_by('-created', '-id').values_list('slug', flat=True)
+        self.assertEqual(slugs, list(expected))
+        self.assertEqual(pages, 7)
+
+    def test_price_ordering_with_ties(self):
+        products = self.create_products(20)
+        Product.objects.filter(id__in=[p.id for p in products[5:15]]).update(price=Decimal('20.00'))
+        # The second walk finds fragments of every product cached and only selects the pages.
+        for ordering, prefix, queries in (('price', '', 3), ('-price', '-', 1)):
+            slugs, _ = self.walk({'cursor': '', 'page_size': 4, 'ordering': ordering}, queries)
+            expected = Product.objects.order_by(prefix + 'price', prefix + 'id').values_list('slug', flat=True)
+            self.assertEqual(slugs, list(expected))
+
+    def test_previous_link(self):
+        self.create_products(10)
+        first = self.client.get('/api/products/', {'cursor': '', 'page_size': 4})
+        self.assertIsNone(first.data['previous'])
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+
+    def test_filters_combine_with_cursor(self):
+        self.create_products(10)
+        response = self.client.get('/api/products/', {'cursor': '', 'max_price': 14})
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/products/', {'cursor': 'zly-kursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unsupported_ordering_is_rejected(self):
+        self.create_products(3)
+        for ordering in ('rating', '-rating'):
+            response = self.client.get('/api/products/', {'cursor': '', 'ordering': ordering})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('cursor', response.data)
+        self.assertEqual(self.client.get('/api/products/', {'ordering': 'rating'}).status_code, status.HTTP_200_OK)
+
+    def test_page_number_mode_is_default(self):
+        self.create_products(3)
+        response = self.client.get('/api/products/')
+        self.assertEqual(response.data['count'], 3)
+
+
+class OrderPricesTest(StoreTestCase):
+
+    def order_data(self, products, quantity=2):
+        return {'shipping': self.shipping.slug, 'payment': self.payment.slug, 'address': 'Ulica 1',
+                'zip_code': '00-001', 'city': 'Warszawa',
+                'items': [{'product': product.slug, 'quantity': quantity} for product in products]}
+
+    def test_create_stores_prices(self):
+        products = self.create_products(2)
+        self.authenticate()
+        response = self.client.post('/api/orders/new/', self.order_data(products))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get()
+        self.assertEqual(order.items_price, Decimal('42.00'))
+        self.assertEqual(order.shipping_price, Decimal('15.00'))
+        self.assertEqual(order.total_price, Decimal('57.00'))
+
+    def test_prices_are_frozen(self):
+        products = self.create_products(1)
+        self.authenticate()
+        self.client.post('/api/orders/new/', self.order_data(products, quantity=1))
+        Product.objects.update(price=Decimal('99.00'))
+        self.assertEqual(Order.objects.get().total_price, Decimal('25.00'))
+
+    def test_list_reads_stored_prices(self):
+        products = self.create_products(3)
+        self.authenticate()
+        for _ in range(5):
+            self.client.post('/api/orders/new/', self.order_data(products))
+        # token + profile + orders
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/orders/')
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(Decimal(response.data['results'][0]['total_price']), Decimal('81.00'))
+
+    def test_backfill_command(self):
+        order = self.create_order(self.create_products(2), quantity=3)
+        self.assertIsNone(order.total_price)
+        call_command('backfill_order_prices', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual(order.items_price, Decimal('63.00'))
+        self.assertEqual(order.total_price, Decimal('78.00'))
+
+
+class OrderStockTest(StoreTestCase):
+
+    def order_data(self, items):
+        return {'shipping': self.shipping.slug, 'payment': self.payment.slug, 'address': 'Ulica 1',
+                'zip_code': '00-001', 'city': 'Warszawa',
+                'items': [{'product': product.slug, 'quantity': quantity} for product, quantity in items]}
+
+    def test_stock_is_decremented(self):
+        first, second = self.create_products(2)
+        self.authenticate()
+        response = self.client.post('/api/orders/new/', self.order_data([(first, 3), (second, 5)]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(dict(Product.objects.values_list('slug', 'stock')), {first.slug: 97, second.slug: 95})
+
+    def test_insufficient_stock(self):
+        first, second = self.create_products(2)
+        Product.objects.filter(id=second.id).update(stock=2)
+        self.authenticate()
+        response = self.client.post('/api/orders/new/', self.order_data([(first, 1), (second, 3)]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(second.title, response.data['items'])
+        self.assertNotIn(first.title, response.data['items'])
+        self.assertEqual(dict(Product.objects.values_list('slug', 'stock')), {first.slug: 100, second.slug: 2})
+        self.assertFalse(Order.objects.exists())
+
+    def test_items_are_resolved_with_one_query(self):
+        products = self.create_products(50)
+        serializer = OrderCreateSerizalizer(data=self.order_data([(product, 1) for product in products]))
+        # shipping + payment + products
+        with self.assertNumQueries(3):
+            self.assertTrue(serializer.is_valid())
+        self.assertEqual([item['product'] for item in serializer.validated_data['items']], products)
+
+    def test_duplicated_items_are_merged(self):
+        first, second = self.create_products(2)
+        self.authenticate()
+        response = self.client.post('/api/orders/new/', self.order_data([(first, 1), (second, 2), (first, 3)]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(dict(OrderItem.objects.values_list('product__slug', 'quantity')),
+                         {first.slug: 4, second.slug: 2})
+        self.assertEqual(Product.objects.get(id=first.id).stock, 96)
+
+    def test_merged_quantity_is_validated(self):
+        first, second = self.create_products(2)
+        serializer = OrderCreateSerizalizer(data=self.order_data([(first, 30000), (second, 1), (first, 30000)]))
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['items'][:2], [{}, {}])
+        self.assertIn('32767', serializer.errors['items'][2]['quantity'][0])
+        serializer = OrderCreateSerizalizer(data=self.order_data([(first, 0)]))
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('quantity', serializer.errors['items'][0])
+
+    def test_unknown_product_error_points_to_item(self):
+        product = self.create_products(1)[0]
+        data = self.order_data([(product, 1)])
+        data['items'].append({'product': 'nie-ma', 'quantity': 1})
+        serializer = OrderCreateSerizalizer(data=data)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['items'][0], {})
+        self.assertEqual(list(serializer.errors['items'][1]), ['product'])
+        self.assertIn('nie-ma', serializer.errors['items'][1]['product'][0])
+
+
+class CheckoutStressTest(StoreDataMixin, TransactionTestCase):
+    threads = 8
+    checkouts_per_thread = 10
+    stock = 50
+
+    def setUp(self):
+        super(CheckoutStressTest, self).setUp()
+        self.products = self.create_products(3, stock=self.stock)
+
+    def run_threads(self, checkout):
+        errors = []
+
+        def worker():
+            for _ in range(self.checkouts_per_thread):
+                try:
+                    with transaction.atomic():
+                        checkout()
+                except (InsufficientStock, DatabaseError):
+                    errors.append(1)
+
+        run_in_threads(worker, [()] * self.threads)
+        return len(errors)
+
+    def checkout(self):
+        Product.objects.decrement_stock({product.id: 1 for product in self.products})
+
+    def test_stock_is_never_oversold(self):
+        failed = self.run_threads(self.checkout)
+        sold = self.threads * self.checkouts_per_thread - failed
+        for stock in Product.objects.values_list('stock', flat=True):
+            self.assertGreaterEqual(stock, 0)
+            self.assertEqual(stock, self.stock - sold)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_checkout', threads=2, checkouts=3, stdout=out)
+        self.assertEqual([line.split()[0] for line in out.getvalue().splitlines()], ['decrement_stock', 'save()'])
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {self.stock})
+
+
+class CatalogCacheTest(StoreTestCase):
+
+    def test_list_is_cached(self):
+        self.create_products(5)
+        first = self.client.get('/api/products/', {'genre': 'rock', 'page_size': 4})
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/products/', {'page_size': 4, 'genre': 'rock', '_': '123'})
+        self.assertEqual(first.data, second.data)
+        # count + page, the fragments of the products are cached by the first request
+        with self.assertNumQueries(2):
+            self.client.get('/api/products/', {'genre': 'rock', 'page_size': 2})
+
+    def test_list_is_invalidated_on_product_change(self):
+        product = self.create_products(1)[0]
+        self.client.get('/api/products/')
+        product.price = Decimal('99.00')
+        product.save()
+        response = self.client.get('/api/products/')
+        self.assertEqual(response.data['results'][0]['price'], '99.00')
+
+    def test_list_is_invalidated_on_stock_change(self):
+        product = self.create_products(1)[0]
+        self.client.get('/api/products/')
+        Product.objects.decrement_stock({product.id: 10})
+        response = self.client.get('/api/products/')
+        self.assertEqual(response.data['results'][0]['stock'], 90)
+
+    def test_detail_is_cached(self):
+        product = self.create_products(1)[0]
+        url = '/api/products/{}/'.format(product.slug)
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(first.data, second.data)
+
+    def test_detail_is_invalidated_only_by_related_rows(self):
+        first, second = self.create_products(2)
+        other_genre = Genre.objects.create(name='Jazz', slug='jazz')
+        Product.objects.filter(id=second.id).update(genre=other_genre)
+        url = '/api/products/{}/'.format(first.slug)
+        self.client.get(url)
+        other_genre.name = 'Jazz tradycyjny'
+        other_genre.save()
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.genre.name = 'Rock progresywny'
+        self.genre.save()
+        self.assertEqual(self.client.get(url).data['genre']['name'], 'Rock progresywny')
+
+    def test_detail_is_invalidated_on_tag_change(self):
+        product = self.create_products(1)[0]
+        url = '/api/products/{}/'.format(product.slug)
+        self.client.get(url)
+        product.tags.add('nowosc')
+        self.assertIn('nowosc', self.client.get(url).data['tags'])
+        tag = product.tags.get(name='rock')
+        tag.name = 'rock-and-roll'
+        tag.save()
+        self.assertIn('rock-and-roll', self.client.get(url).data['tags'])
+
+
+class ConditionalGetTest(StoreTestCase):
+
+    def test_product_detail_etag(self):
+        product = self.create_products(1)[0]
+        url = '/api/products/{}/'.format(product.slug)
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        product.price = Decimal('50.00')
+        product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_product_detail_etag_without_cached_entry(self):
+        product = self.create_products(1)[0]
+        url = '/api/products/{}/'.format(product.slug)
+        etag = self.client.get(url)['ETag']
+        cache.delete(get_product_cache_key(APIRequestFactory().get(url), product.slug))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_product_list_etag(self):
+        self.create_products(3)
+        etag = self.client.get('/api/products/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get('/api/products/', {'page_size': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_reviews_validators(self):
+        product = self.create_products(1)[0]
+        older = Review.objects.create(author=self.user.profile, product=product, text='Dobra płyta', rate=5)
+        newer = Review.objects.create(author=self.user.profile, product=product, text='Świetna płyta', rate=4)
+
+        def get(etag):
+            return self.client.get('/api/reviews/', {'product': product.slug}, HTTP_IF_NONE_MATCH=etag)
+
+        etag = self.client.get('/api/reviews/', {'product': product.slug})['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(get(etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertNotIn('Last-Modified', get(etag))
+        # Reviews of other products don't change the validators.
+        other = self.create_products(1, slug='inny')[0]
+        Review.objects.create(author=self.user.profile, product=other, text='Inna płyta')
+        self.assertEqual(get(etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Neither of these moves the newest `updated` of active reviews forward.
+        older.is_active = False
+        older.save()
+        response = get(etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        self.user.first_name = 'Jan'
+        self.user.save()
+        response = get(response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['author']['user']['first_name'], 'Jan')
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(get(response['ETag']).status_code, status.HTTP_304_NOT_MODIFIED)
+        newer.delete()
+        response = get(response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 0)
+
+
+class ProductSearchTest(StoreTestCase):
+
+    def search(self, query, **params):
+        params['q'] = query
+        return [product['slug'] for product in self.client.get('/api/products/', params).data['results']]
+
+    def test_normalize(self):
+        self.assertEqual(normalize('Płyty z muzyką ZESPOŁÓW'), ['plyt', 'muzyk', 'zespol'])
+        self.assertEqual(normalize('płytami'), normalize('płyta'))
+
+    def test_ranking(self):
+        in_title, in_description = self.create_products(2, tags=())
+        in_title.title = 'Jazzowe ballady'
+        in_title.save()
+        in_description.description = 'Album z balladami'
+        in_description.save()
+        self.assertEqual(self.search('ballada'), [in_title.slug, in_description.slug])
+
+    def test_searches_related_names_and_tags(self):
+        first, second = self.create_products(2, tags=())
+        first.tags.add('Muzyka filmowa')
+        other_artist = Artist.objects.create(name='Czesław Niemen', slug='czeslaw-niemen')
+        second.artist = other_artist
+        second.save()
+        self.assertEqual(self.search('filmowej muzyki'), [first.slug])
+        self.assertEqual(self.search('czeslaw niemen'), [second.slug])
+        other_artist.name = 'Niemen Enigmatic'
+        other_artist.save()
+        self.assertEqual(self.search('enigmatic'), [second.slug])
+
+    def test_combines_with_filters(self):
+        products = self.create_products(4, tags=())
+        for product in products:
+            product.description = 'Rockowa klasyka'
+            product.save()
+        self.assertEqual(self.search('klasyka', max_price=11), [products[1].slug, products[0].slug])
+        self.assertEqual(self.search('klasyka', ordering='-price'), [p.slug for p in reversed(products)])
+
+    def test_relevance_is_not_paged_with_cursor(self):
+        products = self.create_products(3, tags=())
+        response = self.client.get('/api/products/', {'q': 'album', 'cursor': ''})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('wyszukiwania', response.data['cursor'])
+        # An explicit ordering has a keyset, the search only narrows the products.
+        response = self.client.get('/api/products/', {'q': 'album', 'cursor': '', 'ordering': 'price'})
+        self.assertEqual([product['slug'] for product in response.data['results']], [p.slug for p in products])
+
+    def test_index_is_updated_incrementally(self):
+        product = self.create_products(1, tags=())[0]
+        product.title = 'Nowy tytuł'
+        product.save()
+        self.assertEqual(self.search('album'), [])
+        self.assertEqual(self.search('tytul'), [product.slug])
+        self.assertFalse(SearchTerm.objects.filter(term='album').exists())
+
+    def test_related_changes_are_reindexed(self):
+        products = self.create_products(3, tags=('winyl',))
+        self.genre.name = 'Muzyka dawna'
+        self.genre.save()
+        self.assertEqual(len(self.search('dawna')), 3)
+        self.assertEqual(len(self.search('winyl')), 3)
+        Tag.objects.get(name='winyl').delete()
+        self.assertEqual(self.search('winyl'), [])
+        self.assertEqual(reindex_in_batches(Product.objects.filter(id__in=[p.id for p in products]), 2), 3)
+
+    def test_rebuild_command(self):
+        self.create_products(3, tags=())
+        SearchTerm.objects.all().delete()
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(len(self.search('album')), 3)
+
+
+class ProductFacetsTest(StoreTestCase):
+
+    def setUp(self):
+        super(ProductFacetsTest, self).setUp()
+        jazz = Genre.objects.create(name='Jazz', slug='jazz')
+        vinyl = Medium.objects.create(name='Winyl')
+        self.create_products(3, tags=('rock',))
+        self.create_products(2, tags=('jazz', 'winyl'), genre=jazz, medium_type=vinyl, label=None,
+                             price=Decimal('60.00'), title='Jazz', slug='jazz')
+
+    def test_counts(self):
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/products/facets/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['genre'], [{'slug': 'rock', 'name': 'Rock', 'count': 3},
+                                                  {'slug': 'jazz', 'name': 'Jazz', 'count': 2}])
+        self.assertEqual(response.data['medium_type'], [{'name': 'CD', 'count': 3},
+                                                        {'name': 'Winyl', 'count': 2}])
+        self.assertEqual(response.data['label'], [{'slug': 'wytwornia', 'name': 'Wytwórnia',
+                                                   'count': 3}])
+        self.assertEqual({tag['name']: tag['count'] for tag in response.data['tags']},
+                         {'rock': 3, 'jazz': 2, 'winyl': 2})
+        self.assertEqual([bucket['count'] for bucket in response.data['price']], [3, 0, 2, 0, 0])
+
+    def test_facet_ignores_its_own_filter(self):
+        response = self.client.get('/api/products/facets/', {'genre': 'jazz'})
+        self.assertEqual(len(response.data['genre']), 2)
+        self.assertEqual(response.data['medium_type'], [{'name': 'Winyl', 'count': 2}])
+        self.assertEqual([bucket['count'] for bucket in response.data['price']], [0, 0, 2, 0, 0])
+
+    def test_combines_with_search(self):
+        response = self.client.get('/api/products/facets/', {'q': 'jazz', 'max_price': 100})
+        self.assertEqual(response.data['genre'], [{'slug': 'jazz', 'name': 'Jazz', 'count': 2}])
+
+    def test_is_cached_and_invalidated(self):
+        self.client.get('/api/products/facets/')
+        with self.assertNumQueries(0):
+            self.client.get('/api/products/facets/')
+        self.create_products(1, tags=(), slug='nowy')
+        response = self.client.get('/api/products/facets/')
+        self.assertEqual(response.data['genre'][0]['count'], 4)
+
+
+class ReviewThreadTest(StoreTestCase):
+
+    def setUp(self):
+        super(ReviewThreadTest, self).setUp()
+        self.product = self.create_products(1)[0]
+        self.authenticate()
+
+    def post_review(self, text, parent=None, rate=None):
+        data = {'product': self.product.slug, 'text': text, 'parent': parent, 'rate': rate}
+        response = self.client.post('/api/reviews/', data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def test_paths(self):
+        root = self.post_review('Korzeń', rate=5)
+        reply = self.post_review('Odpowiedź', parent=root)
+        root_review, reply_review = Review.objects.get(id=root), Review.objects.get(id=reply)
+        self.assertEqual(reply_review.depth, 1)
+        self.assertTrue(reply_review.path.startswith(root_review.path))
+        self.assertEqual(reply_review.parent_path, root_review.path)
+
+    def test_threaded_list(self):
+        first = self.post_review('Pierwszy')
+        second = self.post_review('Drugi')
+        first_reply = self.post_review('Odpowiedź 1', parent=first)
+        nested_reply = self.post_review('Odpowiedź 1.1', parent=first_reply)
+        self.post_review('Odpowiedź 1.1.1', parent=nested_reply)
+        self.post_review('Odpowiedź 2', parent=first)
+        response = self.client.get('/api/reviews/', {'product': self.product.slug, 'threaded': 1, 'depth': 2})
+        self.assertEqual(response.data['count'], 2)
+        second_data, first_data = response.data['results']
+        self.assertEqual(second_data['id'], second)
+        self.assertEqual(second_data['replies'], [])
+        self.assertEqual([reply['text'] for reply in first_data['replies']], ['Odpowiedź 1', 'Odpowiedź 2'])
+        nested = first_data['replies'][0]['replies'][0]
+        self.assertEqual(nested['text'], 'Odpowiedź 1.1')
+        self.assertEqual(nested['replies'], [])
+        self.assertEqual(nested['replies_count'], 1)
+
+    def test_children_limit_and_root(self):
+        root = self.post_review('Korzeń')
+        for i in range(3):
+            self.post_review('Odpowiedź {}'.format(i), parent=root)
+        response = self.client.get('/api/reviews/', {'threaded': 1, 'root': root, 'children': 2})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['replies_count'], 3)
+        self.assertEqual(len(response.data['results'][0]['replies']), 2)
+
+    def test_hot_thread_loads_only_shown_replies(self):
+        root = Review.objects.create(author=self.user.profile, product=self.product, text='Korzeń')
+        for i in range(6):
+            reply = Review.objects.create(author=self.user.profile, product=self.product, parent=root,
+                                          text='Odpowiedź {}'.format(i), is_active=i != 1)
+            for j in range(3):
+                Review.objects.create(author=self.user.profile, product=self.product, parent=reply,
+                                      text='Odpowiedź {}.{}'.format(i, j))
+        params = {'threaded': 1, 'root': root.id, 'children': 2, 'depth': 2}
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/reviews/', params)
+        thread = response.data['results'][0]
+        self.assertEqual(thread['replies_count'], 5)
+        # The inactive reply is skipped, the next one takes its place.
+        self.assertEqual([reply['text'] for reply in thread['replies']], ['Odpowiedź 0', 'Odpowiedź 2'])
+        self.assertEqual([[nested['text'] for nested in reply['replies']] for reply in thread['replies']],
+                         [['Odpowiedź 0.0', 'Odpowiedź 0.1'], ['Odpowiedź 2.0', 'Odpowiedź 2.1']])
+        self.assertEqual([reply['replies_count'] for reply in thread['replies']], [3, 3])
+        # Twice as many replies on every level cost no more queries.
+        for reply in Review.objects.filter(parent__isnull=False):
+            Review.objects.create(author=self.user.profile, product=self.product, parent=reply, text='Więcej')
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.client.get('/api/reviews/', params)
+
+    def test_rebuild_command(self):
+        root = self.post_review('Korzeń')
+        reply = self.post_review('Odpowiedź', parent=root)
+        expected = Review.objects.get(id=reply).path
+        Review.objects.update(path='', depth=0)
+        call_command('rebuild_review_paths', stdout=StringIO())
+        self.assertEqual(Review.objects.get(id=reply).path, expected)
+
+
+class ProductRatingTest(StoreTestCase):
+
+    def setUp(self):
+        super(ProductRatingTest, self).setUp()
+        self.product = self.create_products(1)[0]
+
+    def review(self, rate, **kwargs):
+        return Review.objects.create(author=self.user.profile, product=self.product, text='Opinia', rate=rate, **kwargs)
+
+    def rating(self):
+        return ProductRating.objects.get(product=self.product)
+
+    def test_summary_is_maintained(self):
+        first = self.review(5)
+        self.review(4)
+        self.review(4)
+        self.review(None)
+        Review.objects.create(author=self.user.profile, product=self.product, text='Odpowiedź', parent=first)
+        rating = self.rating()
+        self.assertEqual((rating.count, rating.total, rating.average), (3, 13, Decimal('4.33')))
+        self.assertEqual(list(rating.get_distribution().values()), [0, 0, 0, 2, 1])
+
+        first = Review.objects.get(id=first.id)
+        first.is_active = False
+        first.save()
+        self.assertEqual((self.rating().count, self.rating().average), (2, Decimal('4.00')))
+        first.is_active = True
+        first.save()
+        self.assertEqual(self.rating().count, 3)
+        Review.objects.filter(rate=4).delete()
+        rating = self.rating()
+        self.assertEqual((rating.count, rating.rate_4, rating.average), (1, 0, Decimal('5.00')))
+
+    def test_detail_exposes_rating(self):
+        self.review(5)
+        self.review(2)
+        response = self.client.get('/api/products/{}/'.format(self.product.slug))
+        self.assertEqual(response.data['rating']['count'], 2)
+        self.assertEqual(response.data['rating']['average'], '3.50')
+        self.assertEqual(response.data['rating']['distribution'], {1: 0, 2: 1, 3: 0, 4: 0, 5: 1})
+
+    def test_filter_and_ordering(self):
+        other = self.create_products(1, slug='inny')[0]
+        self.review(5)
+        Review.objects.create(author=self.user.profile, product=other, text='Słaba', rate=2)
+        response = self.client.get('/api/products/', {'ordering': '-rating'})
+        self.assertEqual([p['slug'] for p in response.data['results']], [self.product.slug, other.slug])
+        response = self.client.get('/api/products/', {'min_rating': 3})
+        self.assertEqual([p['slug'] for p in response.data['results']], [self.product.slug])
+
+    def test_rebuild_command(self):
+        self.review(5)
+        self.review(3)
+        ProductRating.objects.all().delete()
+        call_command('rebuild_product_ratings', stdout=StringIO())
+        rating = self.rating()
+        self.assertEqual((rating.count, rating.total, rating.rate_3, rating.average), (2, 8, 1, Decimal('4.00')))
+
+
+class QueryBudgetTest(StoreTestCase):
+    """
+    Every endpoint of store/urls.py called with growing page sizes (or order sizes) must run the same, budgeted
+    number of queries. A query count which grows with the size means an N+1 somewhere in the serializers.
+    """
+    sizes = (1, 8, 32)
+
+    def setUp(self):
+        super(QueryBudgetTest, self).setUp()
+        self.products = self.create_products(max(self.sizes))
+        other_user = User.objects.create_user('inny', 'inny@example.com', 'haslo1234')
+        for i, product in enumerate(self.products):
+            author = self.user.profile if i % 2 else other_user.profile
+            review = Review.objects.create(author=author, product=product, text='Opinia', rate=i % 5 + 1)
+            Review.objects.create(author=self.user.profile, product=product, text='Odpowiedź', parent=review)
+            Review.objects.create(author=self.user.profile, product=self.products[0], text='Opinia {}'.format(i))
+        self.orders = {size: self.create_order(self.products[:size]) for size in self.sizes}
+        for _ in range(max(self.sizes) - 1):
+            self.create_order(self.products[:1])
+        self.authenticate()
+
+    def count_queries(self, request):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = request()
+            # Streamed responses run their queries while the content is read.
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertLess(response.status_code, 300, content)
+        return len(context.captured_queries)
+
+    def assertQueryBudget(self, budget, request, prepare=None):
+        # `prepare(size)` makes the data of a size before the queries are counted.
+        counts = {}
+        for size in self.sizes:
+            if prepare is not None:
+                prepare(size)
+            counts[size] = self.count_queries(lambda: request(size))
+        self.assertEqual(len(set(counts.values())), 1, 'Query count grows with size: {}'.format(counts))
+        self.assertLessEqual(counts[self.sizes[0]], budget, 'Query budget exceeded: {}'.format(counts))
+
+    def test_product_list(self):
+        # token + count + page + products + tags
+        self.assertQueryBudget(5, lambda size: self.client.get('/api/products/', {'page_size': size}))
+        self.assertQueryBudget(4, lambda size: self.client.get('/api/products/', {'page_size': size, 'cursor': ''}))
+        self.assertQueryBudget(5, lambda size: self.client.get('/api/products/', {'page_size': size, 'q': 'album'}))
+
+    def test_product_facets(self):
+        # token + one query per facet
+        self.assertQueryBudget(6, lambda size: self.client.get('/api/products/facets/', {'max_price': size + 10}))
+
+    def test_product_detail(self):
+        # token + product + tags
+        self.assertQueryBudget(3, lambda size: self.client.get('/api/products/{}/'.format(
+            self.products[size - 1].slug)))
+
+    @override_settings(CATALOG_FEED_KEYS=['klucz-partnera'], CATALOG_FEED_CHUNK_SIZE=max(sizes))
+    def test_product_feed(self):
+        since = timezone.now() + timedelta(days=1)
+
+        def change(size):
+            Product.objects.update(updated=since - timedelta(days=2))
+            Product.objects.filter(id__in=[product.id for product in self.products[:size]]).update(updated=since)
+
+        # token + chunk + tags + empty chunk after the last one
+        self.assertQueryBudget(4, lambda size: self.client.get('/api/products/feed/', {'since': since.isoformat()},
+                                                               HTTP_X_FEED_KEY='klucz-partnera'), change)
+
+    def test_reviews(self):
+        product = self.products[0].slug
+        # token + validators + count + reviews
+        self.assertQueryBudget(4, lambda size: self.client.get('/api/reviews/', {'page_size': size}))
+        self.assertQueryBudget(4, lambda size: self.client.get('/api/reviews/', {'page_size': size,
+                                                                                 'product': product}))
+        # token + count + roots + replies + replies count, one more query per level of replies shown
+        self.assertQueryBudget(5, lambda size: self.client.get('/api/reviews/', {'page_size': size,
+                                                                                 'threaded': 1, 'depth': 1}))
+
+    def test_orders(self):
+        # token + profile + orders, every size is a full page of the orders made in setUp
+        self.assertQueryBudget(3, lambda size: self.client.get('/api/orders/', {'page_size': size}))
+        self.assertQueryBudget(3, lambda size: self.client.get('/api/orders/', {'page_size': size,
+                                                                                'state': Order.ORDERED}))
+        # token + profile + order + items + tags
+        self.assertQueryBudget(5, lambda size: self.client.get('/api/orders/{}/'.format(self.orders[size].id)))
+
+    def test_order_create(self):
+        def create(size):
+            return self.client.post('/api/orders/new/', {
+                'shipping': self.shipping.slug, 'payment': self.payment.slug, 'address': 'Ulica 1',
+                'zip_code': '00-001', 'city': 'Warszawa',
+                'items': [{'product': product.slug, 'quantity': 1} for product in self.products[:size]]})
+        # token + products + shipping + payment + profile + reservations + stock lock + stock update + order + items
+        # + response items, and four savepoint statements
+        self.assertQueryBudget(15, create)
+
+    def test_reservations(self):
+        reservations = {}
+
+        def reserve(size, count=None):
+            Reservation.objects.all().delete()
+            for product in self.products[:size if count is None else count]:
+                reservations[size] = Reservation.objects.reserve(self.user.profile, product.id, 1).id
+
+        def create(size):
+            return self.client.post('/api/reservations/', {'product': self.products[size - 1].slug, 'quantity': 1})
+
+        # token + profile + reservations
+        self.assertQueryBudget(3, lambda size: self.client.get('/api/reservations/'), reserve)
+        # token + product + profile + reservation lock + stock lock + stock update + reservation update + reservation,
+        # and four savepoint statements
+        self.assertQueryBudget(12, create, reserve)
+        # The first reservation of a product adds the insert and its savepoint.
+        self.assertQueryBudget(15, create, lambda size: reserve(size, size - 1))
+        # token + profile + reservation lock + quantities + stock lock + stock update + delete, and four savepoint
+        # statements
+        self.assertQueryBudget(11, lambda size: self.client.delete('/api/reservations/{}/'.format(reservations[size])),
+                               reserve)
+
+    def test_profile(self):
+        # token + profile
+        self.assertQueryBudget(2, lambda size: self.client.get('/api/profile/'))
+
+
+@override_settings(REQUEST_INSTRUMENTATION=True, REQUEST_INSTRUMENTATION_SLOW_MS=0,
+                   REQUEST_INSTRUMENTATION_SAMPLE_RATE=1)
+class RequestInstrumentationTest(StoreTestCase):
+
+    def test_server_timing(self):
+        self.create_products(3)
+        with self.assertLogs('store.instrumentation', 'INFO') as logs:
+            response = self.client.get('/api/products/')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="4 queries"', response['Server-Timing'])
+        self.assertIn('render;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'store.views.ProductListView')
+        self.assertEqual(record['queries'], 4)
+
+    def test_slow_request_reports_repeated_sql(self):
+        products = self.create_products(3)
+
+        def n_plus_one_view(request):
+            for product in products:
+                Product.objects.get(id=product.id)
+            return HttpResponse()
+
+        middleware = RequestInstrumentationMiddleware(n_plus_one_view)
+        with self.assertLogs('store.instrumentation', 'WARNING') as logs:
+            middleware(APIRequestFactory().get('/api/products/'))
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['queries'], 3)
+        self.assertEqual(record['repeated_sql'][0]['count'], 3)
+        self.assertIn('WHERE "store_product"."id" = ?', record['repeated_sql'][0]['sql'])
+
+    def test_serializer_time_is_reported_apart_from_view(self):
+        class SlowSerializer(serializers.Serializer):
+            def to_representation(self, instance):
+                sleep(0.05)
+                return {}
+
+        def serializing_view(request):
+            return HttpResponse(json.dumps(SlowSerializer([1, 2], many=True).data))
+
+        middleware = RequestInstrumentationMiddleware(serializing_view)
+        with self.assertLogs('store.instrumentation', 'INFO') as logs:
+            response = middleware(APIRequestFactory().get('/api/products/'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertGreaterEqual(record['serializer_ms'], 100)
+        self.assertLess(record['view_ms'], 50)
+        self.assertIn('serializer;dur=', response['Server-Timing'])
+
+    @override_settings(CATALOG_FEED_KEYS=['klucz-partnera'], CATALOG_FEED_CHUNK_SIZE=2)
+    def test_streamed_response_is_reported_when_consumed(self):
+        self.create_products(3)
+        with self.assertLogs('store.instrumentation', 'INFO') as logs:
+            response = self.client.get('/api/products/feed/', HTTP_X_FEED_KEY='klucz-partnera')
+            self.assertEqual(logs.records, [])
+            b''.join(response.streaming_content)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'store.views.ProductFeedView')
+        # keyset chunks of 2 + tags of each chunk, content type
+        self.assertEqual(record['queries'], 5)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_is_the_first_middleware(self):
+        self.assertEqual(settings.MIDDLEWARE[0], 'store.middleware.RequestInstrumentationMiddleware')
+
+    def test_normalize_sql(self):
+        self.assertEqual(normalize_sql("SELECT * FROM a WHERE id IN (1, 2, 3) AND name = 'x''y' AND v = 1.5"),
+                         'SELECT * FROM a WHERE id IN (...) AND name = ? AND v = ?')
+
+    @override_settings(REQUEST_INSTRUMENTATION=False)
+    def test_disabled(self):
+        response = self.client.get('/api/products/')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class FailingEmailBackend(BaseEmailBackend):
+
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP niedostępny')
+
+
+class UnreachableEmailBackend(BaseEmailBackend):
+
+    def open(self):
+        raise ConnectionRefusedError('SMTP niedostępny')
+
+    def send_messages(self, email_messages):
+        raise AssertionError('Połączenie nie zostało otwarte')
+
+
+class EmailOutboxTest(StoreTestCase):
+
+    def setUp(self):
+        super(EmailOutboxTest, self).setUp()
+        self.payment = Payment.objects.create(name='Przelew', slug='przelew-bankowy')
+        BankInfo.objects.create(name='Music Shop', account='12 3456', address='Ulica 1, Warszawa')
+
+    def create_order_with_transfer(self):
+        product = self.create_products(1)[0]
+        self.authenticate()
+        data = {'shipping': self.shipping.slug, 'payment': self.payment.slug, 'address': 'Ulica 1',
+                'zip_code': '00-001', 'city': 'Warszawa', 'items': [{'product': product.slug, 'quantity': 1}]}
+        return self.client.post('/api/orders/new/', data)
+
+    def test_order_queues_email(self):
+        response = self.create_order_with_transfer()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['info']['account'], '12 3456')
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.to, 'klient@example.com')
+        self.assertIn(str(Order.objects.get().code), email.body)
+        self.assertEqual(mail.outbox, [])
+
+    def test_sends_once(self):
+        self.create_order_with_transfer()
+        call_command('send_queued_emails', stdout=StringIO())
+        call_command('send_queued_emails', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        email = OutgoingEmail.objects.get()
+        self.assertIsNotNone(email.sent)
+        self.assertEqual(mail.outbox[0].extra_headers['Message-ID'], '<outbox-{}@music-shop.com>'.format(email.id))
+
+    def test_batch_uses_one_connection(self):
+        OutgoingEmail.objects.bulk_create([OutgoingEmail(subject='Temat', body='Treść', from_email='sklep@example.com',
+                                                         to='klient{}@example.com'.format(i)) for i in range(5)])
+        # savepoint + claim + lease update + release + one update per email
+        with self.assertNumQueries(9):
+            self.assertEqual(send_queued_emails(batch_size=5), (5, 0))
+        self.assertEqual(len(mail.outbox), 5)
+
+    @override_settings(EMAIL_BACKEND='store.tests.FailingEmailBackend')
+    def test_failure_is_retried_later(self):
+        self.create_order_with_transfer()
+        self.assertEqual(send_queued_emails(), (0, 1))
+        email = OutgoingEmail.objects.get()
+        self.assertIsNone(email.sent)
+        self.assertEqual(email.attempts, 1)
+        self.assertIn('SMTP', email.last_error)
+        self.assertGreater(email.next_attempt, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(send_queued_emails(), (0, 0))
+
+        OutgoingEmail.objects.update(next_attempt=timezone.now())
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            self.assertEqual(send_queued_emails(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_BACKEND='store.tests.UnreachableEmailBackend')
+    def test_unreachable_server_fails_whole_batch(self):
+        OutgoingEmail.objects.bulk_create([OutgoingEmail(subject='Temat', body='Treść', from_email='sklep@example.com',
+                                                         to='klient{}@example.com'.format(i)) for i in range(3)])
+        OutgoingEmail.objects.filter(to='klient0@example.com').update(attempts=2)
+        self.assertEqual(send_queued_emails(), (0, 3))
+        emails = OutgoingEmail.objects.order_by('to')
+        self.assertEqual([email.attempts for email in emails], [3, 1, 1])
+        self.assertTrue(all('SMTP' in email.last_error and email.sent is None for email in emails))
+        # Backoff grows with the attempts, the lease is replaced by the retry delay.
+        self.assertGreater(emails[0].next_attempt, timezone.now() + timedelta(seconds=230))
+        self.assertLess(emails[1].next_attempt, timezone.now() + timedelta(seconds=70))
+
+
+def make_image(size=(1600, 1000), image_format='PNG', mode='RGBA'):
+    output = BytesIO()
+    Image.new(mode, size, (200, 30, 30)).save(output, image_format)
+    return output.getvalue()
+
+
+class ImageRenditionsTest(StoreTestCase):
+
+    def setUp(self):
+        super(ImageRenditionsTest, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+        super(ImageRenditionsTest, self).tearDown()
+
+    def test_renditions_generated_on_save(self):
+        product = self.create_products(1)[0]
+        product.image.save('okladka.png', ContentFile(make_image()))
+        product.refresh_from_db()
+        self.assertEqual(product.renditions_source, product.image.name)
+        for rendition, size in (('retina', (1200, 750)), ('detail', (600, 375)), ('thumbnail', (200, 125))):
+            with default_storage.open(get_rendition_name(product.image.name, rendition)) as rendition_file:
+                image = Image.open(rendition_file)
+                self.assertEqual((image.format, image.size), ('JPEG', size))
+
+        response = self.client.get('/api/products/')
+        images = response.data['results'][0]['images']
+        self.assertEqual(list(images), ['thumbnail', 'detail', 'retina'])
+        self.assertTrue(images['thumbnail'].endswith('/media/renditions/thumbnail/okladka.jpg'))
+        response = self.client.get('/api/products/{}/'.format(product.slug))
+        self.assertTrue(response.data['images']['retina'].startswith('http://testserver/media/renditions/retina/'))
+
+    def test_without_renditions(self):
+        self.create_products(1)
+        self.assertIsNone(self.client.get('/api/products/').data['results'][0]['images'])
+
+    def test_backfill_command(self):
+        products = self.create_products(2)
+        for product in products:
+            default_storage.save('images/{}.jpg'.format(product.slug), ContentFile(make_image(image_format='JPEG',
+                                                                                               mode='RGB')))
+        # Images assigned without save(), like rows imported before renditions existed.
+        for product in products:
+            Product.objects.filter(id=product.id).update(image='images/{}.jpg'.format(product.slug))
+        call_command('generate_image_renditions', processes=2, stdout=StringIO())
+        for product in Product.objects.all():
+            self.assertEqual(product.renditions_source, product.image.name)
+            self.assertTrue(default_storage.exists(get_rendition_name(product.image.name, 'thumbnail')))
+
+    def test_decode_base64_image(self):
+        data = 'data:image/jpeg;base64,' + b64encode(make_image(image_format='JPEG', mode='RGB')).decode()
+        image_file = decode_base64_image(data)
+        self.assertTrue(image_file.name.endswith('.jpg'))
+        self.assertEqual(Image.open(image_file).size, (1600, 1000))
+
+    def test_decode_base64_image_limits(self):
+        with self.assertRaisesMessage(InvalidImage, 'Niepoprawny format zdjęcia.'):
+            decode_base64_image('data:image/png;base64,nie-base64')
+        with self.assertRaisesMessage(InvalidImage, 'Niepoprawny format zdjęcia.'):
+            decode_base64_image(b64encode(b'tekst').decode())
+        with self.settings(IMAGE_UPLOAD_MAX_SIZE=1024):
+            with self.assertRaisesMessage(InvalidImage, 'Zdjęcie jest za duże.'):
+                decode_base64_image(b64encode(make_image()).decode())
+        with self.settings(IMAGE_UPLOAD_MAX_PIXELS=1000):
+            with self.assertRaisesMessage(InvalidImage, 'Zdjęcie jest za duże.'):
+                decode_base64_image(b64encode(make_image(image_format='GIF', mode='P')).decode())
+
+
+class SlidingWindowThrottleTest(StoreTestCase):
+
+    def make_throttle(self, throttle_class, now):
+        throttle = throttle_class()
+        throttle.timer = lambda: now
+        return throttle
+
+    def check(self, throttle_class, now, count):
+        request = APIRequestFactory().get('/api/products/')
+        request.user = self.user
+        return [self.make_throttle(throttle_class, now).allow_request(request, None) for _ in range(count)]
+
+    def test_limit(self):
+        self.assertEqual(self.check(ProductListThrottle, 600, 21), [True] * 20 + [False])
+        # Rejected requests don't count, the previous window keeps half of its 20 requests in the sliding window.
+        self.assertEqual(self.check(ProductListThrottle, 690, 11), [True] * 10 + [False])
+        # A second before the end of the window, only 1/60 of the previous window is left.
+        self.assertEqual(self.check(ProductListThrottle, 719, 10), [True] * 9 + [False])
+        self.assertEqual(self.check(ProductListThrottle, 780, 20), [True] * 20)
+
+    def test_scopes_are_separate(self):
+        self.assertEqual(self.check(ProductListThrottle, 600, 21)[-1], False)
+        self.assertEqual(self.check(ProductDetailThrottle, 600, 30), [True] * 30)
+
+    def test_wait(self):
+        self.check(ProductListThrottle, 600, 20)
+        request = APIRequestFactory().get('/api/products/')
+        request.user = self.user
+        throttle = self.make_throttle(ProductListThrottle, 690)
+        for _ in range(10):
+            throttle.allow_request(request, None)
+        self.assertFalse(throttle.allow_request(request, None))
+        # One more request fits once the previous window's share drops from 10 to 9, i.e. after 5% of the window.
+        self.assertAlmostEqual(throttle.wait(), 3)
+
+    def test_view_is_throttled(self):
+        for _ in range(20):
+            self.assertEqual(self.client.get('/api/products/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/products/').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.client.options('/api/products/').status_code, status.HTTP_200_OK)
+
+
+class CatalogImportTest(StoreTestCase):
+
+    CSV = (
+        'title,artist,genre,label,medium,release_date,price,stock,tags,description\n'
+        'Dziwny jest ten świat,Czesław Niemen,Rock,Polskie Nagrania,Winyl,1967-01-01,59.99,5,"klasyka, polski rock",\n'
+        'Enigmatic,Czesław Niemen,Rock,Polskie Nagrania,CD,1970-01-01,39.99,10,klasyka,Album z Bema pamięci\n'
+        'Bez ceny,Czesław Niemen,Rock,,CD,1970-01-01,,10,,\n'
+    )
+
+    def import_file(self, content, suffix='.csv', **options):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, encoding='utf-8', delete=False) as source:
+            source.write(content)
+        self.addCleanup(os.remove, source.name)
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', source.name, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_csv(self):
+        out, err = self.import_file(self.CSV)
+        self.assertIn('Utworzono: 2, zaktualizowano: 0, błędy: 1', out)
+        self.assertIn('Wiersz 3: Brak pola price.', err)
+        vinyl = Product.objects.get(slug='czeslaw-niemen-dziwny-jest-ten-swiat-winyl')
+        self.assertEqual((vinyl.artist.slug, vinyl.label.name, vinyl.medium_type.name, vinyl.price, vinyl.stock),
+                         ('czeslaw-niemen', 'Polskie Nagrania', 'Winyl', Decimal('59.99'), 5))
+        self.assertEqual(vinyl.genre, self.genre)
+        self.assertEqual(sorted(vinyl.get_serializable_tags()), ['klasyka', 'polski rock'])
+        self.assertEqual(Artist.objects.filter(name='Czesław Niemen').count(), 1)
+        self.assertEqual(ProductRating.objects.filter(product__artist__slug='czeslaw-niemen').count(), 2)
+        response = self.client.get('/api/products/', {'q': 'bem niemen'})
+        self.assertEqual([product['title'] for product in response.data['results']], ['Enigmatic'])
+
+    def test_reimport_updates(self):
+        self.import_file(self.CSV)
+        jsonl = '\n'.join([
+            json.dumps({'title': 'Enigmatic', 'artist': 'Czesław Niemen', 'genre': 'Rock', 'medium': 'CD',
+                        'release_date': '1970-01-01', 'price': '29.99', 'stock': 3, 'tags': ['jazz']}),
+            'nie json',
+        ])
+        out, err = self.import_file(jsonl, suffix='.jsonl')
+        self.assertIn('Utworzono: 0, zaktualizowano: 1, błędy: 1', out)
+        product = Product.objects.get(title='Enigmatic')
+        self.assertEqual((product.price, product.stock, product.label), (Decimal('29.99'), 3, None))
+        self.assertEqual(product.get_serializable_tags(), ['jazz'])
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(self.client.get('/api/products/', {'q': 'klasyka'}).data['count'], 1)
+
+    def test_dry_run(self):
+        out, err = self.import_file(self.CSV, dry_run=True)
+        self.assertIn('Bez zapisu. Utworzono: 2', out)
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(Artist.objects.filter(slug='czeslaw-niemen').exists())
+
+    def test_dry_run_forgets_rolled_back_ids(self):
+        importer = CatalogImporter(chunk_size=1, dry_run=True)
+        importer.run(read_csv(StringIO(self.CSV)))
+        self.assertEqual(importer.created, 2)
+        self.assertEqual(importer.related[Artist], {})
+        self.assertEqual((importer.media, importer.tags), ({}, {}))
+
+    def test_make_slug(self):
+        self.assertEqual(make_slug('Czesław Niemen', 'Łąka żółć'), 'czeslaw-niemen-laka-zolc')
+
+    def test_colliding_slugs_get_suffixes(self):
+        admin_product = self.create_products(1, title='Enigmatic', slug='czeslaw-niemen-enigmatic-cd')[0]
+        header, row = self.CSV.splitlines()[:2]
+        content = '\n'.join([header] + [
+            'Enigmatic,Czesław Niemen,Rock,,CD,{},39.99,10,,'.format(release_date)
+            for release_date in ('1970-01-01', '1975-01-01', '1970-01-01')
+        ] + ['Enigmatic!,Czesław Niemen,Rock,,CD,1980-01-01,39.99,10,,'])
+        out, _ = self.import_file(content)
+        # The repeated row is the same product, the rest differ from each other and from the product of the admin.
+        self.assertIn('Utworzono: 3, zaktualizowano: 0', out)
+        slugs = Product.objects.exclude(id=admin_product.id).order_by('slug').values_list('slug', flat=True)
+        self.assertEqual(list(slugs), ['czeslaw-niemen-enigmatic-cd-2', 'czeslaw-niemen-enigmatic-cd-3',
+                                       'czeslaw-niemen-enigmatic-cd-4'])
+        self.assertEqual(Product.objects.get(id=admin_product.id).price, admin_product.price)
+        out, _ = self.import_file(content.replace('39.99', '19.99'))
+        self.assertIn('Utworzono: 0, zaktualizowano: 3', out)
+        self.assertEqual(Product.objects.filter(price=Decimal('19.99')).count(), 3)
+
+    def test_errors_are_sampled(self):
+        content = self.CSV.splitlines()[0] + '\n' + 'Bez ceny,Czesław Niemen,Rock,,CD,1970-01-01,,10,,\n' * 30
+        out, err = self.import_file(content)
+        self.assertIn('błędy: 30', out)
+        self.assertEqual(len(err.splitlines()), 20)
+
+
+@override_settings(CATALOG_FEED_KEYS=['klucz-partnera'], CATALOG_FEED_CHUNK_SIZE=2)
+class ProductFeedTest(StoreTestCase):
+
+    def get_feed(self, **params):
+        response = self.client.get('/api/products/feed/', params, HTTP_X_FEED_KEY='klucz-partnera')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, b''.join(response.streaming_content).decode('utf-8')
+
+    def test_permissions(self):
+        self.assertEqual(self.client.get('/api/products/feed/').status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get('/api/products/feed/', HTTP_X_FEED_KEY='zly-klucz')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.authenticate()
+        self.assertEqual(self.client.get('/api/products/feed/').status_code, status.HTTP_403_FORBIDDEN)
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        self.assertEqual(self.client.get('/api/products/feed/').status_code, status.HTTP_200_OK)
+
+    def test_ndjson(self):
+        self.create_products(5)
+        # keyset chunks of 2 + tags of each chunk, content type
+        with self.assertNumQueries(7):
+            response, content = self.get_feed()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['slug'] for row in rows], ['album-{}'.format(i) for i in range(5)])
+        self.assertEqual((rows[0]['artist'], rows[0]['label'], rows[0]['price'], rows[0]['tags']),
+                         ('Artysta', 'Wytwórnia', '10.00', ['rock', 'winyl']))
+
+    def test_csv(self):
+        self.create_products(3, tags=('jazz',))
+        response, content = self.get_feed(format='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual([row['title'] for row in rows], ['Album 0', 'Album 1', 'Album 2'])
+        self.assertEqual((rows[0]['genre_slug'], rows[0]['tags']), ('rock', 'jazz'))
+        response, content = self.get_feed(format='csv', since=response['X-Feed-Next-Since'])
+        self.assertEqual(content.splitlines(), [','.join(CSV_FIELDS)])
+
+    def test_incremental(self):
+        products = self.create_products(4)
+        response, content = self.get_feed()
+        since = response['X-Feed-Next-Since']
+        self.assertEqual(self.get_feed(since=since)[1], '')
+
+        products[2].price = Decimal('5.00')
+        products[2].save()
+        Product.objects.filter(id=products[0].id).decrement_stock({products[0].id: 1})
+        self.genre.name = 'Rock progresywny'
+        self.genre.save()
+        self.assertEqual(len(self.get_feed(since=since)[1].splitlines()), 4)
+
+        since = self.get_feed()[0]['X-Feed-Next-Since']
+        products[3].tags.add('nowy')
+        rows = [json.loads(line) for line in self.get_feed(since=since)[1].splitlines()]
+        self.assertEqual([row['slug'] for row in rows], ['album-3'])
+        self.assertIn('nowy', rows[0]['tags'])
+
+    def test_invalid_params(self):
+        response = self.client.get('/api/products/feed/', {'since': 'wczoraj'}, HTTP_X_FEED_KEY='klucz-partnera')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/api/products/feed/', {'format': 'xml'}, HTTP_X_FEED_KEY='klucz-partnera')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BenchmarkTest(StoreTestCase):
+
+    def test_seed_and_run(self):
+        call_command('seed_benchmark_data', products='40', stdout=StringIO())
+        self.assertEqual(Product.objects.count(), 40)
+        self.assertEqual(Review.objects.filter(path='').count(), 0)
+        self.assertTrue(Order.objects.filter(items__isnull=False, total_price__isnull=False).exists())
+        orders = Order.objects.count()
+
+        out = StringIO()
+        call_command('run_benchmark', requests=3, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['meta']['products'], 40)
+        self.assertGreaterEqual(len(report['scenarios']), 20)
+        for name, result in report['scenarios'].items():
+            self.assertEqual(result['errors'], 0, name)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        # The run is rolled back.
+        self.assertEqual(Order.objects.count(), orders)
+
+    def test_order_codes_follow_the_seed(self):
+        self.assertEqual(DataGenerator(10, seed=1).make_code(), DataGenerator(10, seed=1).make_code())
+        self.assertNotEqual(DataGenerator(10, seed=1).make_code(), DataGenerator(10, seed=2).make_code())
+
+
+class RequestProfilingTest(StoreTestCase):
+
+    def setUp(self):
+        super(RequestProfilingTest, self).setUp()
+        self.profile_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(REQUEST_PROFILING=True, REQUEST_PROFILING_DIR=self.profile_dir,
+                                                   REQUEST_PROFILING_SAMPLE_INTERVAL=0.0001)
+        self.settings_override.enable()
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        self.create_products(3)
+        self.authenticate()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.profile_dir)
+        super(RequestProfilingTest, self).tearDown()
+
+    def read_profile(self, response):
+        profile = RequestProfile.objects.get(id=response['X-Profile-Id'])
+        with open(get_profile_path(profile.file_name), 'rb') as f:
+            return profile, f.read()
+
+    def test_sampled_profile(self):
+        response = self.client.get('/api/products/', HTTP_X_PROFILE='sample')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile, data = self.read_profile(response)
+        self.assertEqual((profile.user, profile.mode, profile.path), (self.user, 'sample', '/api/products/'))
+        self.assertTrue(profile.file_name.endswith('.folded'))
+        self.assertIn(b'rest_framework.views:dispatch', data)
+        for line in data.decode().splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+            self.assertNotIn('store.profiling', stack)
+
+    def test_cprofile(self):
+        response = self.client.get('/api/products/', {'profile': 'cprofile'})
+        profile, data = self.read_profile(response)
+        self.assertEqual(profile.mode, 'cprofile')
+        stats = pstats.Stats(get_profile_path(profile.file_name))
+        self.assertTrue(any(name == 'render_page' and path.endswith('views.py') for path, line, name in stats.stats))
+
+    def test_only_staff_and_flagged_requests(self):
+        self.assertFalse(self.client.get('/api/products/').has_header('X-Profile-Id'))
+        User.objects.filter(id=self.user.id).update(is_staff=False)
+        self.assertFalse(self.client.get('/api/products/', HTTP_X_PROFILE='1').has_header('X-Profile-Id'))
+        self.client.credentials()
+        self.assertFalse(self.client.get('/api/products/', HTTP_X_PROFILE='1').has_header('X-Profile-Id'))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(REQUEST_PROFILING_MAX_PER_MINUTE=0)
+    def test_rate_limit(self):
+        response = self.client.get('/api/products/', HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Profile-Skipped'], 'limit')
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(REQUEST_PROFILING_MAX_PROFILES=1)
+    def test_retention(self):
+        self.client.get('/api/products/', HTTP_X_PROFILE='1')
+        response = self.client.get('/api/products/album-1/', HTTP_X_PROFILE='1')
+        self.assertEqual(list(RequestProfile.objects.values_list('id', flat=True)), [int(response['X-Profile-Id'])])
+        self.assertEqual(os.listdir(self.profile_dir), [RequestProfile.objects.get().file_name])
+
+    def test_admin_download(self):
+        response = self.client.get('/api/products/', HTTP_X_PROFILE='1')
+        profile, data = self.read_profile(response)
+        User.objects.filter(id=self.user.id).update(is_superuser=True)
+        self.client.force_login(self.user)
+        response = self.client.get('/admin/store/requestprofile/')
+        self.assertContains(response, profile.file_name)
+        response = self.client.get('/admin/store/requestprofile/{}/download/'.format(profile.id))
+        self.assertEqual(b''.join(response.streaming_content), data)
+        self.assertIn(profile.file_name, response['Content-Disposition'])
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(StoreTestCase):
+    """Runs against a second SQLite database playing the replica, its rows differ from the primary on purpose."""
+    copied_models = (ContentType, User, UserProfile, Genre, Artist, RecordLabel, Medium, Product, ProductRating, Tag,
+                     TaggedItem, Review)
+
+    def setUp(self):
+        super(ReplicaRoutingTest, self).setUp()
+        handle, self.replica_name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.replica_name}
+        call_command('migrate', database='replica', run_syncdb=True, verbosity=0)
+        self.product = self.create_products(1)[0]
+        ContentType.objects.using('replica').all().delete()
+        for model in self.copied_models:
+            model.objects.using('replica').bulk_create(model.objects.using('default').all())
+        ContentType.objects.clear_cache()
+        Product.objects.using('replica').update(title='Z repliki')
+
+    def tearDown(self):
+        connections['replica'].close()
+        del connections.databases['replica']
+        delattr(connections._connections, 'replica')
+        os.remove(self.replica_name)
+        ContentType.objects.clear_cache()
+        super(ReplicaRoutingTest, self).tearDown()
+
+    def test_catalog_reads_go_to_replica(self):
+        Review.objects.using('replica').create(author=self.user.profile, product=self.product, text='Opinia', rate=4)
+        self.assertEqual(self.client.get('/api/products/').data['results'][0]['title'], 'Z repliki')
+        self.assertEqual(self.client.get('/api/products/album-0/').data['title'], 'Z repliki')
+        self.assertEqual(self.client.get('/api/reviews/').data['count'], 1)
+        self.assertEqual(Review.objects.count(), 0)
+
+    def test_writer_is_pinned_to_primary(self):
+        self.authenticate()
+        response = self.client.post('/api/orders/new/', {
+            'shipping': self.shipping.slug, 'payment': self.payment.slug, 'address': 'Ulica 1', 'zip_code': '00-001',
+            'city': 'Warszawa', 'items': [{'product': self.product.slug, 'quantity': 1}]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(cache.get(get_user_pin_key(self.user)))
+        self.assertEqual(self.client.get('/api/products/album-0/').data['title'], 'Album 0')
+        self.client.credentials()
+        self.assertEqual(self.client.get('/api/products/', {'page_size': 10}).data['results'][0]['title'],
+                         'Z repliki')
+
+    @override_settings(REQUEST_INSTRUMENTATION=True)
+    def test_queries_by_alias(self):
+        self.authenticate()
+        with self.assertLogs('store.instrumentation', 'INFO') as logs:
+            self.client.get('/api/products/')
+            self.client.get('/api/products/', {'page_size': 10})
+        # The token is checked before the view picks the replica, the first request also loads content types and
+        # the fragments of the products.
+        self.assertEqual(json.loads(logs.records[1].getMessage())['queries_by_alias'], {'default': 1, 'replica': 2})
+
+
+class ProductFragmentsTest(StoreTestCase):
+
+    def get_titles_and_artists(self, **params):
+        response = self.client.get('/api/products/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(product['title'], product['artist']['name']) for product in response.json()['results']]
+
+    def test_page_matches_serializer(self):
+        self.create_products(3)
+        response = self.client.get('/api/products/')
+        request = APIRequestFactory().get('/api/products/')
+        products = Product.objects.select_related('genre', 'artist', 'medium_type').prefetch_related('tags')
+        data = ProductsListSerializer(products, many=True, context={'request': request}).data
+        self.assertEqual(response.json(), json.loads(json.dumps({'count': 3, 'next': None, 'previous': None,
+                                                                 'results': data})))
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_fragments_follow_related_changes(self):
+        self.create_products(2)
+        self.get_titles_and_artists()
+        self.artist.name = 'Inny artysta'
+        self.artist.save()
+        self.assertEqual(self.get_titles_and_artists(), [('Album 1', 'Inny artysta'), ('Album 0', 'Inny artysta')])
+        Tag.objects.get(name='winyl').delete()
+        response = self.client.get('/api/products/', {'page_size': 1})
+        self.assertEqual(response.json()['results'][0]['tags'], ['rock'])
+
+    def test_browsable_api(self):
+        self.create_products(1)
+        response = self.client.get('/api/products/', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'Album 0')
+
+
+class OrdersListTest(StoreTestCase):
+
+    def setUp(self):
+        super(OrdersListTest, self).setUp()
+        products = self.create_products(1)
+        self.orders = [self.create_order(products) for _ in range(5)]
+        other = User.objects.create_user('inny', 'inny@example.com', 'haslo1234')
+        Order.objects.create(user=other.profile, shipping=self.shipping, payment=self.payment, address='Ulica 1',
+                             zip_code='00-001', city='Warszawa')
+        self.authenticate()
+
+    def get_ids(self, **params):
+        response = self.client.get('/api/orders/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [order['id'] for order in response.data['results']]
+
+    def test_pages(self):
+        ids, url, params = [], '/api/orders/', {'page_size': 2}
+        while url:
+            # token + profile + page, no count
+            with self.assertNumQueries(3):
+                response = self.client.get(url, params)
+            self.assertNotIn('count', response.data)
+            ids.extend(order['id'] for order in response.data['results'])
+            url, params = response.data['next'], None
+        self.assertEqual(ids, [order.id for order in reversed(self.orders)])
+
+    def test_state_filter(self):
+        Order.objects.filter(id__in=[self.orders[0].id, self.orders[3].id]).update(state=Order.SEND)
+        self.assertEqual(self.get_ids(state=Order.SEND), [self.orders[3].id, self.orders[0].id])
+        self.assertEqual(len(self.get_ids(state=Order.ORDERED)), 3)
+
+    def test_date_filters(self):
+        now = timezone.now()
+        for i, order in enumerate(self.orders):
+            Order.objects.filter(id=order.id).update(created=now - timedelta(days=i))
+        today = timezone.localdate(now)
+        self.assertEqual(self.get_ids(created_from=today - timedelta(days=1)),
+                         [self.orders[0].id, self.orders[1].id])
+        self.assertEqual(self.get_ids(created_from=today - timedelta(days=3), created_to=today - timedelta(days=2)),
+                         [self.orders[2].id, self.orders[3].id])
+
+
+class OrderCancelTest(StoreTestCase):
+
+    def setUp(self):
+        super(OrderCancelTest, self).setUp()
+        self.products = self.create_products(3)
+        self.authenticate()
+
+    def test_cancel_restores_stock(self):
+        response = self.client.post('/api/orders/new/', {
+            'shipping': self.shipping.slug, 'payment': self.payment.slug, 'address': 'Ulica 1', 'zip_code': '00-001',
+            'city': 'Warszawa', 'items': [{'product': self.products[0].slug, 'quantity': 3},
+                                          {'product': self.products[1].slug, 'quantity': 1}]})
+        self.assertEqual(Product.objects.get(id=self.products[0].id).stock, 97)
+        response = self.client.delete('/api/orders/{}/'.format(response.data['id']))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {100})
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_paid_and_foreign_orders(self):
+        order = self.create_order(self.products)
+        Order.objects.filter(id=order.id).update(state=Order.PAID)
+        response = self.client.delete('/api/orders/{}/'.format(order.id))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        other = User.objects.create_user('inny', 'inny@example.com', 'haslo1234')
+        foreign = Order.objects.create(user=other.profile, shipping=self.shipping, payment=self.payment,
+                                       address='Ulica 1', zip_code='00-001', city='Warszawa')
+        response = self.client.delete('/api/orders/{}/'.format(foreign.id))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {100})
+
+    def test_statements_do_not_depend_on_order_count(self):
+        counts = []
+        for size in (1, 10):
+            for _ in range(size):
+                self.create_order(self.products, quantity=2)
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(len(Order.objects.all().cancel()), size)
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {122})
+
+    def test_admin_action(self):
+        orders = [self.create_order(self.products[:1]) for _ in range(3)]
+        Order.objects.filter(id=orders[0].id).update(state=Order.PAID)
+        User.objects.filter(id=self.user.id).update(is_staff=True, is_superuser=True)
+        # The admin takes form data, which APIClient doesn't send.
+        client = Client()
+        client.force_login(self.user)
+        response = client.post('/admin/store/order/', {
+            'action': 'cancel_orders', 'index': 0, '_selected_action': [order.id for order in orders]}, follow=True)
+        self.assertContains(response, 'Anulowano zamówień: 2, pominięto opłaconych: 1.')
+        self.assertEqual(list(Order.objects.values_list('id', flat=True)), [orders[0].id])
+        self.assertEqual(Product.objects.get(id=self.products[0].id).stock, 102)
+
+
+class ReservationTest(StoreTestCase):
+
+    def setUp(self):
+        super(ReservationTest, self).setUp()
+        self.products = self.create_products(2)
+        self.authenticate()
+
+    def reserve(self, product, quantity):
+        return self.client.post('/api/reservations/', {'product': product.slug, 'quantity': quantity})
+
+    def checkout(self, product, quantity):
+        return self.client.post('/api/orders/new/', {
+            'shipping': self.shipping.slug, 'payment': self.payment.slug, 'address': 'Ulica 1',
+            'zip_code': '00-001', 'city': 'Warszawa', 'items': [{'product': product.slug, 'quantity': quantity}]})
+
+    def get_stock(self, product):
+        return Product.objects.get(id=product.id).stock
+
+    def test_concurrent_first_reservation(self):
+        product = self.products[0]
+        update = ReservationQuerySet.update
+
+        def update_after_concurrent_reservation(queryset, **kwargs):
+            updated = update(queryset, **kwargs)
+            if not updated and not Reservation.objects.exists():
+                # Another request of the user commits its first reservation of the product right after this UPDATE.
+                Reservation.objects.create(user=self.user.profile, product=product, quantity=1,
+                                           expires=kwargs['expires'])
+            return updated
+
+        with mock.patch.object(ReservationQuerySet, 'update', autospec=True,
+                               side_effect=update_after_concurrent_reservation):
+            response = self.reserve(product, 2)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['quantity'], 3)
+        self.assertEqual(Reservation.objects.filter(product=product).count(), 1)
+
+    def test_reservation_holds_stock(self):
+        product = self.products[0]
+        response = self.reserve(product, 2)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        expires = response.data['expires']
+        response = self.reserve(product, 1)
+        self.assertEqual(response.data['quantity'], 3)
+        self.assertGreaterEqual(response.data['expires'], expires)
+        self.assertEqual(self.get_stock(product), 97)
+        response = self.client.get('/api/reservations/')
+        self.assertEqual([(item['product'], item['quantity']) for item in response.data], [(product.slug, 3)])
+
+    def test_insufficient_stock(self):
+        product = self.products[0]
+        Product.objects.filter(id=product.id).update(stock=1)
+        response = self.reserve(product, 2)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(product.title, response.data['quantity'])
+        self.assertEqual(self.get_stock(product), 1)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_checkout_claims_reservation_without_touching_product(self):
+        product = self.products[0]
+        self.reserve(product, 3)
+        with CaptureQueriesContext(connection) as context:
+            response = self.checkout(product, 2)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse([query for query in context.captured_queries
+                          if query['sql'].startswith('UPDATE "store_product"')])
+        self.assertEqual(self.get_stock(product), 97)
+        self.assertEqual(Reservation.objects.get().quantity, 1)
+        # One piece comes from the reservation, the other one from the stock.
+        response = self.checkout(product, 2)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get_stock(product), 96)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_release(self):
+        product = self.products[0]
+        reservation_id = self.reserve(product, 5).data['id']
+        other = User.objects.create_user('inny', 'inny@example.com', 'haslo1234')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.delete('/api/reservations/{}/'.format(reservation_id)).status_code,
+                         status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.delete('/api/reservations/{}/'.format(reservation_id)).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.get_stock(product), 100)
+        self.assertEqual(self.client.delete('/api/reservations/{}/'.format(reservation_id)).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_expired_reservations_are_released(self):
+        first, second = self.products
+        self.reserve(first, 2)
+        self.reserve(second, 4)
+        Reservation.objects.filter(product=first).update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([item['product'] for item in self.client.get('/api/reservations/').data], [second.slug])
+        # An expired reservation isn't claimed, the order takes the pieces off the stock.
+        self.assertEqual(self.checkout(first, 1).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get_stock(first), 97)
+        out = StringIO()
+        call_command('release_expired_reservations', batch_size=1, stdout=out)
+        self.assertIn('Zwolniono rezerwacji: 1', out.getvalue())
+        self.assertEqual(self.get_stock(first), 99)
+        self.assertEqual(self.get_stock(second), 96)
+        self.assertEqual(list(Reservation.objects.values_list('product', flat=True)), [second.id])
+
+    def test_release_statements_do_not_depend_on_reservation_count(self):
+        counts = []
+        for size in (1, 10):
+            users = [User.objects.create_user('kupujacy-{}-{}'.format(size, i)) for i in range(size)]
+            for user in users:
+                for product in self.products:
+                    Reservation.objects.reserve(user.profile, product.id, 1)
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(len(Reservation.objects.all().release()), size * len(self.products))
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {100})
+
+
+class ReservationDropTest(StoreDataMixin, TransactionTestCase):
+    """A limited drop: every buyer reserves a piece and checks out, there are half as many pieces as buyers."""
+    threads = 8
+    buyers_per_thread = 5
+    retries = 20
+    stock = 20
+
+    def setUp(self):
+        super(ReservationDropTest, self).setUp()
+        self.product = self.create_products(1, stock=self.stock)[0]
+        self.buyers = [[User.objects.create_user('kupujacy-{}-{}'.format(thread, i)).profile
+                        for i in range(self.buyers_per_thread)] for thread in range(self.threads)]
+
+    def test_drop(self):
+        results = ReservationDrop(self.product, self.buyers, self.shipping.slug, self.payment.slug,
+                                  self.retries).run()
+
+        # A buyer holding a reservation always gets the piece, only reserving can find the product sold out.
+        self.assertEqual(results['failed_checkout'], [])
+        stock = Product.objects.get(id=self.product.id).stock
+        ordered = OrderItem.objects.aggregate(total=Sum('quantity'))['total'] or 0
+        held = Reservation.objects.aggregate(total=Sum('quantity'))['total'] or 0
+        self.assertGreaterEqual(stock, 0)
+        self.assertEqual(stock + ordered + held, self.stock)
+        self.assertEqual(ordered, len(results['bought']))
+        if not results['errors']:
+            self.assertEqual(ordered, self.stock)
+
+    def test_benchmark_command(self):
+        for buyers in self.buyers:
+            for buyer in buyers:
+                buyer.user.username = USERNAME_PREFIX + buyer.user.username
+                buyer.user.save()
+        out = StringIO()
+        call_command('benchmark_reservation_drop', threads=2, buyers=3, stock=4, stdout=out)
+        self.assertTrue(out.getvalue().startswith('Kupiono '))
+        self.assertEqual(Product.objects.get(id=self.product.id).stock, self.stock)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Reservation.objects.exists())
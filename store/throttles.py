@@ -1,23 +1,59 @@
 from rest_framework.throttling import UserRateThrottle
 
 
-class ProductDetailThrottle(UserRateThrottle):
-
-    rate = '30/m'
-    scope = 'product-detail'
+class SlidingWindowUserRateThrottle(UserRateThrottle):
+    """
+    Per user rate limit with a sliding window counter. Requests are counted in fixed windows of the rate's duration
+    and the count of the last `duration` seconds is estimated as the current window plus the part of the previous
+    one still inside the sliding window. The state is two integers per user and scope, read with one get_many and
+    only accepted requests are counted with an atomic incr, so a rejected request costs a single cache round trip.
+    Concurrent requests of one user may all pass the check before any of them is counted, so the limit can be
+    exceeded by the number of such requests.
+    """
 
     def allow_request(self, request, view):
-        if request.method == 'OPTIONS':
+        if request.method == 'OPTIONS' or self.rate is None:
             return True
-        return super(ProductDetailThrottle, self).allow_request(request, view)
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        self.now = self.timer()
+        window, elapsed = divmod(self.now, self.duration)
+        current_key, previous_key = '{}:{:.0f}'.format(key, window), '{}:{:.0f}'.format(key, window - 1)
+        counts = self.cache.get_many([current_key, previous_key])
+        self.current, self.previous = counts.get(current_key, 0), counts.get(previous_key, 0)
+        self.previous_weight = 1 - elapsed / self.duration
+        # Rejected requests don't use up the limit, same as in DRF throttles.
+        if self.previous * self.previous_weight + self.current + 1 > self.num_requests:
+            return False
+        self.increment(current_key)
+        return True
+
+    def increment(self, key):
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Twice the duration, the window is still read as the previous one during the next window.
+            if self.cache.add(key, 1, 2 * self.duration):
+                return 1
+            return self.cache.incr(key)
+
+    def wait(self):
+        if self.current >= self.num_requests or not self.previous:
+            # Until the end of the current window, the estimate is only a lower bound then.
+            return self.duration * self.previous_weight
+        # Seconds until the previous window's share drops enough to let one more request in.
+        weight = (self.num_requests - self.current - 1) / self.previous
+        return max(self.previous_weight - weight, 0) * self.duration
+
+
+class ProductDetailThrottle(SlidingWindowUserRateThrottle):
 
+    rate = '30/m'
+    scope = 'product-detail'
 
-class ProductListThrottle(UserRateThrottle):
 
-    rate = '20/m'
-    scope = 'product-detail'
+class ProductListThrottle(SlidingWindowUserRateThrottle):
 
-    def allow_request(self, request, view):
-        if request.method == 'OPTIONS':
-            return True
-        return super(ProductListThrottle, self).allow_request(request, view)
+    rate = '20/m'
+    scope = 'product-list'
@@ -2,7 +2,8 @@ from django.conf.urls import url, include
 from rest_framework.routers import DefaultRouter
 
 from store.views import ProductListView, ProductDetailView, ReviewView, OrderDetailView,\
-                        OrdersListView, OrderCreateView, RetrieveCurrentUserProfile
+                        OrdersListView, OrderCreateView, RetrieveCurrentUserProfile, ProductFacetsView,\
+                        ProductFeedView, ReservationsView, ReservationDetailView
 
 
 router = DefaultRouter()
@@ -10,11 +11,15 @@ router = DefaultRouter()
 
 urlpatterns = [
     url(r'^products/$', ProductListView.as_view()),
+    url(r'^products/facets/$', ProductFacetsView.as_view()),
+    url(r'^products/feed/$', ProductFeedView.as_view()),
     url(r'^products/(?P<slug>[\w-]+)/$', ProductDetailView.as_view()),
     url(r'^reviews/$', ReviewView.as_view()),
     url(r'^orders/$', OrdersListView.as_view()),
     url(r'^orders/new/$', OrderCreateView.as_view()),
     url(r'^orders/(?P<pk>[\d]+)/$', OrderDetailView.as_view()),
+    url(r'^reservations/$', ReservationsView.as_view()),
+    url(r'^reservations/(?P<pk>[\d]+)/$', ReservationDetailView.as_view()),
     url(r'^profile/$', RetrieveCurrentUserProfile.as_view()),
     url(r'^', include(router.urls)),
 ]
@@ -1,12 +1,16 @@
-from django.core.mail import send_mail
+from calendar import timegm
+from hashlib import md5
+
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
 
 from music_store.settings import EMAIL_ADDRESS
-from store.models import BankInfo
+from store.models import OutgoingEmail
 
 
-def send_email_about_order(instance):
+def send_email_about_order(instance, bank_info):
+    """Queues the order email in the outbox, call it inside the order transaction."""
     if instance.payment.slug == 'przelew-bankowy':
-        bank_info = BankInfo.objects.first()
         email_body = """
         Witaj {username}
         
@@ -19,7 +23,30 @@ def send_email_about_order(instance):
         
         Pozdrawiamy
         Zespół Music Shop
-        """.format(username=instance.user.user, price=str(instance.total_price()), account=bank_info.account,
+        """.format(username=instance.user.user, price=str(instance.total_price), account=bank_info.account,
                    name=bank_info.name, address=bank_info.address, title=instance.code)
         email_title = 'Music Shop - Dziekujemy za zamowienie'
-        send_mail(email_title, email_body, EMAIL_ADDRESS, [instance.user.user.email])
+        OutgoingEmail.objects.create(subject=email_title, body=email_body, from_email=EMAIL_ADDRESS,
+                                     to=instance.user.user.email)
+
+
+def make_etag(request, *parts):
+    """ETag of the response representation, so browsable API and JSON responses don't share validators."""
+    value = '|'.join([request.accepted_media_type or '', request.get_full_path()] + [str(part) for part in parts])
+    return quote_etag(md5(value.encode('utf-8')).hexdigest())
+
+
+def conditional_response(request, get_response, etag=None, last_modified=None):
+    """
+    Answers with 304 Not Modified when the request validators match `etag`/`last_modified`, otherwise returns
+    get_response(). Either way the response carries the validators.
+    """
+    last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = get_response()
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
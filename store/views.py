@@ -1,43 +1,225 @@
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.db import transaction, IntegrityError
+from django.db.models import Prefetch, Count, OuterRef, Subquery
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView, RetrieveAPIView, CreateAPIView, ListCreateAPIView, RetrieveUpdateAPIView
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.views import APIView, Response
 
-from store.paginations import StandardResultsSetPagination
-from store.filters import ProductFilterSet, ReviewFilterSet
-from store.models import Product, Review, Order, BankInfo, UserProfile
-from store.utils import send_email_about_order
+from store.permissions import IsStaffOrFeedKey
+from store.routers import ReplicaReadMixin
+from store.paginations import StandardResultsSetPagination, ProductResultsSetPagination, OrderResultsSetPagination
+from store.filters import ProductFilterSet, ReviewFilterSet, OrderFilterSet
+from store.facets import get_facets
+from store.fragments import FRAGMENT_FIELDS, PrerenderedJSON, PrerenderedJSONRenderer, get_product_fragments,\
+    render_page
+from store.feeds import iter_products, render_csv, render_ndjson
+from store.models import Product, Review, Order, OrderItem, BankInfo, UserProfile, Reservation
+from store.utils import send_email_about_order, conditional_response, make_etag
+from store.caching import get_list_cache_key, get_cached_list, set_cached_list, get_product_cache_key,\
+    get_cached_product, set_cached_product, get_product_dependencies, get_review_dependencies, get_versions
 from store.throttles import ProductDetailThrottle, ProductListThrottle
 from store.serializers import ProductsListSerializer, ProductDetailSerializer, ReviewSerializer, OrderDetailSerializer,\
-    OrderListSerializer, OrderCreateSerizalizer, BankInfoSerializer, UserProfileSerializer
+    OrderListSerializer, OrderCreateSerizalizer, BankInfoSerializer, UserProfileSerializer, ReviewThreadSerializer,\
+    ReservationSerializer
 
 
-class ProductListView(ListAPIView):
-    queryset = Product.objects.select_related('genre', 'artist', 'medium_type', 'label')
+class ProductListView(ReplicaReadMixin, ListAPIView):
+    """
+    Pages are joined of pre-rendered JSON fragments of products, see store.fragments. The page query loads only
+    ids and `updated`, products are loaded and serialized only for the fragments missing in the cache.
+    """
+    queryset = Product.objects.select_related('genre', 'artist', 'medium_type', 'label').prefetch_related('tags')
+    page_queryset = Product.objects.only(*FRAGMENT_FIELDS + ProductResultsSetPagination.cursor_ordering_fields)
     serializer_class = ProductsListSerializer
+    renderer_classes = (PrerenderedJSONRenderer, BrowsableAPIRenderer)
     throttle_classes = (ProductListThrottle, )
     filter_backends = (DjangoFilterBackend, )
     filter_class = ProductFilterSet
-    pagination_class = StandardResultsSetPagination
+    pagination_class = ProductResultsSetPagination
+
+    def list(self, request, *args, **kwargs):
+        allowed_params = set(self.filter_class.base_filters) | {'page', 'page_size', 'cursor'}
+        key = get_list_cache_key(request, allowed_params, prefix='catalog:page')
+        return conditional_response(request, lambda: self.get_list_response(key), etag=make_etag(request, key))
+
+    def get_list_response(self, key):
+        content = get_cached_list(key)
+        if content is None:
+            content = self.render_page()
+            set_cached_list(key, content)
+        return Response(PrerenderedJSON(content))
+
+    def render_page(self):
+        products = self.paginate_queryset(self.filter_queryset(self.page_queryset.all()))
+        fragments = get_product_fragments(self.request, products, lambda ids: self.queryset.filter(id__in=ids),
+                                          lambda instances: self.get_serializer(instances, many=True).data)
+        return render_page(self.get_paginated_response([]).data, fragments)
+
+
+class ProductFacetsView(ReplicaReadMixin, APIView):
+    queryset = Product.objects.all()
+    throttle_classes = (ProductListThrottle, )
+    filter_class = ProductFilterSet
+
+    def get(self, request, *args, **kwargs):
+        key = get_list_cache_key(request, set(self.filter_class.base_filters), prefix='catalog:facets')
+        return conditional_response(request, lambda: self.get_facets_response(key), etag=make_etag(request, key))
 
+    def get_facets_response(self, key):
+        data = get_cached_list(key)
+        if data is None:
+            data = get_facets(self.filter_class, self.request.query_params, self.queryset)
+            set_cached_list(key, data)
+        return Response(data)
 
-class ProductDetailView(RetrieveAPIView):
-    queryset = Product.objects.select_related('genre', 'artist', 'medium_type', 'label')
+
+class ProductFeedView(APIView):
+    """
+    Whole catalog as NDJSON or CSV (?format=csv), streamed in chunks. With ?since=<ISO timestamp> only products
+    changed since then, the X-Feed-Next-Since header holds the value to use for the next download.
+    """
+    permission_classes = (IsStaffOrFeedKey, )
+    feed_renderers = {'ndjson': (render_ndjson, 'application/x-ndjson; charset=utf-8'),
+                       'csv': (render_csv, 'text/csv; charset=utf-8')}
+
+    def get(self, request, *args, **kwargs):
+        feed_format = request.query_params.get('format', 'ndjson')
+        if feed_format not in self.feed_renderers:
+            raise ValidationError({'format': 'Dostępne formaty: csv, ndjson.'})
+        since = request.query_params.get('since')
+        if since is not None:
+            try:
+                since = parse_datetime(since)
+            except ValueError:
+                since = None
+            if since is None:
+                raise ValidationError({'since': 'Niepoprawna data.'})
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since, timezone.utc)
+        # Taken before the first query, so a product changed while streaming is sent again next time.
+        next_since = timezone.now()
+        render, content_type = self.feed_renderers[feed_format]
+        chunks = iter_products(since, settings.CATALOG_FEED_CHUNK_SIZE,
+                               lambda name: request.build_absolute_uri(default_storage.url(name)))
+        response = StreamingHttpResponse(render(chunks), content_type=content_type)
+        response['X-Feed-Next-Since'] = next_since.isoformat()
+        if feed_format == 'csv':
+            response['Content-Disposition'] = 'attachment; filename="katalog.csv"'
+        return response
+
+    def perform_content_negotiation(self, request, force=False):
+        # ?format= picks the feed format here, not one of the REST framework renderers, used only for errors.
+        return super(ProductFeedView, self).perform_content_negotiation(request, force=True)
+
+
+class ProductDetailView(ReplicaReadMixin, RetrieveAPIView):
+    queryset = Product.objects.select_related('genre', 'artist', 'medium_type', 'label', 'rating')\
+        .prefetch_related('tags')
     serializer_class = ProductDetailSerializer
     throttle_classes = (ProductDetailThrottle, )
     lookup_field = 'slug'
 
+    def retrieve(self, request, *args, **kwargs):
+        key = get_product_cache_key(request, kwargs['slug'])
+        entry = get_cached_product(key)
+        if entry is not None:
+            versions, data = entry
+            return conditional_response(request, lambda: Response(data),
+                                        etag=make_etag(request, sorted(versions.items())))
+        instance = self.get_object()
+        versions = get_versions(get_product_dependencies(instance))
+        return conditional_response(request, lambda: self.get_detail_response(key, instance, versions),
+                                    etag=make_etag(request, sorted(versions.items())))
 
-class ReviewView(ListCreateAPIView):
-    queryset = Review.objects.filter(is_active=True)
+    def get_detail_response(self, key, instance, versions):
+        data = self.get_serializer(instance).data
+        set_cached_product(key, versions, data)
+        return Response(data)
+
+
+class ReviewView(ReplicaReadMixin, ListCreateAPIView):
+    queryset = Review.objects.filter(is_active=True).select_related('author__user', 'product')
     serializer_class = ReviewSerializer
     permission_classes = (IsAuthenticatedOrReadOnly, )
     pagination_class = StandardResultsSetPagination
     filter_backends = (DjangoFilterBackend, )
     filter_class = ReviewFilterSet
 
+    thread_depth = 3
+    max_thread_depth = 10
+    thread_children = 10
+    max_thread_children = 50
+
+    def list(self, request, *args, **kwargs):
+        # Validators follow versions bumped by every change of a review or an author, there is no Last-Modified:
+        # a deactivated or deleted review, or a renamed author, doesn't move the newest `updated` forward.
+        product_ids = None
+        if 'product' in request.query_params:
+            product_ids = Product.objects.filter(slug=request.query_params['product']).values_list('id', flat=True)
+        versions = get_versions(get_review_dependencies(product_ids))
+        if 'threaded' in request.query_params:
+            get_response = self.list_threads
+        else:
+            get_response = partial(super(ReviewView, self).list, request, *args, **kwargs)
+        return conditional_response(request, get_response, etag=make_etag(request, sorted(versions.items())))
+
+    def list_threads(self):
+        """
+        Paginates root reviews (or the `root` one) with their replies nested up to `depth` levels and `children`
+        replies per review. Replies are loaded one query per level, only the first `children` of each review,
+        and their counts come from one aggregate, so a thread with thousands of replies loads just what is shown.
+        A single `path__startswith` range would load every reply of the thread, `path` only orders the replies of
+        a level and groups them under their parents.
+        """
+        params = self.request.query_params
+        roots = self.filter_queryset(self.get_queryset())
+        if params.get('root', '').isdigit():
+            roots = roots.filter(id=params['root'])
+        else:
+            roots = roots.filter(parent__isnull=True)
+        page = self.paginate_queryset(roots)
+        depth = self.get_limit('depth', self.thread_depth, self.max_thread_depth)
+        children = self.get_limit('children', self.thread_children, self.max_thread_children)
+        replies = defaultdict(list)
+        shown = [review.id for review in page or ()]
+        parents = shown if children else []
+        for _ in range(depth):
+            if not parents:
+                break
+            # Siblings share the parent path, so their id order is their path order.
+            first_children = Review.objects.filter(parent=OuterRef('parent'), is_active=True).order_by('id')
+            level = list(self.get_queryset().filter(parent__in=parents,
+                                                    id__in=Subquery(first_children.values('id')[:children]))
+                         .order_by('path'))
+            for reply in level:
+                replies[reply.parent_path].append(reply)
+            parents = [reply.id for reply in level]
+            shown.extend(parents)
+        replies_count = {}
+        if shown:
+            replies_count = dict(Review.objects.filter(parent__in=shown, is_active=True).order_by()
+                                 .values('parent').annotate(count=Count('id')).values_list('parent', 'count'))
+        context = self.get_serializer_context()
+        context.update(replies=replies, replies_count=replies_count, max_depth=page[0].depth + depth if page else 0)
+        return self.get_paginated_response(ReviewThreadSerializer(page, many=True, context=context).data)
+
+    def get_limit(self, param, default, maximum):
+        try:
+            return min(max(int(self.request.query_params[param]), 0), maximum)
+        except (KeyError, ValueError):
+            return default
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user.profile)
 
@@ -45,33 +227,36 @@ class ReviewView(ListCreateAPIView):
 class OrdersListView(ListAPIView):
     permission_classes = (IsAuthenticated, )
     serializer_class = OrderListSerializer
+    pagination_class = OrderResultsSetPagination
+    filter_backends = (DjangoFilterBackend, )
+    filter_class = OrderFilterSet
 
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user.profile)
+        return Order.objects.filter(user=self.request.user.profile).select_related('shipping', 'payment')
 
 
 class OrderDetailView(APIView):
     permission_classes = (IsAuthenticated, )
 
     def get(self, request, pk, *args, **kwargs):
+        items = Prefetch('items', queryset=OrderItem.objects.select_related('product__genre', 'product__artist',
+                                                                            'product__medium_type', 'product__label',
+                                                                            'product__rating'))
         try:
-            order = Order.objects.prefetch_related('items').get(id=pk, user=request.user.profile)
+            order = Order.objects.select_related('user__user', 'shipping', 'payment')\
+                .prefetch_related(items, 'items__product__tags').get(id=pk, user=request.user.profile)
         except Order.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
         return Response(OrderDetailSerializer(order).data, status=status.HTTP_200_OK)
 
     def delete(self, request, pk, *args, **kwargs):
-        try:
-            order = Order.objects.prefetch_related('items').get(id=pk, user=request.user.profile)
-        except Order.DoesNotExist:
+        orders = Order.objects.filter(id=pk, user=request.user.profile)
+        if orders.cancel():
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        if not orders.exists():
             return Response(status=status.HTTP_404_NOT_FOUND)
-        if order.state != Order.ORDERED:
-            return Response({'error': 'Zamówienie zostało już opłacone i nie może zostać usunięte,'
-                                      ' prosimy o kontakt osobisty.'}, status=status.HTTP_400_BAD_REQUEST)
-        for item in order.items.all():
-            item.delete()
-        order.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response({'error': 'Zamówienie zostało już opłacone i nie może zostać usunięte,'
+                                  ' prosimy o kontakt osobisty.'}, status=status.HTTP_400_BAD_REQUEST)
 
 
 class OrderCreateView(CreateAPIView):
@@ -79,11 +264,15 @@ class OrderCreateView(CreateAPIView):
     serializer_class = OrderCreateSerizalizer
     queryset = Order.objects.all().select_related('user__user')
 
+    bank_info = None
+
     def perform_create(self, serializer):
         try:
             with transaction.atomic():
                 order = serializer.save(user=self.request.user.profile)
-                transaction.on_commit(lambda: send_email_about_order(order))
+                if order.payment.slug == 'przelew-bankowy':
+                    self.bank_info = BankInfo.objects.first()
+                send_email_about_order(order, self.bank_info)
         except IntegrityError:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -94,13 +283,33 @@ class OrderCreateView(CreateAPIView):
         headers = self.get_success_headers(serializer.data)
         payment_method = serializer.data.get('payment', None)
         if payment_method == 'przelew-bankowy':
-            bank_info = BankInfo.objects.first()
-            body = {'order': serializer.data, 'info': BankInfoSerializer(bank_info).data}
+            body = {'order': serializer.data, 'info': BankInfoSerializer(self.bank_info).data}
             return Response(body, status=status.HTTP_201_CREATED, headers=headers)
         else:
             return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
 
+class ReservationsView(ListCreateAPIView):
+    """Pieces in the user's cart, held until they are ordered or the reservation expires."""
+    permission_classes = (IsAuthenticated, )
+    serializer_class = ReservationSerializer
+
+    def get_queryset(self):
+        return Reservation.objects.live().filter(user=self.request.user.profile).select_related('product')
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user.profile)
+
+
+class ReservationDetailView(APIView):
+    permission_classes = (IsAuthenticated, )
+
+    def delete(self, request, pk, *args, **kwargs):
+        if Reservation.objects.filter(id=pk, user=request.user.profile).release():
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(status=status.HTTP_404_NOT_FOUND)
+
+
 class RetrieveCurrentUserProfile(RetrieveUpdateAPIView):
     serializer_class = UserProfileSerializer
     permission_classes = (IsAuthenticated, )